@@ -1,43 +1,80 @@
 """
 Entry point for FiberSim_utilities
 @author: Ken Campbell
+
+Each subcommand imports its handler when it is called, so a process that
+is launched for one subcommand, such as the characterize jobs started by
+sample_model, does not pay for the imports of the others. The modules
+for each subcommand, and a budget for the time taken to import them in
+a new interpreter, are listed in import_budgets. Budgets are in seconds
+(budget_s), or a multiple (budget_ref) of the time taken to import
+numpy, pandas, scipy and matplotlib on the same machine. They can be
+checked with
+    python FiberPy.py check_import_times [budget_factor]
 """
 
 import sys
 
-from package.modules.display.animate_cb_distributions import animate_cb_distributions as anim_cb
-from package.modules.batch.batch import run_batch
-from package.modules.batch.batch import run_multiple_batch
-from package.modules.output_handler import output_handler as oh
-from package.modules.fitting.fit_model import fit_model
-from package.modules.visualization import render as viz
-from package.modules.visualization.create_movie import create_hs_movie as cm
-from package.modules.characterize import characterize_model as characterize
-from package.modules.sample import sample_model as sample
+
+# Packages that are slow to import, or optional, and that are only needed
+# by a few subcommands
+heavy_packages = ['emcee', 'corner', 'cv2', 'imageio', 'sklearn']
+
+import_budgets = {
+    'dispatch': {'modules': ['FiberPy'],
+                 'budget_s': 0.1,
+                 'forbidden': heavy_packages + ['numpy']},
+    'run_batch': {'modules': ['package.modules.batch.batch'],
+                  'budget_ref': 1.5,
+                  'forbidden': heavy_packages},
+    'make_figures': {'modules': ['package.modules.output_handler.output_handler'],
+                     'budget_ref': 1.25,
+                     'forbidden': heavy_packages},
+    'characterize': {'modules': ['package.modules.characterize.characterize_model'],
+                     'budget_ref': 1.5,
+                     'forbidden': heavy_packages},
+    'sample': {'modules': ['package.modules.sample.sample_model'],
+               'budget_ref': 1.5,
+               'forbidden': heavy_packages},
+    'fit_model': {'modules': ['package.modules.fitting.fit_model'],
+                  'budget_ref': 1.5,
+                  'forbidden': heavy_packages}
+}
 
 
 def parse_inputs():
 
     if (sys.argv[1] == "run_batch"):
+        from package.modules.batch.batch import run_batch
         if (len(sys.argv)==3):
             run_batch(sys.argv[2])
+        elif (sys.argv[3] == "resume"):
+            run_batch(sys.argv[2], resume=True)
         else:
             run_batch(sys.argv[2], figures_only=True)
 
     if (sys.argv[1] == "make_figures"):
+        from package.modules.output_handler import output_handler as oh
         oh.output_handler(sys.argv[2],
                           sim_results_file_string=sys.argv[3])
 
     if (sys.argv[1] == "fit_model"):
-        fit_model(sys.argv[2])
+        from package.modules.fitting.fit_model import fit_model
+        if (len(sys.argv) == 4) and (sys.argv[3] in ["resume", "--resume"]):
+            fit_model(sys.argv[2], resume=True)
+        else:
+            fit_model(sys.argv[2])
 
     if (sys.argv[1] == "render_model"):
+        from package.modules.visualization import render as viz
         viz.generate_images(sys.argv[2])
-    
+
     if (sys.argv[1] == "movie_with_data"):
+        from package.modules.visualization import render as viz
         viz.generate_movie_with_data(sys.argv[2])
-    
+
     if (sys.argv[1] == "animate_cb_distribs"):
+        from package.modules.display.animate_cb_distributions import animate_cb_distributions as anim_cb
         if (len(sys.argv) == 5):
             frames = sys.argv[4]
         else:
@@ -46,17 +83,34 @@ def parse_inputs():
             sys.argv[2], sys.argv[3], frames)
 
     if (sys.argv[1] == "spatial_visualization"):
+        from package.modules.visualization.create_movie import create_hs_movie as cm
         cm(sys.argv[2], sys.argv[3])
-    
+
     if (sys.argv[1] == "characterize"):
+        from package.modules.characterize import characterize_model as characterize
         characterize.characterize_model(sys.argv[2])
 
     if (sys.argv[1] == "run_all_demos"):
-        run_multiple_batch(sys.argv[2])
-        
+        from package.modules.batch.batch import run_multiple_batch
+        if (len(sys.argv) == 4) and (sys.argv[3] == "resume"):
+            run_multiple_batch(sys.argv[2], resume=True)
+        else:
+            run_multiple_batch(sys.argv[2])
+
     if (sys.argv[1] == "sample"):
+        from package.modules.sample import sample_model as sample
         sample.sample_model(sys.argv[2])
 
+    if (sys.argv[1] == "check_import_times"):
+        from package.modules.utilities import import_times
+        if (len(sys.argv) == 3):
+            budget_factor = float(sys.argv[2])
+        else:
+            budget_factor = 1.0
+        if not import_times.check_import_times(import_budgets,
+                                               budget_factor):
+            exit(1)
+
 
 if __name__ == "__main__":
     parse_inputs()
@@ -7,10 +7,12 @@ Created on Wed Sep  8 14:11:32 2021
 
 import os
 import json
+import multiprocessing
+
+import concurrent.futures
 
 import numpy as np
 import pandas as pd
-from natsort import natsorted
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
@@ -21,9 +23,13 @@ import matplotlib.gridspec as gridspec
 # MODULES_ROOT = os.path.realpath(os.path.join(ROOT, "..", ".."))
 # sys.path.append(MODULES_ROOT)
 
-from modules.half_sarcomere import half_sarcomere
+from modules.half_sarcomere import hs_status
 
-def get_ATP_cons(data, batch_file_string): # Calculate the ATP consumption rate 
+def get_ATP_cons(data, batch_file_string, max_workers=None): # Calculate the ATP consumption rate 
+    """ Calculates the ATP consumption rate for each dump folder and writes
+        the rates, and the rate in each dump interval, to an Excel file.
+        The dump folders are independent and are analyzed in parallel using
+        up to max_workers processes """
     
     # Pull off the base folder
     base_folder = os.path.dirname(batch_file_string)
@@ -47,19 +53,35 @@ def get_ATP_cons(data, batch_file_string): # Calculate the ATP consumption rate
         else:
             dump_folder = elmt    
         dump_array.append(dump_folder)
+
+    # Analyze the folders, in parallel if there is more than one
+    if (max_workers is None):
+        max_workers = multiprocessing.cpu_count()
+    max_workers = int(min([max_workers, len(model_array)]))
+
+    if (max_workers > 1):
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers) as executor:
+            time_series = list(executor.map(calculate_ATPase_time_series,
+                                            model_array, dump_array))
+    else:
+        time_series = [calculate_ATPase_time_series(m, d)
+                       for (m, d) in zip(model_array, dump_array)]
     
     # Create lists to hold data
     case = []
     ATP_cons_per_head = []
     ATP_cons = []
     
-    for i in range(len(model_array)):
+    for i, ts in enumerate(time_series):
         
-        ATP_head, ATP_cons_mol = calculate_ATPase_rate(model_array[i], dump_array[i])
+        ATP_head, ATP_cons_mol = return_overall_rates(ts)
         
         case.append(i+1)
         ATP_cons_per_head.append(ATP_head)
         ATP_cons.append(ATP_cons_mol)
+
+        ts.insert(0, 'case', i+1)
     
     # If more than one rate is calculated, create a figure
     ### CREATE figure
@@ -72,6 +94,8 @@ def get_ATP_cons(data, batch_file_string): # Calculate the ATP consumption rate
                     'ATP consumption \n rate \n (# molecule / myosin head /s)': ATP_cons_per_head,
                     'ATP \n consumption \n rate \n (mol / s / mg)': ATP_cons})
 
+    ts = pd.concat(time_series, ignore_index=True)
+
     # Save the data as an excel file if required in the batch file
     if(data['output_data_file_string']):
         if (data['relative_to'] == 'this_file'):
@@ -82,97 +106,134 @@ def get_ATP_cons(data, batch_file_string): # Calculate the ATP consumption rate
 
         print('Writing ATP consumption rates to %s' % output_file_string)
         
-        
-        #writer = pd.ExcelWriter(output_file_string) 
-        
-        r.to_excel(output_file_string, sheet_name='atp_consumption',
-                   engine='openpyxl',
-                   index=False)
-        
+        with pd.ExcelWriter(output_file_string, engine='openpyxl') as writer:
+            r.to_excel(writer, sheet_name='atp_consumption', index=False)
+            ts.to_excel(writer, sheet_name='atp_time_series', index=False)
 
-               
+    return (r, ts)
 
 def calculate_ATPase_rate(model_file, dump_folder):
     
     """Calculate the number of ATP molecules consumed per unit time"""
 
-    ### Get the hs_status dump files ###
-
-    hs_file = []
+    return return_overall_rates(
+        calculate_ATPase_time_series(model_file, dump_folder))
 
-    for filenames in os.listdir(dump_folder):
-        filenames = os.path.join(dump_folder, filenames)
+def calculate_ATPase_time_series(model_file, dump_folder):
+    """ Returns a DataFrame with the number of ATP molecules consumed in
+        each interval between consecutive dump files, and the
+        corresponding rates. The values needed for the overall rates are
+        stored in the attrs of the DataFrame """
 
-        hs_file.append(filenames)
-
-    hs_file = natsorted(hs_file) # sorting the dump files    
-    
-    ### Initialize the number of ATPs consumed
-    
-    no_of_ATP = 0
-    
     ### Extract the kinetics data
     
     m_kinetics = get_m_kinetics(model_file) 
-    
+
+    # Look-up tables for the state type and the extension of each state
+    no_of_states = max([len(isotype) for isotype in m_kinetics])
+    is_A = np.zeros((len(m_kinetics), no_of_states+1), dtype=bool)
+    is_D = np.zeros((len(m_kinetics), no_of_states+1), dtype=bool)
+    for i, isotype in enumerate(m_kinetics):
+        for j, state in enumerate(isotype):
+            is_A[i, j+1] = (state["state_type"] == 'A')
+            is_D[i, j+1] = (state["state_type"] == 'D')
+
+    fields = ['cb_state', 'cb_iso', 'm_cbs_per_node']
+
     ### Loop over the dump files
-               
-    # HS at t
-    hs_0 = half_sarcomere.half_sarcomere(hs_file[0])
-    
-    # Get the extension array
-    
-    ext = hs_0["hs_data"]["cb_extensions"]
-  
-    for ind in range(1,len(hs_file)): 
-        # HS at t + dt
-        hs_1 = half_sarcomere.half_sarcomere(hs_file[ind])
-      
-        for i, thick_fil_0 in enumerate(hs_0["thick"]): # Loop over all thick filaments
-            
-            thick_fil_1 = hs_1["thick"][i] 
-   
-            for cb_ind, state_0 in enumerate(thick_fil_0["cb_state"]): # loop over all CBs
-                
-                cb_iso_0 = thick_fil_0["cb_iso"][cb_ind] # CB isotype at t
-                cb_iso_1 = thick_fil_1["cb_iso"][cb_ind] # CB isotype at t + dt
-               
-                # Check isotype does not change through time
-                if cb_iso_0 != cb_iso_1:                    
-                    raise RuntimeError(f"Isotype #{cb_iso_0} turned into isotype #{cb_iso_1}")
-                    
-                cb_state_0 = thick_fil_0["cb_state"][cb_ind] # CB state at t
-                cb_state_1 = thick_fil_1["cb_state"][cb_ind] # CB state at t + dt
-                
-                cb_0_type = m_kinetics[cb_iso_0-1][cb_state_0-1]["state_type"] # CB type at t
-                cb_1_type = m_kinetics[cb_iso_1-1][cb_state_1-1]["state_type"] # CB type at t + dt
-                                                
-                ### Determine if a detachment occurred ### 
-           
-                if cb_0_type == 'A' and cb_1_type == 'D': # A detachment event occured 
-                    
-                    cb_ext = ext[cb_state_0  - 1] # get the CB extension
-                    
-                    if cb_ext > 0.0 : # A post-power stroke detachment event occured 
-                    
-                        no_of_ATP += 1                                
-              
+
+    time = []
+    no_of_ATP = []
+    hs_length = []
+
+    hs_0 = None
+    for hs_1 in hs_status.iterate_dump_folder(dump_folder, fields):
+
+        if (hs_0 is None):
+            # Get the extension array
+            ext = np.asarray(hs_1["hs_data"]["cb_extensions"])
+            post_stroke = np.zeros(max([no_of_states, len(ext)])+1,
+                                   dtype=bool)
+            post_stroke[1:len(ext)+1] = (ext > 0.0)
+            time_0 = hs_1["hs_data"]["time"]
+        else:
+            iso_0 = hs_0["thick"]["cb_iso"] # CB isotype at t
+            iso_1 = hs_1["thick"]["cb_iso"] # CB isotype at t + dt
+
+            # Check isotype does not change through time
+            bad = (iso_0 != iso_1)
+            if np.any(bad):
+                (f, c) = np.argwhere(bad)[0]
+                raise RuntimeError(f"Isotype #{iso_0[f, c]} turned into isotype #{iso_1[f, c]}")
+
+            state_0 = hs_0["thick"]["cb_state"] # CB state at t
+            state_1 = hs_1["thick"]["cb_state"] # CB state at t + dt
+
+            # A post-power stroke detachment event uses one ATP
+            detached = is_A[iso_0-1, state_0] & is_D[iso_1-1, state_1] & \
+                post_stroke[state_0]
+
+            time.append(hs_1["hs_data"]["time"])
+            no_of_ATP.append(np.count_nonzero(detached))
+            hs_length.append(hs_1["hs_data"]["hs_length"])
+
         hs_0 = hs_1
-        
-    total_time = hs_0["hs_data"]["time"] # Time in s
 
-    no_myosin_heads = len(hs_0["thick"]) * hs_0["hs_data"]["m_nodes_per_thick_filament"] * hs_0 ["thick"][0]["m_cbs_per_node"]
-    
-    ATP_per_head = no_of_ATP/no_myosin_heads/total_time # Get the number of ATP molecules consumed per unit time per myosin head
-    
+    no_of_thick = hs_0.no_of_filaments('thick')
+    no_myosin_heads = no_of_thick * hs_0["hs_data"]["m_nodes_per_thick_filament"] * \
+        hs_0["thick"]["m_cbs_per_node"][0]
+
+    time = np.asarray(time, dtype=float)
+    no_of_ATP = np.asarray(no_of_ATP)
+    dt = np.diff(np.concatenate(([time_0], time)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ATP_per_head = no_of_ATP / no_myosin_heads / dt
+        ATP_cons = convert_to_mol_per_mg(no_of_ATP, dt, no_of_thick,
+                                         np.asarray(hs_length),
+                                         hs_0["hs_data"]["m_filament_density"])
+
+    ts = pd.DataFrame({'time_s': time,
+                       'no_of_ATP': no_of_ATP,
+                       'ATP_per_head_per_s': ATP_per_head,
+                       'ATP_mol_per_s_per_mg': ATP_cons})
+
+    ts.attrs['total_time'] = hs_0["hs_data"]["time"] # Time in s
+    ts.attrs['no_myosin_heads'] = no_myosin_heads
+    ts.attrs['no_of_thick'] = no_of_thick
+    ts.attrs['hs_length'] = hs_0["hs_data"]["hs_length"]
+    ts.attrs['m_filament_density'] = hs_0["hs_data"]["m_filament_density"]
+
+    return ts
+
+def return_overall_rates(ts):
+    """ Returns the overall ATP consumption rates per myosin head and in
+        mol/s/mg from a time series """
+
+    no_of_ATP = int(ts['no_of_ATP'].sum())
+    total_time = ts.attrs['total_time']
+
+    ATP_per_head = no_of_ATP/ts.attrs['no_myosin_heads']/total_time # Get the number of ATP molecules consumed per unit time per myosin head
+
+    ATP_cons = convert_to_mol_per_mg(no_of_ATP, total_time,
+                                     ts.attrs['no_of_thick'],
+                                     ts.attrs['hs_length'],
+                                     ts.attrs['m_filament_density'])
+
+    return ATP_per_head, ATP_cons
+
+def convert_to_mol_per_mg(no_of_ATP, total_time, no_of_thick, hs_length,
+                          m_filament_density):
+    """ Converts a number of ATP molecules consumed in total_time to
+        mol/s/mg of muscle """
+
     N_A = 6e23 # Avogadro number
     
-    vol = len(hs_0["thick"])* hs_0["hs_data"]["hs_length"] *1e-9 /hs_0["hs_data"]["m_filament_density"] # half-sarcomere volume (in m³)
+    vol = no_of_thick * hs_length *1e-9 / m_filament_density # half-sarcomere volume (in m³)
     
     vol = vol * 1e3 # volume in liter
 
     density = 1.055 # density in g/ml (PMC6461811)
-    
 
     ATP_cons = no_of_ATP / N_A # get mol
     
@@ -182,7 +243,7 @@ def calculate_ATPase_rate(model_file, dump_folder):
 
     ATP_cons = ATP_cons * 1e-6 # get mol/s/mg
                 
-    return ATP_per_head, ATP_cons
+    return ATP_cons
     
 def get_m_kinetics(model_json_file):
     
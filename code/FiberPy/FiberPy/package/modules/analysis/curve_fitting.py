@@ -11,32 +11,167 @@ from numpy.polynomial import Polynomial as poly
     
 from scipy.optimize import curve_fit
 from scipy.optimize import minimize_scalar
-from sklearn.metrics import r2_score
+from scipy.special import expit
 
 import matplotlib.pyplot as plt
 
 
+def r2_score(y, y_fit):
+    """ Returns the coefficient of determination, matching
+        sklearn.metrics.r2_score, which is slow to import """
+
+    y = np.asarray(y, dtype=float)
+    ss_res = np.sum((y - np.asarray(y_fit, dtype=float))**2)
+    ss_tot = np.sum((y - np.mean(y))**2)
+
+    if (ss_tot == 0):
+        if (ss_res == 0):
+            return 1.0
+        return 0.0
+
+    return 1.0 - (ss_res / ss_tot)
+
+
+# Model functions and their Jacobians
+# The model functions work on whole arrays, and broadcast, so that the
+# parameters can also be arrays with one row per curve. The Jacobians
+# return an array with a final axis of length no_of_parameters, which is
+# the (n, p) shape expected by curve_fit
+
+def y_pCa(x_data, pCa_50, n_H, y_min, y_amp):
+    """ Hill curve as a function of pCa """
+
+    # 10^(-x n_H) / (10^(-x n_H) + 10^(-pCa_50 n_H)) written as a
+    # logistic function, which does not overflow
+    x_data = np.asarray(x_data, dtype=float)
+    f = expit(-np.log(10) * n_H * (x_data - pCa_50))
+    return y_min + y_amp * f
+
+def jac_pCa(x_data, pCa_50, n_H, y_min, y_amp):
+    """ Jacobian of y_pCa """
+
+    x_data = np.asarray(x_data, dtype=float)
+    f = expit(-np.log(10) * n_H * (x_data - pCa_50))
+    g = y_amp * np.log(10) * f * (1 - f)
+    return np.stack(np.broadcast_arrays(g * n_H,
+                                        -g * (x_data - pCa_50),
+                                        np.ones_like(f),
+                                        f), axis=-1)
+
+def _hill_fraction(x_data, IC_50, n_H):
+    """ Returns x^n_H / (x^n_H + IC_50^n_H) and the derivatives of that
+        fraction with respect to IC_50 and n_H """
+
+    x_data = np.asarray(x_data, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_ratio = np.log(x_data) - np.log(IC_50)
+        f = expit(n_H * log_ratio)
+        g = f * (1 - f)
+        # g is zero where x is zero, and the derivative is zero there too
+        d_IC_50 = np.where(g > 0, -g * n_H / IC_50, 0)
+        d_n_H = np.where(g > 0, g * log_ratio, 0)
+    return (f, d_IC_50, d_n_H)
+
+def y_drug_pos(x_data, IC_50, n_H, y_min, y_amp):
+    """ Increasing Hill curve """
+    (f, d_IC_50, d_n_H) = _hill_fraction(x_data, IC_50, n_H)
+    return y_min + y_amp * f
+
+def jac_drug_pos(x_data, IC_50, n_H, y_min, y_amp):
+    """ Jacobian of y_drug_pos """
+    (f, d_IC_50, d_n_H) = _hill_fraction(x_data, IC_50, n_H)
+    return np.stack(np.broadcast_arrays(y_amp * d_IC_50,
+                                        y_amp * d_n_H,
+                                        np.ones_like(f),
+                                        f), axis=-1)
+
+def y_drug_neg(x_data, IC_50, n_H, y_min, y_amp):
+    """ Decreasing Hill curve """
+    (f, d_IC_50, d_n_H) = _hill_fraction(x_data, IC_50, n_H)
+    return (y_amp + y_min) - y_amp * f
+
+def jac_drug_neg(x_data, IC_50, n_H, y_min, y_amp):
+    """ Jacobian of y_drug_neg """
+    (f, d_IC_50, d_n_H) = _hill_fraction(x_data, IC_50, n_H)
+    return np.stack(np.broadcast_arrays(-y_amp * d_IC_50,
+                                        -y_amp * d_n_H,
+                                        np.ones_like(f),
+                                        1 - f), axis=-1)
+
+def y_hyperbola(x_data, x_0, a, b):
+    """ Hyperbola of form (x+a)(y+b) = b*(x_0+a) """
+    x_data = np.asarray(x_data, dtype=float)
+    return ((x_0 + a) * b) / (x_data + a) - b
+
+def jac_hyperbola(x_data, x_0, a, b):
+    """ Jacobian of y_hyperbola """
+    x_data = np.asarray(x_data, dtype=float)
+    return np.stack(np.broadcast_arrays(b / (x_data + a),
+                                        b * (x_data - x_0) / ((x_data + a)**2),
+                                        ((x_0 + a) / (x_data + a)) - 1),
+                    axis=-1)
+
+def y_power(x_data, x_0, a, b):
+    """ Power curve of form y = x*b*(((x_0+a)/(x+a))-1) """
+    x_data = np.asarray(x_data, dtype=float)
+    return x_data * b * (((x_0 + a) / (x_data + a)) - 1)
+
+def jac_power(x_data, x_0, a, b):
+    """ Jacobian of y_power """
+    x_data = np.asarray(x_data, dtype=float)
+    return x_data[..., np.newaxis] * jac_hyperbola(x_data, x_0, a, b)
+
+def y_exp_recovery(x_data, offset, amp, k):
+    """ Exponential recovery of form y = offset + amp*(1 - exp(-k*x)) """
+    x_data = np.asarray(x_data, dtype=float)
+    return offset + amp * (1 - np.exp(-k * x_data))
+
+def jac_exp_recovery(x_data, offset, amp, k):
+    """ Jacobian of y_exp_recovery """
+    x_data = np.asarray(x_data, dtype=float)
+    e = np.exp(-k * x_data)
+    return np.stack(np.broadcast_arrays(np.ones_like(e),
+                                        1 - e,
+                                        amp * x_data * e), axis=-1)
+
+def y_shortening(x_data, a, b, c):
+    """ Shortening trace of form y = a + b*exp(-c*x) """
+    x_data = np.asarray(x_data, dtype=float)
+    return a + (b * np.exp(-c * x_data))
+
+def jac_shortening(x_data, a, b, c):
+    """ Jacobian of y_shortening """
+    x_data = np.asarray(x_data, dtype=float)
+    e = np.exp(-c * x_data)
+    return np.stack(np.broadcast_arrays(np.ones_like(e),
+                                        e,
+                                        -b * x_data * e), axis=-1)
+
+def y_exp_decay(x_data, offset, amp, k):
+    """ Exponential of form y = offset + |amp|*(1 - exp(-|k|*x)) """
+    x_data = np.asarray(x_data, dtype=float)
+    return offset + np.abs(amp) * (1 - np.exp(-np.abs(k) * x_data))
+
+def jac_exp_decay(x_data, offset, amp, k):
+    """ Jacobian of y_exp_decay """
+    x_data = np.asarray(x_data, dtype=float)
+    e = np.exp(-np.abs(k) * x_data)
+    return np.stack(np.broadcast_arrays(np.ones_like(e),
+                                        np.sign(amp) * (1 - e),
+                                        np.abs(amp) * np.sign(k) * x_data * e),
+                    axis=-1)
+
+
 def fit_pCa_data(x, y, no_of_fit_points = 1000):
     """ Fits Hill-curve to x-y data """
 
-    def y_pCa(x_data, pCa_50, n_H, y_min, y_amp):
-        
-        y = np.zeros(len(x_data))
-        for i,x in enumerate(x_data):
-           
-            x = float(x)
-            y[i] = y_min + \
-                y_amp * (np.power(np.power(10, -x), n_H) /
-                (np.power(np.power(10, -x), n_H) + 
-                     np.power(np.power(10, -pCa_50), n_H)))
-        return y
-
     try:
         min_bounds = [4.0, 0.01, -np.inf, 0]
         max_bounds = [8.0, 100.0, np.inf, np.inf]
         popt, pcov = curve_fit(y_pCa, x, y,
                                [6.0, 2, np.amax([0, np.amin(y)]), np.amax([0, np.amax(y)])],
-                               bounds=(min_bounds, max_bounds))
+                               bounds=(min_bounds, max_bounds),
+                               jac=jac_pCa)
     except:
         print('fit_pCa_data failed')
         popt = [6.0, 10.0, 0, 1e5]
@@ -55,32 +190,16 @@ def fit_pCa_data(x, y, no_of_fit_points = 1000):
 def fit_IC_50(x,y, type_curve = "increasing"):
     """ Fits increasing or decreasing Hill-curve to x-y data for drug-response"""
 
-    def y_drug_pos(x_data, IC_50, n_H, y_min, y_amp): # increasing Hill curve
-        y = np.zeros(len(x_data))
-        for i,x in enumerate(x_data):
-            y[i] = y_min + \
-                y_amp * (np.power(x, n_H) /
-                (np.power(x, n_H) + 
-                     np.power(IC_50, n_H)))
-        return y
-
-    def y_drug_neg(x_data, IC_50, n_H, y_min, y_amp): # decreasing Hill curve
-        y = np.zeros(len(x_data))
-        for i,x in enumerate(x_data):
-            y[i] = (y_amp + y_min) - \
-                y_amp * (np.power(x, n_H) /
-                (np.power(x, n_H) + 
-                     np.power(IC_50, n_H)))
-        return y
-
     try:
         
         if type_curve == "increasing":
             popt, pcov = curve_fit(y_drug_pos, x, y,
-                    [0.5, 1.5, np.amax([0, np.amin(y)]), np.amax([0, np.amax(y)])])
+                    [0.5, 1.5, np.amax([0, np.amin(y)]), np.amax([0, np.amax(y)])],
+                    jac=jac_drug_pos)
         elif type_curve == "decreasing":
             popt, pcov = curve_fit(y_drug_neg, x, y,
-                    [0.5, 1.5, np.amax([0, np.amin(y)]), np.amax([0, np.amax(y)])])            
+                    [0.5, 1.5, np.amax([0, np.amin(y)]), np.amax([0, np.amax(y)])],
+                    jac=jac_drug_neg)
     except:
         print('fit_IC_50 failed')
         popt = [0.5, 1.5, np.amax([0, np.amin(y)]), np.amax([0, np.amax(y)])]                               
@@ -101,15 +220,10 @@ def fit_IC_50(x,y, type_curve = "increasing"):
 def fit_hyperbola(x, y):
     """ Fits hyperbola of form (x+a)(y+b) = b*(x_0+a) to y data """
     
-    def y_hyperbola(x_data, x_0, a, b):
-        y = np.zeros(len(x_data))
-        for i,x in enumerate(x_data):
-            y[i] = ((x_0+a)*b)/(x+a) - b
-        return y
-    
     try:
         popt, pcov = curve_fit(y_hyperbola, x, y,
-                           [np.amax(x), 0.2*np.amax(x), 0.3])
+                           [np.amax(x), 0.2*np.amax(x), 0.3],
+                           jac=jac_hyperbola)
 
     except:
 
@@ -129,19 +243,14 @@ def fit_hyperbola(x, y):
 def fit_power_curve(x, y):
     """ Fits power curve of form y = x*b*(((x_0+a)/(x+a))-1) to y data """
     
-    def y_power(x_data, x_0, a, b):
-        y = np.zeros(len(x_data))
-        for i,x in enumerate(x_data):
-            y[i] = x*b*(((x_0+a)/(x+a))-1)
-        return y
-    
     def neg_y_power(x, x_0, a, b):
         y = -y_power(np.asarray([x]), x_0, a, b)
         return y
     
     try:
         popt, pcov = curve_fit(y_power, x, y,
-                           [np.amax(x), 0.2*np.amax(x), np.amax(y) / 0.1 * np.amax(x)])
+                           [np.amax(x), 0.2*np.amax(x), np.amax(y) / 0.1 * np.amax(x)],
+                           jac=jac_power)
     except:
         print('fit_power_curve failed')
         popt = [np.amax(x), 0.2*np.amax(x), 0.1]
@@ -223,20 +332,15 @@ def fit_exponential_recovery(x, y, n=1):
     """ Fits exponential recovery with a single exponential of form y = offset + amp*(1 - exp(-k*x)) to y data """
     
     if n==1:
-        def y_single_exp(x_data, offset, amp, k):
-            y = np.zeros(len(x_data))
-            for i,x in enumerate(x_data):
-                y[i] = offset + amp*(1 - np.exp(-k*x))
-            return y
-
         min_bounds = [-np.inf, -np.inf, 0.0]
         max_bounds = [np.inf, np.inf, np.inf]
         
         
         try:
-            popt, pcov = curve_fit(y_single_exp, x, y,
+            popt, pcov = curve_fit(y_exp_recovery, x, y,
                                [y[0], y[-1]-y[0], (1/(0.2*np.amax(x)))],
                                bounds=(min_bounds, max_bounds),
+                               jac=jac_exp_recovery,
                                maxfev=5000)
         except:
             print('fit exponential decay failed - setting decay rate to bad values')
@@ -248,7 +352,7 @@ def fit_exponential_recovery(x, y, n=1):
         d['amp'] = popt[1]
         d['k'] = popt[2]
         d['x_fit'] = x
-        d['y_fit'] = y_single_exp(d['x_fit'], *popt)
+        d['y_fit'] = y_exp_recovery(d['x_fit'], *popt)
         d['r_squared'] = r2_score(y, d['y_fit'])
         
         return d
@@ -256,18 +360,13 @@ def fit_exponential_recovery(x, y, n=1):
 def fit_shortening_length_trace(x, y):
     """ Fits shortening length trace """
     
-    def y_function(x, a, b, c):
-        y_data = np.zeros(len(x))
-        for i, x_point in enumerate(x):
-            y_data[i] = a + (b * np.exp(-c*x_point))
-        return y_data
-            
     s = [1000, 100, 10]
     min_bounds = [0, 0, 0]
     max_bounds = [np.inf, np.inf, 100]
     
-    popt, pcov = curve_fit(y_function, x, y, s,
+    popt, pcov = curve_fit(y_shortening, x, y, s,
                            bounds = (min_bounds, max_bounds),
+                           jac=jac_shortening,
                            max_nfev=5000)
     
     d = dict()
@@ -275,7 +374,7 @@ def fit_shortening_length_trace(x, y):
     d['b'] = popt[1]
     d['c'] = popt[2]
     d['x_fit'] = x
-    d['y_fit'] = y_function(x, *popt)
+    d['y_fit'] = y_shortening(x, *popt)
     d['r_squared'] = r2_score(y, d['y_fit'])
     
     print('popt: %g  %g  %g' % (d['a'], d['b'], d['c']))
@@ -288,45 +387,223 @@ def fit_shortening_length_trace(x, y):
 def fit_exponential_decay(x, y):
     """ Fits exponential decay with a single exponential of form y = offset + amp*exp(-k*x) to y data """    
 
-    def y_single_exp(x_data, offset, amp, k):
-        print('%g   %g   %g' % (offset, amp, k))
-        y_data = offset + np.abs(amp) * (1 - np.exp(-np.abs(k) * x_data))
-        return y_data
-
-    min_bounds = [-np.inf, 0, 0.0]
-    max_bounds = [np.inf, np.inf, np.inf]
-    
-    st = [y[-1], y[0] - y[-1], 1.0 / (x[-1] - x[0])]
     st = [1000, 100, 10]
-    print(st)
     
     min_bounds = [0, 0, 0]
     max_bounds = [10000, 10000, 10000]
     
     try:
-        print('hello')
-        
-        popt, pcov, a, b, c = curve_fit(y_single_exp, x, y, st,
-                                        bounds=(min_bounds, max_bounds),
-                                        full_output=True)
-        
-        print('popt')
-        print(popt)
+        popt, pcov = curve_fit(y_exp_decay, x, y, st,
+                               bounds=(min_bounds, max_bounds),
+                               jac=jac_exp_decay)
         
     except:
         print('fit exponential decay failed - setting decay rate to NaN')
         popt = [y[-1], y[0]-y[-1], np.nan]
-        exit(1)
 
     d = dict()
     d['offset'] = popt[0]
     d['amp'] = popt[1]
     d['k'] = popt[2]
     d['x_fit'] = x
-    d['y_fit'] = y_single_exp(d['x_fit'], *popt)
+    d['y_fit'] = y_exp_decay(d['x_fit'], *popt)
         
     return d
 
+def fit_curves_batch(y_function, jac_function, x, y, p0,
+                     min_bounds=None, max_bounds=None,
+                     max_iterations=500, tolerance=1e-8):
+    """ Fits the same model to many curves at once
+
+    The fits use a Levenberg-Marquardt scheme that updates every curve
+    in the same NumPy operations, rather than calling curve_fit once for
+    each curve.
+
+    Parameters
+    ----------
+    y_function, jac_function : functions
+        Model and Jacobian, for example y_exp_recovery and
+        jac_exp_recovery. Both must broadcast over parameter arrays
+    x, y : list of arrays, or 2D arrays
+        Data for each curve. Curves can have different lengths
+    p0 : array
+        Starting parameters with shape (no_of_curves, no_of_parameters)
+    min_bounds, max_bounds : lists, optional
+        Bounds for each parameter
+
+    Returns
+    -------
+    dict with
+        popt: array of parameters, one row per curve
+        converged: array of booleans
+        y_fit: list of fitted arrays, one per curve
+        r_squared: array
+    """
+
+    # Pack the curves into padded arrays, with a mask for real points
+    no_of_curves = len(y)
+    lengths = np.asarray([len(yi) for yi in y])
+    no_of_points = np.amax(lengths) if (no_of_curves > 0) else 0
+    x_pad = np.zeros((no_of_curves, no_of_points))
+    y_pad = np.zeros((no_of_curves, no_of_points))
+    mask = np.zeros((no_of_curves, no_of_points), dtype=bool)
+    for i in range(no_of_curves):
+        x_pad[i, :lengths[i]] = x[i]
+        y_pad[i, :lengths[i]] = y[i]
+        mask[i, :lengths[i]] = np.isfinite(y[i])
+    y_pad[~mask] = 0
+
+    p = np.array(p0, dtype=float, ndmin=2)
+    no_of_parameters = p.shape[1]
+    if (min_bounds is None):
+        min_bounds = -np.inf * np.ones(no_of_parameters)
+    if (max_bounds is None):
+        max_bounds = np.inf * np.ones(no_of_parameters)
+    min_bounds = np.asarray(min_bounds, dtype=float)
+    max_bounds = np.asarray(max_bounds, dtype=float)
+    p = np.clip(p, min_bounds, max_bounds)
+
+    def return_residuals(p, rows):
+        with np.errstate(all='ignore'):
+            r = y_function(x_pad[rows],
+                           *[p[:, [j]] for j in range(no_of_parameters)]) - \
+                y_pad[rows]
+        return np.where(mask[rows], r, 0)
+
+    def return_cost(r):
+        c = np.sum(r**2, axis=1)
+        return np.where(np.isfinite(c), c, np.inf)
+
+    all_rows = np.arange(no_of_curves)
+    r = return_residuals(p, all_rows)
+    cost = return_cost(r)
+    lam = 1e-3 * np.ones(no_of_curves)
+    converged = np.zeros(no_of_curves, dtype=bool)
+    active = np.isfinite(cost) & (cost > 0)
+    converged[cost == 0] = True
+
+    for iteration in range(max_iterations):
+        # Only work on the curves that are still being fitted
+        rows = np.flatnonzero(active)
+        if (len(rows) == 0):
+            break
+
+        pa = p[rows]
+        with np.errstate(all='ignore'):
+            J = jac_function(x_pad[rows],
+                             *[pa[:, [j]] for j in range(no_of_parameters)])
+        J = np.where(mask[rows][..., np.newaxis], J, 0)
+        J[~np.isfinite(J)] = 0
+
+        # Solve the damped normal equations for every curve at once
+        JTJ = np.einsum('nmp,nmq->npq', J, J)
+        g = np.einsum('nmp,nm->np', J, r[rows])
+        diag = np.diagonal(JTJ, axis1=1, axis2=2).copy()
+        diag[diag <= 0] = 1e-12
+        A = JTJ + (lam[rows, np.newaxis, np.newaxis] *
+                   (diag[:, :, np.newaxis] * np.eye(no_of_parameters)))
+        try:
+            step = -np.linalg.solve(A, g[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('npq,nq->np', np.linalg.pinv(A), g)
+
+        p_new = np.clip(pa + step, min_bounds, max_bounds)
+        r_new = return_residuals(p_new, rows)
+        cost_new = return_cost(r_new)
+
+        # Accept steps that reduce the cost
+        accept = (cost_new < cost[rows])
+        reduction = np.where(accept, cost[rows] - cost_new, 0)
+        change = np.abs(p_new - pa)
+        small_step = np.all(change <= tolerance * (np.abs(pa) + tolerance),
+                            axis=1)
+
+        ai = rows[accept]
+        p[ai] = p_new[accept]
+        r[ai] = r_new[accept]
+        cost[ai] = cost_new[accept]
+        lam[rows] = np.where(accept, lam[rows] * 0.3, lam[rows] * 10)
+
+        # A curve has converged when the cost stops falling, when the
+        # parameters stop changing, or when no step reduces the cost
+        done = (accept & (reduction <= (tolerance * cost[rows]))) | \
+            small_step | (lam[rows] > 1e12) | (cost[rows] == 0)
+        converged[rows[done]] = True
+        active[rows[done]] = False
+
+    # Fitted curves and r_squared values, calculated for all the curves
+    # at once
+    with np.errstate(all='ignore'):
+        y_fit = y_function(x_pad, *[p[:, [j]] for j in range(no_of_parameters)])
+        no_of_valid = np.sum(mask, axis=1)
+        y_mean = np.sum(y_pad, axis=1) / no_of_valid
+        ss_res = np.sum(np.where(mask, (y_pad - y_fit)**2, 0), axis=1)
+        ss_tot = np.sum(np.where(mask, (y_pad - y_mean[:, np.newaxis])**2, 0),
+                        axis=1)
+        r_squared = 1 - (ss_res / ss_tot)
+
+    d = dict()
+    d['popt'] = p
+    d['converged'] = converged
+    d['y_fit'] = [y_fit[i, :lengths[i]] for i in range(no_of_curves)]
+    d['r_squared'] = r_squared
+
+    return d
+
+def fit_exponential_recovery_batch(x, y):
+    """ Fits exponential recoveries to many curves at once. Returns a list
+        of dicts, one per curve, matching fit_exponential_recovery """
+
+    # Curves with fewer finite points than parameters cannot be fitted.
+    # They are left out of the batch and given NaN values
+    fit_indices = [i for (i, (xi, yi)) in enumerate(zip(x, y))
+                   if ((len(yi) >= 3) and (len(xi) == len(yi)) and
+                       (np.sum(np.isfinite(yi)) >= 3) and
+                       (np.amax(xi) > 0))]
+
+    p0 = [[y[i][0], y[i][-1] - y[i][0], (1/(0.2*np.amax(x[i])))]
+          for i in fit_indices]
+    min_bounds = [-np.inf, -np.inf, 0.0]
+    max_bounds = [np.inf, np.inf, np.inf]
+
+    if fit_indices:
+        res = fit_curves_batch(y_exp_recovery, jac_exp_recovery,
+                               [x[i] for i in fit_indices],
+                               [y[i] for i in fit_indices], p0,
+                               min_bounds, max_bounds)
+
+    fits = []
+    for i in range(len(y)):
+        d = dict()
+        d['x_fit'] = x[i]
+        if not (i in fit_indices):
+            print('fit exponential decay failed - too few points in curve %i' % i)
+            d['offset'] = np.nan
+            d['amp'] = np.nan
+            d['k'] = np.nan
+            d['y_fit'] = y[i]
+            d['r_squared'] = np.nan
+            fits.append(d)
+            continue
+
+        j = fit_indices.index(i)
+        if res['converged'][j]:
+            d['offset'] = res['popt'][j, 0]
+            d['amp'] = res['popt'][j, 1]
+            d['k'] = res['popt'][j, 2]
+            d['y_fit'] = res['y_fit'][j]
+            d['r_squared'] = res['r_squared'][j]
+        else:
+            print('fit exponential decay failed - setting decay rate to bad values')
+            d['offset'] = 1e5
+            d['amp'] = 1e5
+            d['k'] = 10000
+            d['y_fit'] = y_exp_recovery(x[i], d['offset'], d['amp'], d['k'])
+            d['r_squared'] = r2_score(y[i], d['y_fit'])
+        fits.append(d)
+
+    return fits
+
 def fit_straight_line(x, y):
     """ Fits a straight line to data """
 
@@ -18,6 +18,8 @@ from io import StringIO
 from natsort import natsorted
 
 from package.modules.analysis import curve_fitting as cv
+from package.modules.analysis import results_files as rf
+from package.modules.analysis import sim_catalog
 from package.modules.utilities import utilities as ut
 
 def pCa_analysis(fig_data, batch_file_string):
@@ -52,28 +54,28 @@ def pCa_analysis(fig_data, batch_file_string):
     curve_data = dict()
     curve_data['curve'] = []
 
+    # Find the results files for each curve
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
+
     while (keep_going):
-        curve_folder = os.path.join(top_data_folder,
-                                    ('%i' % curve_counter))
-
-        if os.path.isdir(curve_folder):
-            # Find the results files
-            for file in os.listdir(curve_folder):
-                if (file.endswith('.txt') and not file.startswith('rates')):
-                    data_file_string = \
-                        os.path.join(curve_folder, file)
-                    d = pd.read_csv(data_file_string, delimiter='\t')
-                    pCa_values[curve_counter-1].append(d['hs_1_pCa'].iloc[-1])
-                    y = d[fig_data['data_field']].iloc[-50:-1].mean() # take the mean force over last 50 points
-                    y_values[curve_counter-1].append(y)
-                    if (np.amax(y) > max_y):
-                        max_y = np.amax(y)
-                    
-                    # Store data for subsequent output
-                    curve_index.append(curve_counter)
-                    hs_force.append(y)
-                    hs_pCa.append(d['hs_1_pCa'].iloc[-1])
-                    hs_length.append(d['hs_1_length'].iloc[-1])
+
+        if (curve_counter in curve_files):
+            for data_file_string in curve_files[curve_counter]:
+                d = rf.load_results(data_file_string,
+                                    columns=['hs_1_pCa', 'hs_1_length',
+                                             fig_data['data_field']],
+                                    tail_rows=50)
+                pCa_values[curve_counter-1].append(d['hs_1_pCa'].iloc[-1])
+                y = d[fig_data['data_field']].iloc[-50:-1].mean() # take the mean force over last 50 points
+                y_values[curve_counter-1].append(y)
+                if (np.amax(y) > max_y):
+                    max_y = np.amax(y)
+                
+                # Store data for subsequent output
+                curve_index.append(curve_counter)
+                hs_force.append(y)
+                hs_pCa.append(d['hs_1_pCa'].iloc[-1])
+                hs_length.append(d['hs_1_length'].iloc[-1])
 
             # Add in curve
             res=cv.fit_pCa_data(pCa_values[curve_counter-1],
@@ -103,6 +105,12 @@ def pCa_analysis(fig_data, batch_file_string):
                       'hs_force': hs_force,
                       'hs_length': hs_length})
     
+    # Collect the sheets
+    sheets = dict()
+    sheets['simulation_data'] = r
+    for (i,c) in enumerate(curve_data['curve']):
+        sheets['curve_%i' % (i+1)] = c
+    
     # Save the data as an excel file if required in the batch file
     if('output_data_file_string' in fig_data):
         if (fig_data['relative_to'] == 'this_file'):
@@ -113,8 +121,7 @@ def pCa_analysis(fig_data, batch_file_string):
 
         print('Writing tension-pCa data to %s' % output_file_string)
         with pd.ExcelWriter(output_file_string, engine='openpyxl') as writer:
-            r.to_excel(writer, sheet_name = 'simulation_data', index=False)
-            for (i,c) in enumerate(curve_data['curve']):
-                c.to_excel(writer,
-                           index=False,
-                           sheet_name = 'curve_%i' % (i+1))
+            for (sheet_name, df) in sheets.items():
+                df.to_excel(writer, sheet_name = sheet_name, index=False)
+
+    return sheets
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Reads FiberCpp results files
+
+FiberCpp writes its results as tab-separated text. Parsing that text
+dominates post-processing for long protocols, so run_batch can convert each
+results file to a columnar NumPy archive (.npz) alongside the original as
+soon as the simulation finishes. load_results() reads the archive whenever
+it is present and up to date, falling back to the text file otherwise,
+and only decodes the columns that are requested.
+
+Steady-state analyses only need the last few rows of each file. Passing
+tail_rows to load_results() reads those rows from the end of the file
+without parsing the rest of it.
+"""
+
+import os
+import io
+
+import numpy as np
+import pandas as pd
+
+# Strings written by FiberCpp on some platforms for undefined values
+nan_strings = ['-nan(ind)', 'nan(ind)']
+
+binary_extension = '.npz'
+
+
+def return_binary_file_string(results_file_string):
+    """ Returns the file string for the binary copy of a results file """
+
+    return '%s%s' % (os.path.splitext(results_file_string)[0],
+                     binary_extension)
+
+
+def has_current_binary(results_file_string):
+    """ Returns True if there is a binary copy of the results file that
+        is at least as new as the text file """
+
+    binary_file_string = return_binary_file_string(results_file_string)
+    if not os.path.isfile(binary_file_string):
+        return False
+    if not os.path.isfile(results_file_string):
+        return True
+
+    return (os.path.getmtime(binary_file_string) >=
+            os.path.getmtime(results_file_string))
+
+
+def load_results(results_file_string, columns=None, tail_rows=None):
+    """ Returns the contents of a results file as a DataFrame
+
+    Parameters
+    ----------
+    results_file_string : string
+        Path to a results file. This can be the .txt file written by
+        FiberCpp, or its .npz copy
+    columns : list, optional
+        Columns to read. All columns are read if this is None
+    tail_rows : int, optional
+        If set, only the last tail_rows rows are read
+
+    Returns
+    -------
+    DataFrame
+    """
+
+    if results_file_string.endswith(binary_extension):
+        binary_file_string = results_file_string
+    elif has_current_binary(results_file_string):
+        binary_file_string = return_binary_file_string(results_file_string)
+    else:
+        binary_file_string = []
+
+    if binary_file_string:
+        with np.load(binary_file_string, allow_pickle=False) as npz:
+            # The archive stores each column as a separate array so only
+            # the requested columns are read
+            column_names = npz['_columns'].tolist()
+            if (columns is None):
+                columns = column_names
+            else:
+                columns = [c for c in column_names if c in columns]
+            if (tail_rows is None):
+                d = pd.DataFrame({c: npz[c] for c in columns},
+                                 columns=columns)
+            else:
+                d = pd.DataFrame({c: npz[c][-tail_rows:] for c in columns},
+                                 columns=columns)
+        return d
+
+    if (columns is None):
+        usecols = None
+    else:
+        usecols = lambda c: c in columns
+
+    if (tail_rows is None):
+        return pd.read_csv(results_file_string, sep='\t',
+                           na_values=nan_strings, usecols=usecols)
+
+    return pd.read_csv(io.BytesIO(read_text_tail(results_file_string,
+                                                 tail_rows)),
+                       sep='\t', na_values=nan_strings, usecols=usecols)
+
+
+def read_text_tail(results_file_string, tail_rows, block_size=65536):
+    """ Returns the header line and the last tail_rows lines of a text
+        results file as bytes, reading backwards from the end of the file """
+
+    with open(results_file_string, 'rb') as f:
+        header = f.readline()
+        data_start = f.tell()
+
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+
+        # Read blocks from the end until there are enough lines. One extra
+        # line is needed because the first one may be incomplete, and one
+        # more allows for a newline at the end of the file
+        tail = b''
+        while (position > data_start) and \
+                (tail.count(b'\n') <= (tail_rows + 1)):
+            read_size = min([block_size, position - data_start])
+            position = position - read_size
+            f.seek(position)
+            tail = f.read(read_size) + tail
+
+    lines = tail.splitlines()
+    if (position > data_start):
+        lines = lines[1:]
+    lines = [l for l in lines if l.strip()]
+
+    return header + b'\n'.join(lines[-tail_rows:]) + b'\n'
+
+
+def convert_results_to_binary(results_file_string):
+    """ Writes a binary copy of a results file """
+
+    d = pd.read_csv(results_file_string, sep='\t', na_values=nan_strings)
+
+    arrays = dict()
+    for c in d.columns:
+        y = d[c].to_numpy()
+        if (y.dtype == object):
+            y = y.astype(str)
+        arrays[c] = y
+    arrays['_columns'] = np.asarray(d.columns, dtype=str)
+
+    # Write to a temporary file and rename it, so that readers never
+    # see a partial archive
+    binary_file_string = return_binary_file_string(results_file_string)
+    temp_file_string = '%s.tmp%s' % (binary_file_string, binary_extension)
+    np.savez(temp_file_string, **arrays)
+    os.replace(temp_file_string, binary_file_string)
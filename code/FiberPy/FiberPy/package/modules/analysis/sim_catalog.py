@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of the simulations in a sim_output folder
+
+characterize_model writes a SQLite file, sim_catalog.sqlite, to each
+sim_output folder with one row for each job. The row holds the curve,
+which is the number of the folder the results are written to, the
+conditions for the job and the path of the results file relative to the
+sim_output folder. The analyses select the results files they need from
+the catalog with one query, rather than walking the numbered folders and
+listing each of them. Folders without a catalog, for example from batches
+written by hand, are still walked.
+
+The catalog is written before the batch runs, so it lists every job that
+was planned. FiberCpp only writes the results file when a job finishes,
+so jobs that failed are left out, as they were by the walk, unless all
+the planned jobs are asked for.
+"""
+
+import os
+import sqlite3
+
+import pandas as pd
+
+from . import results_files as rf
+
+
+catalog_file_name = 'sim_catalog.sqlite'
+
+# Columns in the catalog, in addition to results_file. Conditions that
+# do not apply to a job are left as NULL
+catalog_columns = [('curve', 'INTEGER'),
+                   ('model', 'INTEGER'),
+                   ('hs_length', 'REAL'),
+                   ('length_step', 'REAL'),
+                   ('m_isotype_profile', 'TEXT'),
+                   ('pCa', 'REAL'),
+                   ('rel_isotonic_force', 'REAL'),
+                   ('protocol', 'INTEGER'),
+                   ('afterload', 'INTEGER'),
+                   ('rep', 'INTEGER')]
+
+
+def return_catalog_file_string(results_folder):
+    """ Returns the file string for the catalog in a sim_output folder """
+
+    return os.path.join(results_folder, catalog_file_name)
+
+def write_catalog(results_folder, rows):
+    """ Writes the catalog for a sim_output folder from a list of dicts,
+        one for each job, replacing any existing catalog """
+
+    if not os.path.isdir(results_folder):
+        os.makedirs(results_folder)
+
+    catalog_file_string = return_catalog_file_string(results_folder)
+    temp_file_string = '%s.tmp' % catalog_file_string
+    if os.path.isfile(temp_file_string):
+        os.remove(temp_file_string)
+
+    column_names = [c[0] for c in catalog_columns] + ['results_file']
+    values = []
+    for r in rows:
+        v = [r[c] if (c in r) else None for c in column_names[0:-1]]
+        v.append(os.path.relpath(r['results_file'], results_folder))
+        values.append(v)
+
+    # Write to a new file and then replace the old one, so that the
+    # analyses never see a partly written catalog
+    con = sqlite3.connect(temp_file_string)
+    try:
+        con.execute('CREATE TABLE jobs (%s, results_file TEXT)' %
+                    ', '.join(['%s %s' % c for c in catalog_columns]))
+        con.executemany('INSERT INTO jobs VALUES (%s)' %
+                        ', '.join(['?'] * len(column_names)), values)
+        con.execute('CREATE INDEX jobs_curve ON jobs (curve)')
+        con.commit()
+    finally:
+        con.close()
+
+    os.replace(temp_file_string, catalog_file_string)
+
+def return_catalog(results_folder, where=None, parameters=(),
+                   completed_only=True):
+    """ Returns the jobs in the catalog for a sim_output folder as a
+        DataFrame, selected by an optional SQL where clause, with the
+        results files as absolute paths. If completed_only is True, jobs
+        without a results file, as text or in the binary format, are
+        dropped. Returns None if there is no catalog """
+
+    catalog_file_string = return_catalog_file_string(results_folder)
+    if not os.path.isfile(catalog_file_string):
+        return None
+
+    query = 'SELECT * FROM jobs'
+    if where:
+        query = '%s WHERE %s' % (query, where)
+    query = '%s ORDER BY rowid' % query
+
+    con = sqlite3.connect(catalog_file_string)
+    try:
+        d = pd.read_sql_query(query, con, params=parameters)
+    finally:
+        con.close()
+
+    d['results_file'] = [os.path.join(results_folder, f)
+                         for f in d['results_file']]
+
+    if completed_only:
+        completed = [(os.path.isfile(f) or
+                      os.path.isfile(rf.return_binary_file_string(f)))
+                     for f in d['results_file']]
+        d = d[completed].reset_index(drop=True)
+
+    return d
+
+def return_curve_files(results_folder):
+    """ Returns a dict, keyed by curve number, with a list of the results
+        files for each curve. The files are taken from the catalog if
+        there is one, or found by walking the numbered folders if not """
+
+    curve_files = dict()
+
+    d = return_catalog(results_folder, completed_only=False)
+    if (d is not None):
+        # Keep curves whose jobs all failed, as the walk did, so that the
+        # analyses still count them
+        for (curve, f) in zip(d['curve'], d['results_file']):
+            files = curve_files.setdefault(int(curve), [])
+            if (os.path.isfile(f) or
+                    os.path.isfile(rf.return_binary_file_string(f))):
+                files.append(f)
+        return curve_files
+
+    curve_counter = 1
+    keep_going = True
+    while (keep_going):
+        curve_folder = os.path.join(results_folder, ('%i' % curve_counter))
+        if os.path.isdir(curve_folder):
+            curve_files[curve_counter] = \
+                [os.path.join(curve_folder, file)
+                 for file in sorted(os.listdir(curve_folder))
+                 if (file.endswith('.txt') and not file.startswith('rates'))]
+            curve_counter = curve_counter + 1
+        else:
+            keep_going = False
+
+    return curve_files
@@ -16,6 +16,8 @@ import natsort
 
 from pathlib import Path
 
+from . import results_files as rf
+
 def fit_pCa_data(x,y):
     """ Fits Hill-curve to x-y data """
     
@@ -80,13 +82,19 @@ def collate_sim_data(sim_output_directory,
     for i in range(no_of_c_states):
         sim_data['c_pop_%i' % i] = []        
 
+    # Only the final populations are needed
+    pop_columns = ['pCa'] + \
+        ['a_pop_%i' % i for i in range(no_of_a_states)] + \
+        ['m_pop_%i' % i for i in range(no_of_m_states)] + \
+        ['c_pop_%i' % i for i in range(no_of_c_states)]
+
     # Loop through the curve folders, finding results files
     for (ci, cf) in enumerate(curve_folders):
         for file in os.listdir(cf):
             if (file.endswith('.txt')):
                 dfs = os.path.join(cf, file)
                 print(dfs)
-                d = pd.read_csv(dfs, sep='\t')
+                d = rf.load_results(dfs, columns=pop_columns, tail_rows=1)
                 
                 sim_data['curve'].append((ci+1))
                 sim_data['pCa'].append(d['pCa'].iloc[-1])
@@ -7,28 +7,36 @@ Created on Wed Feb 12 13:23:48 2020
 
 import os
 import json
+import time
 import multiprocessing
-import threading
 import subprocess
 
-from pathlib import Path
-
-from ..output_handler import output_handler as oh
+import concurrent.futures
 
-from ..display import analyses
+from pathlib import Path
 
-from ..analysis import pCa_analysis as pCa_anal
+from . import job_server
+from . import sim_cache
+from . import job_manifest
+from . import post_processing
 
-from ..validation import validation
+from ..output_handler import output_handler as oh
 
 from ..analysis import atp_cons
+from ..analysis import results_files
 
 
 def run_batch(json_batch_file_string=[],
               batch_structure=[],
               figures_only = False,
-              figures_off = False):
-    """Runs >=1 simulation using multithreading"""
+              figures_off = False,
+              resume = False,
+              analysis_results = None):
+    """Runs >=1 simulation using multithreading
+       If resume is True, jobs that completed in an earlier run with the
+       same inputs are skipped
+       If analysis_results is a dict, the data from the analyses that
+       write data files are added to it"""
 
     print('FiberPy: run_batch() starting')
 
@@ -57,9 +65,11 @@ def run_batch(json_batch_file_string=[],
     job_data = batch_structure['job']
     command_strings = []
     results_file_strings = []
+    job_file_strings = []
     for i, j in enumerate(job_data):
         # Build up command string
         com_string = exe_string
+        job_files = dict()
         for f in ['model_file', 'options_file',
                   'protocol_file', 'results_file']:
             fs = j[f]
@@ -76,9 +86,12 @@ def run_batch(json_batch_file_string=[],
             if (f == 'results_file'):
                 results_file_strings.append(fs)
 
+            job_files[f] = fs
+
             com_string = '%s "%s"' % (com_string, fs)
 
         command_strings.append(com_string)
+        job_file_strings.append(job_files)
     
     # Check the batch to see if max threads have been specified
     if ('max_threads' in batch_structure):
@@ -86,28 +99,100 @@ def run_batch(json_batch_file_string=[],
     else:
         requested_max_threads = float("inf")
         
-    # Get max threads available
-    available_threads = multiprocessing.cpu_count()-1
+    # Get max threads available. The scheduler blocks while it waits
+    # for jobs to finish, so every core can be used for simulations
+    available_threads = multiprocessing.cpu_count()
 
     # Set processes to mininmum of requested and available
     num_processes = int(min([requested_max_threads, available_threads]))
+    num_processes = max([num_processes, 1])
     print('Running batch using %i threads' % num_processes)
 
+    # Create a list to hold the exit code and wall time for each job
+    job_results = []
+
     if (not figures_only):
+        # Get the machine-wide job tokens so that nested batches do not
+        # run more FiberCpp processes than there are cores. max_threads
+        # only sets the width of this batch, not the size of the pool
+        job_tokens = job_server.return_job_tokens()
+
+        # Restore jobs from the simulation cache if it is switched on
+        job_results = [None] * len(command_strings)
+        job_keys = [None] * len(command_strings)
+        if ('sim_cache' in batch_structure):
+            cache_struct = sim_cache.resolve_cache_struct(
+                batch_structure['sim_cache'], json_batch_file_string)
+            run_indices = restore_cached_jobs(cache_struct, exe_string,
+                                              command_strings,
+                                              job_file_strings,
+                                              job_keys, job_results)
+        else:
+            run_indices = list(range(len(command_strings)))
+
+        # Build a list of actions to run as soon as each job finishes
+        completion_actions = []
+
+        # If we are resuming, skip jobs that have already finished
+        if (resume and json_batch_file_string):
+            manifest = job_manifest.job_manifest(
+                job_manifest.return_manifest_file_string(
+                    json_batch_file_string))
+            run_indices = skip_completed_jobs(manifest, exe_string,
+                                              run_indices,
+                                              command_strings,
+                                              job_file_strings,
+                                              job_results)
+
+            # Record each job as soon as it finishes
+            input_hashes = dict()
+            for i in run_indices:
+                input_hashes[i] = job_manifest.return_input_hash(
+                    job_file_strings[i], exe_string)
+
+            def mark_complete(i, jr):
+                manifest.mark_complete(job_file_strings[i],
+                                       input_hashes[i], jr)
+
+            completion_actions.append(mark_complete)
+
+        # Convert results to the binary format while other jobs run
+        if ('results_format' in batch_structure) and \
+                (batch_structure['results_format'] == 'npz'):
+
+            def convert_results(i, jr):
+                if (jr['exit_code'] == 0):
+                    try:
+                        results_files.convert_results_to_binary(
+                            job_file_strings[i]['results_file'])
+                    except Exception as e:
+                        print('Could not convert %s: %s' %
+                              (job_file_strings[i]['results_file'], e))
+
+            completion_actions.append(convert_results)
+
+        def on_complete(run_index, jr):
+            for action in completion_actions:
+                action(run_indices[run_index], jr)
+
         # Now run the batch
-        my_list = command_strings
-    
-        threads = []
-        while threads or my_list:
-            if (len(threads) < num_processes) and my_list:
-                t = threading.Thread(target=worker, args=[my_list.pop()])
-                t.daemon = True
-                t.start()
-                threads.append(t)
-            else:
-                for thread in threads:
-                    if not thread.is_alive():
-                        threads.remove(thread)  
+        run_results = run_commands(
+            [command_strings[i] for i in run_indices],
+            num_processes,
+            job_tokens = job_tokens,
+            on_complete = on_complete)
+
+        for (i, jr) in zip(run_indices, run_results):
+            job_results[i] = jr
+
+        # Add the new results to the cache
+        if ('sim_cache' in batch_structure):
+            for i in run_indices:
+                if (job_keys[i] is not None) and \
+                        (job_results[i]['exit_code'] == 0):
+                    sim_cache.store_job(cache_struct, job_keys[i],
+                                        job_file_strings[i])
+            sim_cache.enforce_size_limit(cache_struct)
 
     # At this point we have run all the simulations
     # Run the output handlers
@@ -125,92 +210,158 @@ def run_batch(json_batch_file_string=[],
             oh.output_handler(fs,
                               sim_results_file_string=results_file_strings[i])
             
-    # Run analyses
-    if (figures_off == True):
-        # See if we have to run any analyses
-        if ('batch_figures' in batch_structure):
-            batch_figures = batch_structure['batch_figures']
-            
-            # Dive into the structure
-            if ('pCa_curves' in batch_figures):
-                print('Now running force-pCa_analysis without making figures')
-                for fig_data in batch_figures['pCa_curves']:
-                    pCa_anal.pCa_analysis(fig_data,
-                                          json_batch_file_string)
-
-    # Create figures            
-    if (figures_off == False):
-        # Now see if we have to make any figures
-        if ('batch_figures' in batch_structure):
-            batch_figures = batch_structure['batch_figures']
-    
-            # Dive into the structure
-            if ('rates' in batch_figures):
-                print('Now generating rates figure')
-                for fig_data in batch_figures['rates']:
-                    analyses.create_rates_figure(fig_data,
-                                              json_batch_file_string)
-    
-            if ('superposed_traces' in batch_figures):
-                print('Now generating superposed_traces figure')
-                for fig_data in batch_figures['superposed_traces']:
-                    analyses.create_superposed_traces_figure(
-                        fig_data,
-                        json_batch_file_string)
-    
-            if ('pCa_curves' in batch_figures):
-                print('Now generating tension-pCa curves')
-                for fig_data in batch_figures['pCa_curves']:
-                    analyses.create_y_pCa_figure(fig_data,
-                                                 json_batch_file_string)
-    
-            if ('force_velocity' in batch_figures):
-                print('Now generating force-velocity curves')
-                for fig_data in batch_figures['force_velocity']:
-                    analyses.create_fv_and_power_figure(fig_data,
-                                              json_batch_file_string)
-    
-            if ('k_tr_analysis' in batch_figures):
-                print('Now generating k_tr_analysis figure')
-                for fig_data in batch_figures['k_tr_analysis']:
-                    analyses.create_k_tr_analysis_figure(fig_data,
-                                              json_batch_file_string)
-    
-            if ('ktr' in batch_figures):
-                print('Now generating ktr curves')
-                for fig_data in batch_figures['ktr']:
-                    analyses.create_ktr_figure(fig_data,
-                                              json_batch_file_string)
-    
-            if ('superpose_ktr_plots' in batch_figures):
-                print('Now generating superpose ktr plots')
-                for fig_data in batch_figures['superpose_ktr_plots']:
-                    analyses.superpose_ktr_plots(fig_data,
-                                              json_batch_file_string)
-    
-            if ('myotrope' in batch_figures):
-                print('Now generating dose response curve')
-                for fig_data in batch_figures['myotrope']:
-                    analyses.dose_response(fig_data,
-                                              json_batch_file_string)
+    # Make the figures and run the analyses and validations, which are
+    # independent of each other
+    tasks = post_processing.return_tasks(batch_structure,
+                                         figures_off = figures_off)
+    task_results = post_processing.run_tasks(tasks,
+                                             json_batch_file_string,
+                                             max_workers = num_processes)
 
-    # Now see if we have to do a kinetics check
-    if ('batch_validation' in batch_structure):
-        for validation_data in batch_structure['batch_validation']:
-                validation.run_validation(validation_data,json_batch_file_string)
+    for (t, tr) in zip(tasks, task_results):
+        if (t['store']):
+            store_analysis_results(analysis_results, t['data'],
+                                   tr['result'])
 
     # Now see if we have to calculate ATP consumption rate
     if ('ATP_consumption' in batch_structure):
         print('Now calculating ATP consumption')
         for data in batch_structure['ATP_consumption']:
-                atp_cons.get_ATP_cons(data,json_batch_file_string)
+                atp_cons.get_ATP_cons(data,json_batch_file_string,
+                                      max_workers=num_processes)
+
+    # Stop if any of the figures, analyses or validations failed
+    failed_tasks = [tr['name'] for tr in task_results
+                    if (tr['error'] is not None)]
+    if failed_tasks:
+        raise RuntimeError('Post-processing failed for: %s' %
+                           ', '.join(failed_tasks))
 
     print('FiberPy: run_batch() closing correctly')
 
-def worker(cmd):
-    subprocess.call(cmd)
+    # Return the job results
+    return job_results
+
+def store_analysis_results(analysis_results, fig_data, sheets):
+    """ Adds the sheets returned by an analysis to analysis_results, using
+        the name of its data file as the key """
+
+    if (analysis_results is None) or (sheets is None):
+        return
+
+    if ('output_data_file_string' in fig_data) and \
+            fig_data['output_data_file_string']:
+        key = Path(fig_data['output_data_file_string']).stem
+        analysis_results[key] = sheets
+
+def restore_cached_jobs(cache_struct, exe_string, command_strings,
+                        job_file_strings, job_keys, job_results):
+    """ Restores jobs whose inputs match an entry in the simulation cache,
+        filling in job_keys and job_results, and returns the indices of
+        the jobs that still have to be run """
+
+    run_indices = []
+    for i in range(len(command_strings)):
+        t_start = time.perf_counter()
+        job_keys[i] = sim_cache.return_job_key(job_file_strings[i],
+                                               exe_string)
+        if (job_keys[i] is not None) and \
+                sim_cache.restore_job(cache_struct, job_keys[i],
+                                      job_file_strings[i]):
+            jr = dict()
+            jr['command'] = command_strings[i]
+            jr['exit_code'] = 0
+            jr['wall_time_s'] = time.perf_counter() - t_start
+            jr['cached'] = True
+            job_results[i] = jr
+        else:
+            run_indices.append(i)
+
+    print('Restored %i of %i jobs from the simulation cache' %
+          ((len(command_strings) - len(run_indices)), len(command_strings)))
+
+    return run_indices
+
+def skip_completed_jobs(manifest, exe_string, run_indices,
+                        command_strings, job_file_strings, job_results):
+    """ Fills in job_results for jobs that the manifest shows are complete
+        and returns the indices of the jobs that still have to be run """
+
+    new_run_indices = []
+    for i in run_indices:
+        input_hash = job_manifest.return_input_hash(job_file_strings[i],
+                                                    exe_string)
+        if manifest.is_complete(job_file_strings[i], input_hash):
+            jr = dict()
+            jr['command'] = command_strings[i]
+            jr['exit_code'] = 0
+            jr['wall_time_s'] = 0
+            jr['resumed'] = True
+            job_results[i] = jr
+        else:
+            new_run_indices.append(i)
+
+    print('Resuming batch: %i of %i jobs are already complete' %
+          ((len(run_indices) - len(new_run_indices)), len(run_indices)))
+
+    return new_run_indices
+
+def run_commands(command_strings, num_processes, job_tokens=None,
+                 on_complete=None):
+    """ Runs a list of command strings as separate processes, keeping
+        num_processes running at any one time, and returns a list of
+        dicts with the exit code and wall time for each job.
+        If job_tokens is provided, each process holds a token from
+        the machine-wide pool while it runs. If on_complete is provided,
+        it is called with the index and result of each job as soon as
+        the job finishes """
+
+    def run_job(index, cmd):
+        jr = worker(cmd, job_tokens = job_tokens)
+        if (on_complete is not None):
+            on_complete(index, jr)
+        return jr
+
+    # Each worker thread blocks on its process until it finishes, so
+    # the scheduler itself does not use any processor time
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = num_processes) as executor:
+        job_results = list(executor.map(run_job,
+                                        range(len(command_strings)),
+                                        command_strings))
+
+    # Report any jobs that failed
+    for jr in job_results:
+        if not (jr['exit_code'] == 0):
+            print('Job failed with exit code %i: %s' %
+                  (jr['exit_code'], jr['command']))
+
+    return job_results
+
+def worker(cmd, job_tokens=None):
+    """ Runs a single command and waits for it to finish """
+
+    # Wait for a token if the process is part of a shared pool
+    if (job_tokens is not None):
+        job_tokens.acquire()
+
+    t_start = time.perf_counter()
+
+    try:
+        p = subprocess.Popen(cmd)
+        exit_code = p.wait()
+    finally:
+        if (job_tokens is not None):
+            job_tokens.release()
+
+    job_result = dict()
+    job_result['command'] = cmd
+    job_result['exit_code'] = exit_code
+    job_result['wall_time_s'] = time.perf_counter() - t_start
+
+    return job_result
 
-def run_multiple_batch(json_multiple_batch_file_string):
+def run_multiple_batch(json_multiple_batch_file_string, resume=False):
     """Runs multiple batch_files """
 
     # Load the multiple batches structure
@@ -223,4 +374,4 @@ def run_multiple_batch(json_multiple_batch_file_string):
     # Run every batch from the batch list
 
     for batch_file in batch_list:
-        run_batch(batch_file)
+        run_batch(batch_file, resume=resume)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Job manifests that allow an interrupted batch to be resumed
+
+When run_batch is called with resume=True, a manifest is written next to
+the batch file. Each line records the results file for a job, a hash of
+its inputs, and the size of the results file once the job completed
+successfully. When the batch is run again, jobs are skipped if their
+inputs are unchanged and their results file is still in place.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from . import sim_cache
+
+
+def return_manifest_file_string(json_batch_file_string):
+    """ Returns the manifest file for a batch file """
+
+    return '%s_manifest.jsonl' % os.path.splitext(json_batch_file_string)[0]
+
+
+def return_input_hash(job_files, exe_string):
+    """ Returns a hash of the raw input files for a job """
+
+    h = hashlib.sha256()
+
+    exe_hash = sim_cache.return_exe_hash(exe_string)
+    if (exe_hash is not None):
+        h.update(exe_hash.encode())
+
+    for f in ['model_file', 'options_file', 'protocol_file']:
+        try:
+            with open(job_files[f], 'rb') as fi:
+                h.update(fi.read())
+        except OSError:
+            return None
+
+    h.update(job_files['results_file'].encode())
+
+    return h.hexdigest()
+
+
+class job_manifest():
+    """ Class for a job manifest """
+
+    def __init__(self, manifest_file_string):
+
+        self.manifest_file_string = manifest_file_string
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+        # Read any existing entries. Later lines replace earlier ones
+        if os.path.isfile(manifest_file_string):
+            with open(manifest_file_string, 'rb+') as f:
+                data = f.read()
+
+                # The last line is cut short if the batch was killed while
+                # it was being written. Remove it, so that the next entry
+                # starts on a new line
+                if data and not data.endswith(b'\n'):
+                    data = data[0:(data.rfind(b'\n') + 1)]
+                    f.seek(len(data))
+                    f.truncate()
+
+            for line in data.decode('utf-8').splitlines():
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[e['results_file']] = e
+
+    def is_complete(self, job_files, input_hash):
+        """ Returns True if the job finished with the same inputs and the
+            results file has not changed since """
+
+        if (input_hash is None):
+            return False
+
+        results_file = job_files['results_file']
+        if not (results_file in self.entries):
+            return False
+
+        e = self.entries[results_file]
+        if not (e['input_hash'] == input_hash) or not e['complete']:
+            return False
+
+        if not os.path.isfile(results_file):
+            return False
+
+        return (os.path.getsize(results_file) == e['results_size'])
+
+    def mark_complete(self, job_files, input_hash, job_result):
+        """ Appends a completion marker for a job """
+
+        if (input_hash is None) or not (job_result['exit_code'] == 0):
+            return
+
+        results_file = job_files['results_file']
+        if not os.path.isfile(results_file):
+            return
+
+        e = dict()
+        e['results_file'] = results_file
+        e['input_hash'] = input_hash
+        e['complete'] = True
+        e['results_size'] = os.path.getsize(results_file)
+        e['wall_time_s'] = job_result['wall_time_s']
+
+        with self.lock:
+            self.entries[results_file] = e
+            with open(self.manifest_file_string, 'a') as f:
+                f.write('%s\n' % json.dumps(e))
+                f.flush()
+                os.fsync(f.fileno())
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Shares a machine-wide pool of job tokens between nested FiberPy processes
+
+The first process that asks for tokens starts a small server that holds
+a semaphore and publishes its address in the environment. Processes
+launched from there (for example, python FiberPy.py characterize ...)
+inherit the environment and connect to the same server, so the total
+number of FiberCpp processes never exceeds the size of the pool.
+"""
+
+import os
+import secrets
+import threading
+import multiprocessing
+
+from multiprocessing.managers import BaseManager
+
+# Environment variables used to find the server
+address_env_string = 'FIBERSIM_JOB_SERVER'
+authkey_env_string = 'FIBERSIM_JOB_SERVER_KEY'
+max_jobs_env_string = 'FIBERSIM_MAX_JOBS'
+
+# Semaphore and server owned by this process, if it started the server
+_token_semaphore = None
+_server = None
+_lock = threading.Lock()
+
+
+class JobTokenManager(BaseManager):
+    """ Manager that serves the token semaphore """
+    pass
+
+
+def _return_token_semaphore():
+    return _token_semaphore
+
+
+JobTokenManager.register('get_tokens', callable=_return_token_semaphore)
+
+
+def return_max_jobs():
+    """ Returns the size of the token pool, which is the number of cores
+        unless it is over-ridden by the FIBERSIM_MAX_JOBS variable """
+
+    if (max_jobs_env_string in os.environ):
+        return max([int(os.environ[max_jobs_env_string]), 1])
+    else:
+        return multiprocessing.cpu_count()
+
+
+def return_job_tokens():
+    """ Returns a proxy to the machine-wide token semaphore, starting
+        the server if this is the outermost process. The pool is always
+        sized by return_max_jobs(), so that the limit for the machine
+        does not depend on which batch happens to start the server """
+
+    global _token_semaphore, _server
+
+    with _lock:
+        if not (address_env_string in os.environ):
+            # Start the server in a background thread of this process
+            max_jobs = return_max_jobs()
+
+            _token_semaphore = threading.BoundedSemaphore(max_jobs)
+
+            authkey = secrets.token_bytes(16)
+            manager = JobTokenManager(address=('127.0.0.1', 0),
+                                      authkey=authkey)
+            _server = manager.get_server()
+            t = threading.Thread(target=_server.serve_forever)
+            t.daemon = True
+            t.start()
+
+            # Publish the address so that child processes can connect
+            host, port = _server.address
+            os.environ[address_env_string] = '%s:%i' % (host, port)
+            os.environ[authkey_env_string] = authkey.hex()
+
+            print('Started job server with %i tokens at %s' %
+                  (max_jobs, os.environ[address_env_string]))
+
+    # Connect to the server
+    host, port = os.environ[address_env_string].split(':')
+    manager = JobTokenManager(
+        address=(host, int(port)),
+        authkey=bytes.fromhex(os.environ[authkey_env_string]))
+    manager.connect()
+
+    return manager.get_tokens()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Makes the figures, analyses and validations for a batch
+
+Once the simulations have finished, each entry in batch_figures and
+batch_validation is an independent task that reads the results files,
+fits curves and writes its own figure or data file. The tasks are run in
+a pool of processes, using the Agg backend, rather than one after
+another. Each worker holds a token from the machine-wide job server while
+it runs a task, so post-processing for nested batches, for example
+during fitting, does not use more cores than there are.
+
+The result and any error are collected for each task. The remaining
+tasks still run when one fails, and run_batch reports the failures once
+they have all finished.
+"""
+
+import time
+import traceback
+import concurrent.futures
+
+import matplotlib
+
+from . import job_server
+
+from ..display import analyses
+
+from ..analysis import pCa_analysis as pCa_anal
+
+from ..validation import validation
+
+
+# Token proxy for a worker process
+worker_tokens = None
+
+
+def create_k_tr_analysis_data(fig_data, batch_file_string):
+    """ Runs the k_tr analysis without making the figure """
+
+    # The analysis skips the figure if there is no image
+    data_only = dict(fig_data)
+    data_only.pop('output_image_file', None)
+
+    return analyses.create_k_tr_analysis_figure(data_only, batch_file_string)
+
+def create_fv_analysis_data(fig_data, batch_file_string):
+    """ Runs the force-velocity analysis without making the figures """
+
+    # The analysis skips the figures if there is no image
+    data_only = dict(fig_data)
+    data_only.pop('output_image_file', None)
+
+    return analyses.create_fv_and_power_figure(data_only, batch_file_string)
+
+# Tasks for each key in batch_figures, in the order they were run in
+# before. Each entry holds the key, the message, the function, and
+# whether it returns sheets for analysis_results. Every figure task that
+# returns sheets has a data-only task here, so that fitting with the
+# figures off still writes the data files and fills analysis_results
+analysis_tasks = [
+    ('pCa_curves', 'force-pCa_analysis without making figures',
+     pCa_anal.pCa_analysis, True),
+    ('force_velocity', 'force-velocity analysis without making figures',
+     create_fv_analysis_data, True),
+    ('k_tr_analysis', 'k_tr_analysis without making figures',
+     create_k_tr_analysis_data, True)]
+
+figure_tasks = [
+    ('rates', 'rates figure',
+     analyses.create_rates_figure, False),
+    ('superposed_traces', 'superposed_traces figure',
+     analyses.create_superposed_traces_figure, False),
+    ('pCa_curves', 'tension-pCa curves',
+     analyses.create_y_pCa_figure, True),
+    ('force_velocity', 'force-velocity curves',
+     analyses.create_fv_and_power_figure, True),
+    ('k_tr_analysis', 'k_tr_analysis figure',
+     analyses.create_k_tr_analysis_figure, True),
+    ('ktr', 'ktr curves',
+     analyses.create_ktr_figure, False),
+    ('superpose_ktr_plots', 'superpose ktr plots',
+     analyses.superpose_ktr_plots, False),
+    ('myotrope', 'dose response curve',
+     analyses.dose_response, False)]
+
+
+def return_tasks(batch_structure, figures_off=False):
+    """ Returns a list of dicts, one for each figure, analysis or
+        validation in the batch structure """
+
+    tasks = []
+
+    if ('batch_figures' in batch_structure):
+        batch_figures = batch_structure['batch_figures']
+
+        if (figures_off == True):
+            task_list = analysis_tasks
+        else:
+            task_list = figure_tasks
+
+        for (key, message, function, store) in task_list:
+            if (key in batch_figures):
+                for fig_data in batch_figures[key]:
+                    t = dict()
+                    t['name'] = key
+                    t['message'] = message
+                    t['function'] = function
+                    t['data'] = fig_data
+                    t['store'] = store
+                    tasks.append(t)
+
+    if ('batch_validation' in batch_structure):
+        for validation_data in batch_structure['batch_validation']:
+            t = dict()
+            t['name'] = 'validation'
+            t['message'] = 'validation'
+            t['function'] = validation.run_validation
+            t['data'] = validation_data
+            t['store'] = False
+            tasks.append(t)
+
+    return tasks
+
+def run_tasks(tasks, batch_file_string, max_workers=1):
+    """ Runs the tasks, using up to max_workers processes, and returns a
+        list of dicts, one for each task in the same order, with the
+        result or the error and the wall time """
+
+    if (len(tasks) == 0):
+        return []
+
+    max_workers = int(max([min([max_workers, len(tasks)]), 1]))
+
+    t_start = time.perf_counter()
+
+    if (max_workers == 1):
+        # Run in this process with the current backend
+        task_results = [run_task(t, batch_file_string) for t in tasks]
+    else:
+        print('Running %i post-processing tasks using %i processes' %
+              (len(tasks), max_workers))
+
+        # Start the job server, if there is not one already, so that
+        # the workers share it
+        job_server.return_job_tokens()
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=init_worker) as executor:
+            futures = [executor.submit(run_task, t, batch_file_string)
+                       for t in tasks]
+            task_results = []
+            for (t, f) in zip(tasks, futures):
+                try:
+                    task_results.append(f.result())
+                except Exception:
+                    # The worker itself failed, for example because the
+                    # task could not be sent to it
+                    task_results.append(
+                        {'name': t['name'], 'result': None,
+                         'error': traceback.format_exc(),
+                         'wall_time_s': float('nan')})
+
+    # Report any tasks that failed
+    for tr in task_results:
+        if (tr['error'] is not None):
+            print('Post-processing task %s failed:\n%s' %
+                  (tr['name'], tr['error']))
+
+    print('Post-processing took %.1f s' % (time.perf_counter() - t_start))
+
+    return task_results
+
+def init_worker():
+    """ Sets up a worker process for the tasks """
+
+    global worker_tokens
+
+    # Workers only write figures to file
+    matplotlib.use('Agg')
+
+    worker_tokens = job_server.return_job_tokens()
+
+def run_task(task, batch_file_string):
+    """ Runs a single task and returns a dict with the result or the
+        error and the wall time """
+
+    if (worker_tokens is not None):
+        worker_tokens.acquire()
+
+    t_start = time.perf_counter()
+
+    try:
+        print('Now running %s' % task['message'])
+        result = task['function'](task['data'], batch_file_string)
+        if not task['store']:
+            result = None
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+    finally:
+        if (worker_tokens is not None):
+            worker_tokens.release()
+
+    task_result = dict()
+    task_result['name'] = task['name']
+    task_result['result'] = result
+    task_result['error'] = error
+    task_result['wall_time_s'] = time.perf_counter() - t_start
+
+    return task_result
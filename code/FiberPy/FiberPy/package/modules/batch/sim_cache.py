@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache for FiberCpp simulation results
+
+Each job is keyed on a hash of its model file, options file, protocol file
+and the FiberCpp executable. When a job is repeated with identical inputs,
+the results file and the rates file are restored from the cache instead of
+running the simulation again.
+
+The cache is switched on by adding a sim_cache section to a batch or setup
+file, for example
+
+"sim_cache": {
+    "relative_to": "this_file",
+    "cache_folder": "../sim_cache",
+    "max_size_GB": 10
+}
+
+Entries are evicted, least recently used first, when the cache grows
+beyond max_size_GB.
+"""
+
+import os
+import json
+import copy
+import shutil
+import hashlib
+import threading
+import uuid
+
+from pathlib import Path
+
+# Executable hashes keyed on (path, size, modification time)
+_exe_hashes = dict()
+_exe_lock = threading.Lock()
+
+
+def resolve_cache_struct(cache_struct, file_string):
+    """ Returns a copy of a sim_cache struct with an absolute cache folder
+        so that it can be passed to files written in other places """
+
+    new_struct = copy.deepcopy(cache_struct)
+
+    base_dir = ''
+    if ('relative_to' in cache_struct):
+        if (cache_struct['relative_to'] == 'this_file'):
+            base_dir = str(Path(file_string).parent.absolute())
+        elif not (cache_struct['relative_to'] in ['False', 'false']):
+            base_dir = cache_struct['relative_to']
+
+    new_struct['cache_folder'] = str(Path(os.path.join(
+        base_dir, cache_struct['cache_folder'])).resolve())
+    new_struct['relative_to'] = 'False'
+
+    if not ('max_size_GB' in new_struct):
+        new_struct['max_size_GB'] = 10
+
+    return new_struct
+
+
+def return_exe_hash(exe_string):
+    """ Returns a hash of the FiberCpp executable, which changes whenever
+        the code is rebuilt """
+
+    exe_string = exe_string.strip('"')
+    if not os.path.isfile(exe_string):
+        return None
+
+    st = os.stat(exe_string)
+    exe_id = (exe_string, st.st_size, st.st_mtime)
+
+    with _exe_lock:
+        if not (exe_id in _exe_hashes):
+            h = hashlib.sha256()
+            with open(exe_string, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            _exe_hashes[exe_id] = h.hexdigest()
+
+        return _exe_hashes[exe_id]
+
+
+def return_rates_file_string(options_data, options_file_string):
+    """ Returns the rates file written by a job, or None """
+
+    opts = options_data['options']
+    if not ('rate_files' in opts):
+        return None
+
+    rate_file = opts['rate_files']['file']
+    if ('relative_to' in opts['rate_files']):
+        if (opts['rate_files']['relative_to'] == 'this_file'):
+            rate_file = os.path.join(
+                str(Path(options_file_string).parent.absolute()), rate_file)
+
+    return rate_file
+
+
+def return_job_key(job_files, exe_string):
+    """ Returns a hash of the inputs for a job, or None if the job
+        cannot be cached """
+
+    exe_hash = return_exe_hash(exe_string)
+    if (exe_hash is None):
+        return None
+
+    try:
+        with open(job_files['model_file'], 'r') as f:
+            model_data = json.load(f)
+        with open(job_files['options_file'], 'r') as f:
+            options_data = json.load(f)
+        with open(job_files['protocol_file'], 'rb') as f:
+            protocol_bytes = f.read()
+    except (OSError, ValueError):
+        return None
+
+    opts = copy.deepcopy(options_data['options'])
+
+    # Simulations with an unpredictable seed give different results
+    # each time, and status dumps and logs are not stored
+    if ('rand_seed' in opts) and (opts['rand_seed'] == 'random'):
+        return None
+    if ('status_files' in opts) or ('logging' in opts):
+        return None
+
+    # The location of the rates file does not change the simulation
+    if ('rate_files' in opts):
+        opts['rate_files'] = 'on'
+
+    h = hashlib.sha256()
+    h.update(exe_hash.encode())
+    h.update(json.dumps(model_data, sort_keys=True).encode())
+    h.update(json.dumps(opts, sort_keys=True).encode())
+    h.update(protocol_bytes)
+
+    return h.hexdigest()
+
+
+def restore_job(cache_struct, key, job_files):
+    """ Copies cached results to the locations expected by the job.
+        Returns True on a hit """
+
+    entry_dir = os.path.join(cache_struct['cache_folder'], key)
+    cached_results = os.path.join(entry_dir, 'results.txt')
+    if not os.path.isfile(cached_results):
+        return False
+
+    with open(job_files['options_file'], 'r') as f:
+        options_data = json.load(f)
+    rates_file = return_rates_file_string(options_data,
+                                          job_files['options_file'])
+    cached_rates = os.path.join(entry_dir, 'rates.json')
+    if (rates_file is not None) and not os.path.isfile(cached_rates):
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(job_files['results_file']),
+                    exist_ok=True)
+        shutil.copyfile(cached_results, job_files['results_file'])
+        if (rates_file is not None):
+            os.makedirs(os.path.dirname(rates_file), exist_ok=True)
+            shutil.copyfile(cached_rates, rates_file)
+
+        # Mark the entry as recently used
+        os.utime(entry_dir)
+    except OSError:
+        return False
+
+    return True
+
+
+def store_job(cache_struct, key, job_files):
+    """ Adds the results of a completed job to the cache """
+
+    if not os.path.isfile(job_files['results_file']):
+        return
+
+    with open(job_files['options_file'], 'r') as f:
+        options_data = json.load(f)
+    rates_file = return_rates_file_string(options_data,
+                                          job_files['options_file'])
+    if (rates_file is not None) and not os.path.isfile(rates_file):
+        return
+
+    entry_dir = os.path.join(cache_struct['cache_folder'], key)
+    if os.path.isdir(entry_dir):
+        return
+
+    # Write to a temporary folder and rename it so that other processes
+    # never see a partial entry
+    temp_dir = os.path.join(cache_struct['cache_folder'],
+                            'tmp_%s' % uuid.uuid4().hex)
+    try:
+        os.makedirs(temp_dir)
+        shutil.copyfile(job_files['results_file'],
+                        os.path.join(temp_dir, 'results.txt'))
+        if (rates_file is not None):
+            shutil.copyfile(rates_file, os.path.join(temp_dir, 'rates.json'))
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def enforce_size_limit(cache_struct):
+    """ Deletes the least recently used entries until the cache is
+        smaller than max_size_GB """
+
+    cache_folder = cache_struct['cache_folder']
+    if not os.path.isdir(cache_folder):
+        return
+
+    max_bytes = cache_struct['max_size_GB'] * 1e9
+
+    entries = []
+    total_bytes = 0
+    for e in os.scandir(cache_folder):
+        if not e.is_dir() or e.name.startswith('tmp_'):
+            continue
+        entry_bytes = 0
+        for f in os.scandir(e.path):
+            entry_bytes = entry_bytes + f.stat().st_size
+        entries.append((e.stat().st_mtime, entry_bytes, e.path))
+        total_bytes = total_bytes + entry_bytes
+
+    if (total_bytes <= max_bytes):
+        return
+
+    # Oldest first
+    entries.sort()
+    for (t, entry_bytes, entry_dir) in entries:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_bytes = total_bytes - entry_bytes
+        if (total_bytes <= max_bytes):
+            break
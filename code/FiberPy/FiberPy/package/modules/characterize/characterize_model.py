@@ -20,14 +20,24 @@ import pandas as pd
 from pathlib import Path
 
 from ..protocols import protocols as prot
+from ..protocols import protocol_builder as prot_builder_lib
+from .model_adjustments import return_m_isotype_ints
+from . import model_adjustments
 from ..batch import batch
+from ..batch import sim_cache
+from ..analysis import results_files as rf
+from ..analysis import sim_catalog
 
 # from .characterize_functions import characterize_fv_with_pCa_and_isometric_force
 
 
-def characterize_model(json_analysis_file_string):
+def characterize_model(json_analysis_file_string, analysis_results=None):
     """ Code takes a json struct that includes a model file, and run the
-        analyses described in the file """
+        analyses described in the file
+        
+        If analysis_results is a dict, the data from each analysis are
+        added to it as a dict of DataFrames, one for each sheet, using
+        the name of the data file without its extension as the key """
         
     print('\n\ncharacterize')
     print(json_analysis_file_string)
@@ -58,19 +68,23 @@ def characterize_model(json_analysis_file_string):
     for ch in char_struct:
         if (ch['type'] == 'pCa_length_control'):
             deduce_pCa_length_control_properties(json_analysis_file_string,
-                                                 pCa_struct = ch)
+                                                 pCa_struct = ch,
+                                                 analysis_results = analysis_results)
         if (ch['type'] == 'force_velocity'):
             deduce_fv_properties(json_analysis_file_string,
-                                 fv_struct =ch)
+                                 fv_struct =ch,
+                                 analysis_results = analysis_results)
         
         if ((ch['type'] == 'freeform') or (ch['type'] == 'twitch')):
             deduce_freeform_properties(json_analysis_file_string,
-                                       freeform_struct = ch)
+                                       freeform_struct = ch,
+                                       analysis_results = analysis_results)
         
         if (ch['type'] == 'fv_with_pCa_and_isometric_force'):
             characterize_fv_with_pCa_and_isometric_force(
                 json_analysis_file_string,
-                ch)
+                ch,
+                analysis_results = analysis_results)
             
         # Run post-Python_function
         if ('post_sim_Python_call' in ch):
@@ -174,211 +188,16 @@ def generate_model_files(json_analysis_file_string):
         no_of_models = 1
     
     generated_models = []
+    
+    # Resolve each adjustment to the value it changes, then build all the
+    # models at once
+    plan = model_adjustments.compile_adjustments(base_model, adjustments,
+                                                 no_of_models)
+    adj_models = model_adjustments.apply_adjustments(base_model, plan,
+                                                     no_of_models)
         
     # Loop through them
-    for i in range(no_of_models):
-        
-        # Copy the base model
-        adj_model = copy.deepcopy(base_model)
-               
-        for (j,a) in enumerate(adjustments):
-            
-            if ((a['variable'] == 'm_kinetics') or
-                    (a['variable'] == 'c_kinetics')):
-
-                # Special case for kinetics
-                if ('extension' in a):
-                    base_value = adj_model[a['variable']][a['isotype']-1]['state'][a['state']-1]['extension']
-                    
-                    value = base_value * a['multipliers'][i]
-                    
-                    adj_model[a['variable']][a['isotype']-1]['state'][a['state']-1]['extension'] = \
-                        value
-                        
-                elif ('relative_to' in a):
-                    # Special case where parameter is relative to another kinetics parameter
-                    # Pull out the relative to parameters
-                    
-                    digits = [int(s) for s in re.findall(r'\d+', a['relative_to'])]
-                    
-                    y = np.asarray(adj_model[a['variable']][digits[0]-1]['state'][digits[1]-1] \
-                                   ['transition'][digits[2]-1]['rate_parameters'],
-                                   dtype = np.float32)
-                        
-                    base_value = y[digits[3]-1]
-                    value = base_value * a['multipliers'][i]
-
-                    y[a['parameter_number'] - 1] = value
-                    adj_model[a['variable']][a['isotype']-1]['state'][a['state']-1] \
-                              ['transition'][a['transition']-1]['rate_parameters'] = \
-                                  y.tolist()                   
-                        
-                else:
-                    # Transition parameters
-                    y = np.asarray(adj_model[a['variable']][a['isotype']-1]['state'][a['state']-1] \
-                              ['transition'][a['transition']-1]['rate_parameters'],
-                              dtype = np.float32)
-                    
-                    base_value = y[a['parameter_number'] - 1]
-                    value = base_value * a['multipliers'][i]
-                        
-                    y[a['parameter_number']-1] = value
-                    adj_model[a['variable']][a['isotype']-1]['state'][a['state']-1] \
-                              ['transition'][a['transition']-1]['rate_parameters'] = \
-                                  y.tolist()
-                                  
-            elif ('iso_switching' in a['variable']):
-                y = np.asarray(adj_model[a['variable']]['type'][a['type']-1] \
-                               ['transition'][a['transition']-1]['rate_parameters'],
-                               dtype = np.float32)
-                    
-                base_value = y[a['parameter_number'] - 1]
-                value = base_value * a['multipliers'][i]
-                
-                y[a['parameter_number']-1] = value
-                
-                adj_model[a['variable']]['type'][a['type']-1] \
-                    ['transition'][a['transition']-1]['rate_parameters'] = \
-                        y.tolist()                           
-                    
-                                  
-            elif (a['variable'] == 'thin_kinetics'):
-                
-                base_value = adj_model[a['variable']][a['isotype']-1][a['parameter']]
-                value = base_value * a['multipliers'][i]
-                
-                adj_model[a['variable']][a['isotype']-1][a['parameter']] = \
-                    float(value)
-                
-            elif (a['variable'].endswith('isotype_proportions')):
-                
-                prefix = a['variable'][0]
-                class_string = '%s_parameters' % prefix
-                adj_model[class_string][a['variable']] = \
-                    a['proportions'][i]['isotype_proportions']
-                    
-            elif (a['variable'] == 'm_isotype_profiles'):
-
-                # Create an empty array of m_isotypes
-                m_iso_int = []
-                
-                if a['profile'][i].startswith('all'):
-                    iso_int = int(a['profile'][i][4])
-                    
-                    # Set m_isotype_ints to a constant array of iso_int
-                    for crown_counter in range(adj_model['thick_structure']['m_crowns_per_filament']):
-                        for hub_counter in range(adj_model['thick_structure']['m_hubs_per_crown']):
-                            for d_counter in range(adj_model['thick_structure']['m_myosins_per_hub']):
-                                m_iso_int.append(iso_int)
-                                
-                if a['profile'][i].startswith('dimer'):
-                    
-                    iso_int_a = int(a['profile'][i][6])
-                    iso_int_b = int(a['profile'][i][8])
-                    
-                    # Set m_isotype_ints to a constant array of iso_int
-                    for crown_counter in range(adj_model['thick_structure']['m_crowns_per_filament']):
-                        for hub_counter in range(adj_model['thick_structure']['m_hubs_per_crown']):
-                            m_iso_int.append(iso_int_a)
-                            m_iso_int.append(iso_int_b)
-                            
-                if a['profile'][i].startswith('p'):
-                    
-                    iso_p_a = int(a['profile'][i][2])
-                    iso_p_b = int(a['profile'][i][4])
-                    iso_c_a = int(a['profile'][i][8])
-                    iso_c_b = int(a['profile'][i][10])
-                    iso_c_c = int(a['profile'][i][12])
-                    iso_c_d = int(a['profile'][i][14])
-                    iso_c_e = int(a['profile'][i][16])
-                    iso_c_f = int(a['profile'][i][18])
-                    iso_d_a = int(a['profile'][i][22])
-                    iso_d_b = int(a['profile'][i][24])
-                    
-                    # Set m_isotype_ints to a constant array of iso_int
-                    for crown_counter in range(adj_model['thick_structure']['m_crowns_per_filament']):
-                        if (crown_counter < (adj_model['mybpc_structure']['c_thick_proximal_node'] - 1)):
-                            # P-zone
-                            for hub_counter in range(adj_model['thick_structure']['m_hubs_per_crown']):
-                                m_iso_int.append(iso_p_a)
-                                m_iso_int.append(iso_p_b)
-
-                        elif (crown_counter >= (adj_model['mybpc_structure']['c_thick_proximal_node'] +
-                                               ((adj_model['mybpc_structure']['c_thick_stripes']) *
-                                                    adj_model['mybpc_structure']['c_thick_node_spacing']) - 1)):
-                            # D-zone
-                            for hub_counter in range(adj_model['thick_structure']['m_hubs_per_crown']):
-                                m_iso_int.append(iso_d_a)
-                                m_iso_int.append(iso_d_b)
-                                
-                        else:
-                            # C-zone
-                            
-                            # Work out which stripe we are in
-                            stripe_index = (1 + crown_counter- 
-                                                    adj_model['mybpc_structure']['c_thick_proximal_node']) % 3
-                            
-                            if (stripe_index == 0):
-                                x = iso_c_a
-                                y = iso_c_b
-                            elif (stripe_index == 1):
-                                x = iso_c_c
-                                y = iso_c_d
-                            else:
-                                x = iso_c_e
-                                y = iso_c_f
-
-                            for hub_counter in range(adj_model['thick_structure']['m_hubs_per_crown']):
-                                m_iso_int.append(x)
-                                m_iso_int.append(y)
-
-                                
-                # Set the m_isotype_ints
-                adj_model['m_parameters']['m_isotype_ints'] = m_iso_int
-                
-                # If there was an m_isotype_proportions, delete it
-                if ('m_isotype_proportions' in adj_model['m_parameters']):
-                    del adj_model['m_parameters']['m_isotype_proportions']
-                
-                    
-            elif (a['class'] == 'half_sarcomere_variation'):
-                hsv = adj_model[a['class']]
-                for (vi, h) in enumerate(hsv):
-                    if (h['variable'] == a['variable']):
-                        y = np.asarray(adj_model[a['class']][vi]['multiplier'],
-                                       dtype=np.float32)
-                        base_value = y[a['parameter_number'] - 1]
-                        value = base_value * a['multipliers'][i]
-                        
-                        y[a['parameter_number'] - 1] = value
-                        adj_model[a['class']][vi]['multiplier'] = y.tolist()
-            
-            else:
-                if ('parameter_number' in a):
-                    # It's an array
-                    y = np.asarray(adj_model[a['class']][a['variable']],
-                                   dtype = np.float32)
-                    base_value = y[a['parameter_number'] - 1]
-                    value = base_value * a['multipliers'][i]
-                    
-                    y[a['parameter_number'] - 1] = value
-                    adj_model[a['class']][a['variable']] = y.tolist()
-                    
-                else:
-                    # Standard value
-                    base_value = adj_model[a['class']][a['variable']]
-                
-                    value = base_value * a['multipliers'][i]
-                
-                    if (a['output_type'] == 'int'):
-                        adj_model[a['class']][a['variable']] = int(value)
-                    
-                    if (a['output_type'] == 'float'):
-                        adj_model[a['class']][a['variable']] = float(value)
-                    
-                    # Check for NaN
-                    if (np.isnan(value)):
-                        adj_model[a['class']][a['variable']] = 'null'
+    for (i, adj_model) in enumerate(adj_models):
         
         # Now generate the model file string
         model_file_string = 'model_%i.json' % (i+1)
@@ -420,6 +239,14 @@ def generate_model_files(json_analysis_file_string):
                 json_data['FiberSim_setup']['characterization'][i]['post_sim_Python_call'] = \
                     str(Path(os.path.join(base_dir, ch['post_sim_Python_call'])).resolve().absolute())
     
+    # Make the sim_cache path absolute, because the new setup file
+    # is in a different place
+    if ('sim_cache' in json_data['FiberSim_setup']):
+        json_data['FiberSim_setup']['sim_cache'] = \
+            sim_cache.resolve_cache_struct(
+                json_data['FiberSim_setup']['sim_cache'],
+                json_analysis_file_string)
+
     # Delete the adjustments
     del(json_data['FiberSim_setup']['model']['manipulations'])
     
@@ -436,7 +263,8 @@ def generate_model_files(json_analysis_file_string):
             
             
 def deduce_pCa_length_control_properties(json_analysis_file_string,
-                                         pCa_struct = []):
+                                         pCa_struct = [],
+                                         analysis_results = None):
     """ Code runs pCa analysis """
     
     print('jj')
@@ -482,8 +310,11 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
         cpp_exe['exe_file'] = FiberCpp_exe_struct['exe_file']
 
     pCa_lc_b['FiberCpp_exe'] = cpp_exe
+    add_sim_cache(pCa_lc_b, char_struct, json_analysis_file_string)
+    add_results_format(pCa_lc_b, char_struct)
 
     pCa_lc_b['job'] = []
+    catalog_rows = []
     
     # Check for half-sarcomere lengths in the pCa_struct
     # If none are specified, create an hsl array from the model file
@@ -527,6 +358,12 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
     # Set up dir_counter
     dir_counter = 0
     
+    # The protocols are written together once they have all been made
+    prot_writer = prot_builder_lib.protocol_writer()
+    
+    # Deduce the pCa steps, which are the same for every protocol
+    pCa_steps = return_pCa_steps(pCa_struct)
+    
     print('ken was here')
     print(model_struct)
     
@@ -612,6 +449,11 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
                     else:
                         rand_repeats = 1
                    
+                    # Build the protocol segments, thinking about
+                    # whether we need smaller time steps for k_tr
+                    prot_builder = return_pCa_protocol_builder(pCa_struct,
+                                                               length_step)
+                   
                     # Loop through the pCa values
                     for pCa_counter,pCa in enumerate(pCa_struct['pCa_values']):
                         
@@ -647,131 +489,20 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
                             with open(options_file, 'w') as f:
                                     json.dump(rep_options_data, f, indent=4)
             
-                            # Make a protocol, thinking about whether we need smaller
-                            # time steps for k_tr
-                            if not ('k_tr_start_s' in pCa_struct):
-                                n_points = int(pCa_struct['sim_duration_s'] /
-                                               pCa_struct['time_step_s'])
-                                dt = pCa_struct['time_step_s'] * np.ones(n_points)
-                                pCa_vector = pCa * np.ones(n_points)
-                                delta_hsl = np.zeros(n_points)
-                                mode_vector = -2 * np.ones(n_points)
-                            else:
-                                # Pre-phase
-                                if not ('length_step_nm' in pCa_struct):
-                                    pre_points = int(pCa_struct['k_tr_start_s'] /
-                                                     pCa_struct['time_step_s'])
-                                    pre_dt = pCa_struct['time_step_s'] * np.ones(pre_points)
-                                    pre_pCa = pCa * np.ones(pre_points)
-                                    pre_delta_hsl = np.zeros(pre_points)
-                                    pre_mode_vector = -2 * np.ones(pre_points)
-                                else:
-                                    # Break up pre_ktr period into before length step,
-                                    # during length step and after length step
-                                    pre_1_points = int(pCa_struct['length_step_s'] /
-                                                       pCa_struct['time_step_s'])
-                                    pre_1_dt = pCa_struct['time_step_s'] * np.ones(pre_1_points)
-                                    pre_1_delta_hsl = np.zeros(pre_1_points)
-                                    pre_1_mode_vector = -2 * np.ones(pre_1_points)
-                                    
-                                    ramp_time_step = pCa_struct['time_step_s']  / 10
-                                    step_ramp_points = int(pCa_struct['length_step_ramp_s'] /
-                                                           ramp_time_step)
-                                    step_ramp_dt = ramp_time_step * np.ones(step_ramp_points)
-                                    step_ramp_inc = length_step / float(step_ramp_points)
-                                    step_ramp_delta_hsl = step_ramp_inc * np.ones(step_ramp_points)
-                                    step_ramp_mode_vector = -1 * np.ones(step_ramp_points)
-                                    
-                                    pre_2_points = int((pCa_struct['k_tr_start_s'] -
-                                                            pCa_struct['length_step_s'] -
-                                                            pCa_struct['length_step_ramp_s']) /
-                                                       pCa_struct['time_step_s'])
-                                    pre_2_dt = pCa_struct['time_step_s'] * np.ones(pre_2_points)
-                                    pre_2_delta_hsl = np.zeros(pre_2_points)
-                                    pre_2_mode_vector = -2 * np.ones(pre_2_points)
-                                    
-                                    # Assemble into pre arrays
-                                    pre_points = pre_1_points + step_ramp_points + pre_2_points
-                                    pre_dt = np.hstack((pre_1_dt,
-                                                        step_ramp_dt,
-                                                        pre_2_dt))
-                                    pre_pCa = pCa * np.ones(pre_points)
-                                    pre_delta_hsl = np.hstack((pre_1_delta_hsl,
-                                                               step_ramp_delta_hsl,
-                                                               pre_2_delta_hsl))
-                                    pre_mode_vector = np.hstack((pre_1_mode_vector,
-                                                                 step_ramp_mode_vector,
-                                                                 pre_2_mode_vector))
-                                    
-                                
-                                # k_tr
-                                k_tr_time_step = pCa_struct['time_step_s'] / 10
-                                k_tr_points = int(pCa_struct['k_tr_duration_s'] / k_tr_time_step)
-                                k_tr_ramp_points = int(pCa_struct['k_tr_ramp_s'] / k_tr_time_step)
-                                ramp_inc = pCa_struct['k_tr_magnitude_nm'] / \
-                                            float(k_tr_ramp_points)
-                                
-                                k_tr_dt = k_tr_time_step * np.ones(k_tr_points)
-                                k_tr_pCa = pCa * np.ones(k_tr_points)
-                                k_tr_delta_hsl = np.zeros(k_tr_points)
-                                vi = np.arange(0, k_tr_ramp_points+1)
-                                k_tr_delta_hsl[vi] = -ramp_inc
-                                vi = np.arange(k_tr_points-1-k_tr_ramp_points, k_tr_points)
-                                k_tr_delta_hsl[vi] = ramp_inc
-                                k_tr_mode_vector = -np.ones(k_tr_points)
-        
-                                # Post
-                                post_points = int((pCa_struct['sim_duration_s'] -
-                                                   pCa_struct['k_tr_start_s'] -
-                                                   pCa_struct['k_tr_duration_s']) /
-                                                  pCa_struct['time_step_s'])
-                                post_dt = pCa_struct['time_step_s'] * np.ones(post_points)
-                                post_pCa = pCa * np.ones(post_points)
-                                post_delta_hsl = np.zeros(post_points)
-                                post_mode_vector = -2 * np.ones(post_points)
-                                
-                                # Stack together
-                                dt = np.hstack((pre_dt, k_tr_dt, post_dt))
-                                pCa_vector = np.hstack((pre_pCa, k_tr_pCa, post_pCa))
-                                delta_hsl = np.hstack((pre_delta_hsl,
-                                                       k_tr_delta_hsl,
-                                                       post_delta_hsl))
-                                mode_vector = np.hstack((pre_mode_vector,
-                                                         k_tr_mode_vector,
-                                                         post_mode_vector))
-                                
-                            # Now adjust the pCa_vector for step_up and step_down
-                            # if required
-                            t = np.cumsum(dt)
-                            if ('pCa_start' not in pCa_struct):
-                                pCa_start = 9.0
-                            else:
-                                pCa_start = pCa_struct['pCa_start']
-                            
-                            if ('pCa_stop' not in pCa_struct):
-                                pCa_stop = 9.0
-                            else:
-                                pCa_stop = pCa_struct['pCa_stop']
-                                
-                            if ('pCa_step_up_s' in pCa_struct):
-                                pCa_vector[t < pCa_struct['pCa_step_up_s']] = pCa_start
-                            
-                            if ('pCa_step_down_s' in pCa_struct):
-                                pCa_vector[t > pCa_struct['pCa_step_down_s']] = pCa_stop
-                            
-                            # Now make the protocol
-                            df = pd.DataFrame({'dt': dt,
-                                               'pCa': pCa_vector,
-                                               'delta_hsl': delta_hsl,
-                                               'mode': mode_vector})
+                            # Now make the protocol, the segments are
+                            # shared by all the pCa values
+                            pCa_vector = prot_builder.return_pCa(
+                                pCa, **pCa_steps)
                             
                             prot_file_string = os.path.join(sim_input_dir,
                                                             ('prot_pCa_%.0f_s_%.0f_r%i.txt' %
                                                              (10*pCa, 10*length_step, rep+1)))
                             
-                            # Write protocol if required
+                            # Queue protocol if required
                             if not figures_only:
-                                prot.write_protocol_to_file(df, prot_file_string)
+                                prot_writer.add(
+                                    prot_builder.return_protocol_text(pCa_vector),
+                                    prot_file_string)
                         
                             # Create the job
                             j = dict()
@@ -816,6 +547,19 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
                                     json.dump(oh, f, indent=4)        
                 
                             pCa_lc_b['job'].append(j)
+                            
+                            # Add the job to the catalog
+                            catalog_rows.append({
+                                'curve': dir_counter,
+                                'model': (i+1),
+                                'hs_length': float(hsl),
+                                'length_step': float(length_step),
+                                'm_isotype_profile': (m_iso_profile
+                                    if isinstance(m_iso_profile, str)
+                                    else None),
+                                'pCa': float(pCa),
+                                'rep': (rep+1),
+                                'results_file': j['results_file']})
 
     # Now create the analysis section
     batch_figs = dict()
@@ -896,6 +640,9 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
             fig['formatting'] = pCa_struct['formatting']
         batch_figs['k_tr_analysis'].append(fig)
 
+    # Write the protocols
+    prot_writer.write()
+
     # Now insert isometric_b into a full batch structure
     pCa_lc_batch = dict()
     pCa_lc_batch['FiberSim_batch'] = pCa_lc_b
@@ -908,10 +655,14 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
     with open(pCa_lc_batch_file, 'w') as f:
         json.dump(pCa_lc_batch, f, indent=4)
         
+    # Write the catalog for the analyses
+    sim_catalog.write_catalog(output_dir, catalog_rows)
+        
     # Now run the isometric batch
     batch.run_batch(pCa_lc_batch_file,
                     figures_only = figures_only,
-                    figures_off = figures_off)
+                    figures_off = figures_off,
+                    analysis_results = analysis_results)
     
     # Add the batch to the output
     func_output['sim_batch'] = pCa_lc_batch    
@@ -921,7 +672,8 @@ def deduce_pCa_length_control_properties(json_analysis_file_string,
     
 
 def deduce_fv_properties(json_analysis_file_string,
-                          fv_struct = []):
+                          fv_struct = [],
+                          analysis_results = None):
     """ Code runs force-velocity analysis """
 
     # Potentially switch off simulations
@@ -960,6 +712,8 @@ def deduce_fv_properties(json_analysis_file_string,
         FiberCpp_exe_struct['exe_file'] = \
             os.path.join(base_dir, FiberCpp_exe_struct['exe_file'])
     isometric_b['FiberCpp_exe'] = FiberCpp_exe_struct
+    add_sim_cache(isometric_b, anal_struct, json_analysis_file_string)
+    add_results_format(isometric_b, anal_struct)
 
     # Check for half-sarcomere lengths in the fv_struct
     # If none are specified, create an hsl array from the model file
@@ -1200,7 +954,8 @@ def deduce_fv_properties(json_analysis_file_string,
             json.dump(isometric_batch, f, indent=4)
             
         # Now run the isometric batch
-        batch.run_batch(isometric_batch_file, figures_only=figures_only)
+        batch.run_batch(isometric_batch_file, figures_only=figures_only,
+                        analysis_results=analysis_results)
         
         # Save the isometric jobs
         isometric_jobs = isometric_batch['FiberSim_batch']['job']
@@ -1209,7 +964,10 @@ def deduce_fv_properties(json_analysis_file_string,
     # First create the isotonic batch dict
     isotonic_b = dict()
     isotonic_b['FiberCpp_exe'] = FiberCpp_exe_struct
+    add_sim_cache(isotonic_b, anal_struct, json_analysis_file_string)
+    add_results_format(isotonic_b, anal_struct)
     isotonic_b['job'] = []
+    catalog_rows = []
     
     # Now cycle thought the isometric jobs, generating an isotonic suite
     # for each one
@@ -1258,7 +1016,8 @@ def deduce_fv_properties(json_analysis_file_string,
                 # Pull off the isometric force for the preceding job
                 isometric_job_index = dir_counter - 1
                 results_file_string = isometric_jobs[isometric_job_index]['results_file']
-                sim_data = pd.read_csv(results_file_string, sep='\t')
+                sim_data = rf.load_results(results_file_string,
+                                           columns=['m_force'])
                  # take the mean force over last 50 points
                 isometric_force = sim_data['m_force'].iloc[-50:-1].mean()
     
@@ -1410,6 +1169,15 @@ def deduce_fv_properties(json_analysis_file_string,
                             json.dump(oh, f, indent=4)      
             
                     isotonic_b['job'].append(j)
+                    
+                    # Add the job to the catalog
+                    catalog_rows.append({
+                        'curve': dir_counter,
+                        'model': (i+1),
+                        'hs_length': float(hsl),
+                        'rel_isotonic_force': float(rel_f),
+                        'rep': (rep+1),
+                        'results_file': j['results_file']})
 
 
     # Now create the batch analysis section
@@ -1484,13 +1252,18 @@ def deduce_fv_properties(json_analysis_file_string,
     with open(isotonic_batch_file, 'w') as f:
         json.dump(isotonic_batch, f, indent=4)
         
+    # Write the catalog for the analyses
+    sim_catalog.write_catalog(batch_output_dir, catalog_rows)
+        
     # Now run the isotonic batch
     batch.run_batch(isotonic_batch_file,
                     figures_only = figures_only,
-                    figures_off = figures_off)
+                    figures_off = figures_off,
+                    analysis_results = analysis_results)
 
 def deduce_freeform_properties(json_analysis_file_string,
-                               freeform_struct):
+                               freeform_struct,
+                               analysis_results = None):
     """ Code runs freeform analysis """
     
     # Potentially switch off simulations
@@ -1534,8 +1307,11 @@ def deduce_freeform_properties(json_analysis_file_string,
         cpp_exe['exe_file'] = FiberCpp_exe_struct['exe_file']
 
     freeform_b['FiberCpp_exe'] = cpp_exe
+    add_sim_cache(freeform_b, char_struct, json_analysis_file_string)
+    add_results_format(freeform_b, char_struct)
 
     freeform_b['job'] = []
+    catalog_rows = []
     
     protocol_afterload = []
     after_struct = []
@@ -1578,20 +1354,24 @@ def deduce_freeform_properties(json_analysis_file_string,
             if not os.path.isdir(prot_dir):
                 os.makedirs(prot_dir)
             
-        # Set up for an array of protocols
+        # Set up for an array of protocols, calculating the Ca transients
+        # together
+        twitch_protocols = prot.create_twitch_protocols(
+            [{'time_step': ps['time_step_s'],
+              'n_points': ps['n_points'],
+              'stimulus_times_s': ps['stimulus_times_s'],
+              'Ca_content': ps['Ca_content'],
+              'stimulus_duration_s': ps['stimulus_duration_s'],
+              'k_leak': ps['k_leak'],
+              'k_act': ps['k_act'],
+              'k_serca': ps['k_serca']}
+             for ps in freeform_struct['protocol']['data']])
+        
         for (i, ps) in enumerate(freeform_struct['protocol']['data']):
             prot_file_string = os.path.join(prot_dir,
                                             'protocol_%i.txt' % (i+1))
             
-            p = prot.create_twitch_protocol(
-                    time_step = ps['time_step_s'],
-                    n_points = ps['n_points'],
-                    stimulus_times_s = ps['stimulus_times_s'],
-                    Ca_content = ps['Ca_content'],
-                    stimulus_duration_s = ps['stimulus_duration_s'],
-                    k_leak = ps['k_leak'],
-                    k_act = ps['k_act'],
-                    k_serca = ps['k_serca'])
+            p = twitch_protocols[i]
             
             # Create the job
             if not figures_only:
@@ -1822,6 +1602,21 @@ def deduce_freeform_properties(json_analysis_file_string,
                                 json.dump(oh, f, indent=4)        
             
                         freeform_b['job'].append(j)
+                        
+                        # Add the job to the catalog
+                        catalog_rows.append({
+                            'curve': dir_counter,
+                            'model': (i+1),
+                            'hs_length': float(hsl),
+                            'protocol': (prot_counter+1),
+                            'afterload': (after_counter+1),
+                            'rep': (rep+1),
+                            'results_file': j['results_file']})
+    
+    # The catalog goes in the sim_output folder with the results
+    catalog_folder = os.path.join(base_dir,
+                                  freeform_struct['sim_folder'],
+                                  'sim_output')
                 
     # Now create the batch analysis section
     batch_figs = dict()
@@ -1888,11 +1683,16 @@ def deduce_freeform_properties(json_analysis_file_string,
         except OSError as e:
             print("Error: %s : %s" % (sim_output_folder, e.strerror))
         
+    # Write the catalog for the analyses
+    sim_catalog.write_catalog(catalog_folder, catalog_rows)
+        
     # Now run the freeform batch
-    batch.run_batch(freeform_batch_file, figures_only=figures_only)
+    batch.run_batch(freeform_batch_file, figures_only=figures_only,
+                    analysis_results=analysis_results)
     
 def characterize_fv_with_pCa_and_isometric_force(json_analysis_file_string,
-                                                 fv_characterize_dict):
+                                                 fv_characterize_dict,
+                                                 analysis_results = None):
     """ Runs simulations at given pCa and calculates force-velocity
         properties """
         
@@ -1929,6 +1729,8 @@ def characterize_fv_with_pCa_and_isometric_force(json_analysis_file_string,
         cpp_exe['exe_file'] = FiberCpp_exe_struct['exe_file']
         
     fv_dict['FiberCpp_exe'] = cpp_exe
+    add_sim_cache(fv_dict, char_struct, json_analysis_file_string)
+    add_results_format(fv_dict, char_struct)
 
     # Turn the model files into absolute paths as well
     model_struct = char_struct['model']
@@ -1960,6 +1762,7 @@ def characterize_fv_with_pCa_and_isometric_force(json_analysis_file_string,
     
     # Set up your jobs
     fv_dict['job'] = []
+    catalog_rows = []
     
     # Get the base directory for the simulations
     if ('relative_to' in fv_characterize_dict):
@@ -2144,6 +1947,15 @@ def characterize_fv_with_pCa_and_isometric_force(json_analysis_file_string,
                     #         json.dump(oh, f, indent=4)      
             
                     fv_dict['job'].append(j)          
+                    
+                    # Add the job to the catalog
+                    catalog_rows.append({
+                        'curve': dir_counter,
+                        'model': (i+1),
+                        'hs_length': float(hsl),
+                        'rel_isotonic_force': float(rel_f),
+                        'rep': (rep+1),
+                        'results_file': j['results_file']})
     
     # Now create the batch analysis section
     batch_figs = dict()
@@ -2217,9 +2029,87 @@ def characterize_fv_with_pCa_and_isometric_force(json_analysis_file_string,
     with open(isotonic_batch_file, 'w') as f:
         json.dump(isotonic_batch, f, indent=4)
         
+    # Write the catalog for the analyses
+    sim_catalog.write_catalog(batch_output_dir, catalog_rows)
+        
     # Now run the isotonic batch
-    batch.run_batch(isotonic_batch_file, figures_only=figures_only)
+    batch.run_batch(isotonic_batch_file, figures_only=figures_only,
+                    analysis_results=analysis_results)
         
+def return_pCa_protocol_builder(pCa_struct, length_step):
+    """ Returns a protocol_builder with the segments for a pCa length
+        control protocol """
+    
+    b = prot_builder_lib.protocol_builder()
+    time_step = pCa_struct['time_step_s']
+    
+    if not ('k_tr_start_s' in pCa_struct):
+        b.add_hold(pCa_struct['sim_duration_s'], time_step)
+        return b
+    
+    # Pre-phase
+    if not ('length_step_nm' in pCa_struct):
+        b.add_hold(pCa_struct['k_tr_start_s'], time_step)
+    else:
+        # Break up pre_ktr period into before length step,
+        # during length step and after length step
+        b.add_hold(pCa_struct['length_step_s'], time_step)
+        b.add_ramp(pCa_struct['length_step_ramp_s'], time_step / 10,
+                   length_step)
+        b.add_hold((pCa_struct['k_tr_start_s'] -
+                    pCa_struct['length_step_s'] -
+                    pCa_struct['length_step_ramp_s']), time_step)
+    
+    # k_tr
+    b.add_k_tr(pCa_struct['k_tr_duration_s'], time_step / 10,
+               pCa_struct['k_tr_ramp_s'], pCa_struct['k_tr_magnitude_nm'])
+    
+    # Post
+    b.add_hold((pCa_struct['sim_duration_s'] -
+                pCa_struct['k_tr_start_s'] -
+                pCa_struct['k_tr_duration_s']), time_step)
+    
+    return b
+
+def return_pCa_steps(pCa_struct):
+    """ Returns the pCa step up and step down for a pCa length control
+        protocol as keyword arguments for protocol_builder.return_pCa """
+    
+    pCa_steps = dict()
+    
+    if ('pCa_start' not in pCa_struct):
+        pCa_steps['pCa_start'] = 9.0
+    else:
+        pCa_steps['pCa_start'] = pCa_struct['pCa_start']
+    
+    if ('pCa_stop' not in pCa_struct):
+        pCa_steps['pCa_stop'] = 9.0
+    else:
+        pCa_steps['pCa_stop'] = pCa_struct['pCa_stop']
+    
+    if ('pCa_step_up_s' in pCa_struct):
+        pCa_steps['pCa_step_up_s'] = pCa_struct['pCa_step_up_s']
+    
+    if ('pCa_step_down_s' in pCa_struct):
+        pCa_steps['pCa_step_down_s'] = pCa_struct['pCa_step_down_s']
+    
+    return pCa_steps
+
+def add_sim_cache(batch_dict, setup_struct, json_analysis_file_string):
+    """ Copies the sim_cache section of a setup into a batch, with an
+        absolute path for the cache folder """
+    
+    if ('sim_cache' in setup_struct):
+        batch_dict['sim_cache'] = sim_cache.resolve_cache_struct(
+            setup_struct['sim_cache'], json_analysis_file_string)
+
+def add_results_format(batch_dict, setup_struct):
+    """ Copies the results_format of a setup into a batch so that the
+        results files are converted as the simulations finish """
+
+    if ('results_format' in setup_struct):
+        batch_dict['results_format'] = setup_struct['results_format']
+
 def return_base_dir(struct, file_string):
     base_dir = ''
     if ('relative_to' in struct):
@@ -2228,82 +2118,3 @@ def return_base_dir(struct, file_string):
         elif not (struct['relative_to'] == 'False'):
             base_dir = struct['relative_to']
     return base_dir
-
-def return_m_isotype_ints(model_dict, m_profile):
-    """ Returns an array of m_isotyp_ints that sets the isotype of
-        each myosin """
-        
-    # Create an empty array of m_isotypes
-    m_iso_int = []
-    
-    if m_profile.startswith('all'):
-        iso_int = int(m_profile[4])
-        
-        # Set m_isotype_ints to a constant array of iso_int
-        for crown_counter in range(model_dict['thick_structure']['m_crowns_per_filament']):
-            for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
-                for d_counter in range(model_dict['thick_structure']['m_myosins_per_hub']):
-                    m_iso_int.append(iso_int)
-                    
-    if m_profile.startswith('dimer'):
-        
-        iso_int_a = int(m_profile[6])
-        iso_int_b = int(m_profile[8])
-        
-        # Set m_isotype_ints to a constant array of iso_int
-        for crown_counter in range(model_dict['thick_structure']['m_crowns_per_filament']):
-            for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
-                m_iso_int.append(iso_int_a)
-                m_iso_int.append(iso_int_b)
-                
-    if m_profile.startswith('p'):
-        
-        iso_p_a = int(m_profile[2])
-        iso_p_b = int(m_profile[4])
-        iso_c_a = int(m_profile[8])
-        iso_c_b = int(m_profile[10])
-        iso_c_c = int(m_profile[12])
-        iso_c_d = int(m_profile[14])
-        iso_c_e = int(m_profile[16])
-        iso_c_f = int(m_profile[18])
-        iso_d_a = int(m_profile[22])
-        iso_d_b = int(m_profile[24])
-        
-        # Set m_isotype_ints to a constant array of iso_int
-        for crown_counter in range(model_dict['thick_structure']['m_crowns_per_filament']):
-            if (crown_counter < (model_dict['mybpc_structure']['c_thick_proximal_node'] - 1)):
-                # P-zone
-                for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
-                    m_iso_int.append(iso_p_a)
-                    m_iso_int.append(iso_p_b)
-
-            elif (crown_counter >= (model_dict['mybpc_structure']['c_thick_proximal_node'] +
-                                   ((model_dict['mybpc_structure']['c_thick_stripes']) *
-                                        model_dict['mybpc_structure']['c_thick_node_spacing']) - 1)):
-                # D-zone
-                for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
-                    m_iso_int.append(iso_d_a)
-                    m_iso_int.append(iso_d_b)
-                    
-            else:
-                # C-zone
-                
-                # Work out which stripe we are in
-                stripe_index = (1 + crown_counter- 
-                                        model_dict['mybpc_structure']['c_thick_proximal_node']) % 3
-                
-                if (stripe_index == 0):
-                    x = iso_c_a
-                    y = iso_c_b
-                elif (stripe_index == 1):
-                    x = iso_c_c
-                    y = iso_c_d
-                else:
-                    x = iso_c_e
-                    y = iso_c_f
-
-                for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
-                    m_iso_int.append(x)
-                    m_iso_int.append(y)
-                    
-    return m_iso_int
\ No newline at end of file
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Applies the model manipulations in a characterization setup
+
+compile_adjustments() resolves each adjustment in
+['model']['manipulations']['adjustments'] once, to the path of the value
+it changes in the model dict. apply_adjustments() then calculates that
+value for every generated model at once, with the multipliers held as
+arrays, and builds each model by copying only the parts of the base model
+that are changed. Everything else is shared with the base model.
+
+The generated models are the same as adjusting a deep copy of the base
+model for each multiplier in turn. Parameters that are stored as arrays,
+such as rate_parameters, are held as float32 values, as before.
+"""
+
+import re
+import copy
+
+import numpy as np
+
+
+# Marks a value that is removed from the model
+DELETE = object()
+
+
+def compile_adjustments(base_model, adjustments, no_of_models):
+    """ Returns a list of steps, one or more for each adjustment, each
+        holding the path to the value it changes in the model """
+
+    plan = []
+
+    for a in adjustments:
+
+        if ('multipliers' in a):
+            multipliers = np.asarray(a['multipliers'][0:no_of_models],
+                                     dtype=float)
+
+        if ((a['variable'] == 'm_kinetics') or
+                (a['variable'] == 'c_kinetics')):
+
+            state_path = (a['variable'], a['isotype']-1,
+                          'state', a['state']-1)
+
+            # Special case for kinetics
+            if ('extension' in a):
+                plan.append({'type': 'scale',
+                             'path': state_path + ('extension',),
+                             'multipliers': multipliers,
+                             'output_type': 'float',
+                             'null_if_nan': False})
+
+            elif ('relative_to' in a):
+                # Parameter is relative to another kinetics parameter.
+                # The other rate parameters of the transition are kept
+                digits = [int(s) for s in re.findall(r'\d+', a['relative_to'])]
+                plan.append({'type': 'scale_element',
+                             'path': state_path +
+                                 ('transition', a['transition']-1,
+                                  'rate_parameters'),
+                             'index': a['parameter_number']-1,
+                             'source_path': (a['variable'], digits[0]-1,
+                                             'state', digits[1]-1,
+                                             'transition', digits[2]-1,
+                                             'rate_parameters'),
+                             'source_index': digits[3]-1,
+                             'multipliers': multipliers})
+
+            else:
+                # Transition parameters
+                path = state_path + ('transition', a['transition']-1,
+                                     'rate_parameters')
+                plan.append({'type': 'scale_element',
+                             'path': path,
+                             'index': a['parameter_number']-1,
+                             'source_path': path,
+                             'source_index': a['parameter_number']-1,
+                             'multipliers': multipliers})
+
+        elif ('iso_switching' in a['variable']):
+            path = (a['variable'], 'type', a['type']-1,
+                    'transition', a['transition']-1, 'rate_parameters')
+            plan.append({'type': 'scale_element',
+                         'path': path,
+                         'index': a['parameter_number']-1,
+                         'source_path': path,
+                         'source_index': a['parameter_number']-1,
+                         'multipliers': multipliers})
+
+        elif (a['variable'] == 'thin_kinetics'):
+            plan.append({'type': 'scale',
+                         'path': (a['variable'], a['isotype']-1,
+                                  a['parameter']),
+                         'multipliers': multipliers,
+                         'output_type': 'float',
+                         'null_if_nan': False})
+
+        elif (a['variable'].endswith('isotype_proportions')):
+            prefix = a['variable'][0]
+            plan.append({'type': 'set',
+                         'path': ('%s_parameters' % prefix, a['variable']),
+                         'values': [p['isotype_proportions']
+                                    for p in a['proportions'][0:no_of_models]]})
+
+        elif (a['variable'] == 'm_isotype_profiles'):
+            # Each distinct profile is only expanded once
+            profiles = dict()
+            for p in a['profile'][0:no_of_models]:
+                if not (p in profiles):
+                    profiles[p] = return_m_isotype_ints(base_model, p)
+            plan.append({'type': 'set',
+                         'path': ('m_parameters', 'm_isotype_ints'),
+                         'values': [profiles[p]
+                                    for p in a['profile'][0:no_of_models]]})
+
+            # If there was an m_isotype_proportions, delete it
+            if ('m_isotype_proportions' in base_model['m_parameters']):
+                plan.append({'type': 'set',
+                             'path': ('m_parameters',
+                                      'm_isotype_proportions'),
+                             'values': [DELETE] * no_of_models})
+
+        elif (a['class'] == 'half_sarcomere_variation'):
+            for (vi, h) in enumerate(base_model[a['class']]):
+                if (h['variable'] == a['variable']):
+                    path = (a['class'], vi, 'multiplier')
+                    plan.append({'type': 'scale_element',
+                                 'path': path,
+                                 'index': a['parameter_number']-1,
+                                 'source_path': path,
+                                 'source_index': a['parameter_number']-1,
+                                 'multipliers': multipliers})
+
+        else:
+            path = (a['class'], a['variable'])
+            if ('parameter_number' in a):
+                # It's an array
+                plan.append({'type': 'scale_element',
+                             'path': path,
+                             'index': a['parameter_number']-1,
+                             'source_path': path,
+                             'source_index': a['parameter_number']-1,
+                             'multipliers': multipliers})
+            else:
+                # Standard value
+                plan.append({'type': 'scale',
+                             'path': path,
+                             'multipliers': multipliers,
+                             'output_type': a['output_type'],
+                             'null_if_nan': True})
+
+    return plan
+
+def apply_adjustments(base_model, plan, no_of_models):
+    """ Returns a list of no_of_models adjusted models """
+
+    # The current value at each path, with one row for each model
+    values = dict()
+
+    # The paths that are written to the models, and how their values are
+    # converted. Paths that are only read are not written
+    output_types = dict()
+    null_paths = set()
+
+    for step in plan:
+        path = step['path']
+
+        if (step['type'] == 'set'):
+            values[path] = list(step['values'])
+            output_types[path] = 'object'
+
+        elif (step['type'] == 'scale_element'):
+            source = return_element_values(base_model, values,
+                                           step['source_path'], no_of_models)
+            y = return_element_values(base_model, values,
+                                      path, no_of_models)
+            y[:, step['index']] = source[:, step['source_index']] * \
+                step['multipliers'].astype(np.float32)
+            output_types[path] = 'array'
+
+        else:
+            if not (path in values):
+                base_value = return_path_value(base_model, path)
+                values[path] = np.full(no_of_models, base_value, dtype=float)
+                if isinstance(base_value, int):
+                    output_types[path] = 'int'
+                else:
+                    output_types[path] = 'float'
+            value = values[path] * step['multipliers']
+
+            if (step['output_type'] == 'int'):
+                values[path] = np.trunc(value)
+                output_types[path] = 'int'
+            elif (step['output_type'] == 'float'):
+                values[path] = value
+                output_types[path] = 'float'
+
+            # Standard values are set to null if they are NaN
+            if step['null_if_nan']:
+                values[path] = np.where(np.isnan(value), np.nan,
+                                        values[path])
+                null_paths.add(path)
+
+    # Convert the values to the types written to the model files
+    model_values = []
+    for (path, output_type) in output_types.items():
+        y = values[path]
+        if (output_type == 'object'):
+            v = y
+        elif (output_type == 'array'):
+            v = y.tolist()
+        else:
+            if (output_type == 'int'):
+                v = [x if np.isnan(x) else int(x) for x in y]
+            else:
+                v = [float(x) for x in y]
+            if (path in null_paths):
+                v = ['null' if np.isnan(x) else x for x in v]
+        model_values.append((path, v))
+
+    models = []
+    for i in range(no_of_models):
+        models.append(build_model(base_model,
+                                  [(path, v[i]) for (path, v) in model_values]))
+
+    return models
+
+def build_model(base_model, path_values):
+    """ Returns a copy of base_model with the values set at each path,
+        copying only the containers along those paths """
+
+    model = copy.copy(base_model)
+    copied = {(): model}
+
+    for (path, value) in path_values:
+        node = model
+        for depth in range(len(path) - 1):
+            key = path[0:(depth+1)]
+            if not (key in copied):
+                copied[key] = copy.copy(node[path[depth]])
+                node[path[depth]] = copied[key]
+            node = copied[key]
+
+        if (value is DELETE):
+            if (path[-1] in node):
+                del node[path[-1]]
+        else:
+            node[path[-1]] = value
+
+    return model
+
+def return_path_value(model, path):
+    """ Returns the value at a path in a model """
+
+    node = model
+    for p in path:
+        node = node[p]
+    return node
+
+def return_element_values(base_model, values, path, no_of_models):
+    """ Returns the float32 array of values for an array parameter, with
+        one row for each model """
+
+    if not (path in values):
+        y = np.asarray(return_path_value(base_model, path), dtype=np.float32)
+        values[path] = np.tile(y, (no_of_models, 1))
+    return values[path]
+
+def return_m_isotype_ints(model_dict, m_profile):
+    """ Returns an array of m_isotyp_ints that sets the isotype of
+        each myosin """
+        
+    # Create an empty array of m_isotypes
+    m_iso_int = []
+    
+    if m_profile.startswith('all'):
+        iso_int = int(m_profile[4])
+        
+        # Set m_isotype_ints to a constant array of iso_int
+        for crown_counter in range(model_dict['thick_structure']['m_crowns_per_filament']):
+            for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
+                for d_counter in range(model_dict['thick_structure']['m_myosins_per_hub']):
+                    m_iso_int.append(iso_int)
+                    
+    if m_profile.startswith('dimer'):
+        
+        iso_int_a = int(m_profile[6])
+        iso_int_b = int(m_profile[8])
+        
+        # Set m_isotype_ints to a constant array of iso_int
+        for crown_counter in range(model_dict['thick_structure']['m_crowns_per_filament']):
+            for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
+                m_iso_int.append(iso_int_a)
+                m_iso_int.append(iso_int_b)
+                
+    if m_profile.startswith('p'):
+        
+        iso_p_a = int(m_profile[2])
+        iso_p_b = int(m_profile[4])
+        iso_c_a = int(m_profile[8])
+        iso_c_b = int(m_profile[10])
+        iso_c_c = int(m_profile[12])
+        iso_c_d = int(m_profile[14])
+        iso_c_e = int(m_profile[16])
+        iso_c_f = int(m_profile[18])
+        iso_d_a = int(m_profile[22])
+        iso_d_b = int(m_profile[24])
+        
+        # Set m_isotype_ints to a constant array of iso_int
+        for crown_counter in range(model_dict['thick_structure']['m_crowns_per_filament']):
+            if (crown_counter < (model_dict['mybpc_structure']['c_thick_proximal_node'] - 1)):
+                # P-zone
+                for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
+                    m_iso_int.append(iso_p_a)
+                    m_iso_int.append(iso_p_b)
+
+            elif (crown_counter >= (model_dict['mybpc_structure']['c_thick_proximal_node'] +
+                                   ((model_dict['mybpc_structure']['c_thick_stripes']) *
+                                        model_dict['mybpc_structure']['c_thick_node_spacing']) - 1)):
+                # D-zone
+                for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
+                    m_iso_int.append(iso_d_a)
+                    m_iso_int.append(iso_d_b)
+                    
+            else:
+                # C-zone
+                
+                # Work out which stripe we are in
+                stripe_index = (1 + crown_counter- 
+                                        model_dict['mybpc_structure']['c_thick_proximal_node']) % 3
+                
+                if (stripe_index == 0):
+                    x = iso_c_a
+                    y = iso_c_b
+                elif (stripe_index == 1):
+                    x = iso_c_c
+                    y = iso_c_d
+                else:
+                    x = iso_c_e
+                    y = iso_c_f
+
+                for hub_counter in range(model_dict['thick_structure']['m_hubs_per_crown']):
+                    m_iso_int.append(x)
+                    m_iso_int.append(y)
+                    
+    return m_iso_int
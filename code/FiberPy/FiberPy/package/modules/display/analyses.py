@@ -27,12 +27,16 @@ from natsort import natsorted
 
 try:
     from package.modules.analysis import curve_fitting as cv
+    from package.modules.analysis import results_files as rf
+    from package.modules.analysis import sim_catalog
     from package.modules.utilities import utilities as ut
 except:
     this_dir = str(Path(os.path.dirname(__file__)).resolve())
    
     sys.path.append(os.path.join(this_dir, '../analysis'))
     import curve_fitting as cv
+    import results_files as rf
+    import sim_catalog
 
     sys.path.append(os.path.join(this_dir, '../../'))
     import modules.utilities.utilities as ut
@@ -408,29 +412,29 @@ def create_y_pCa_figure(fig_data, batch_file_string):
     curve_data = dict()
     curve_data['curve'] = []
 
+    # Find the results files for each curve
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
+
     while (keep_going):
-        curve_folder = os.path.join(top_data_folder,
-                                    ('%i' % curve_counter))
-
-        if os.path.isdir(curve_folder):
-            # Find the results files
-            for file in os.listdir(curve_folder):
-                if (file.endswith('.txt') and not file.startswith('rates')):
-                    data_file_string = \
-                        os.path.join(curve_folder, file)
-                    d = pd.read_csv(data_file_string, delimiter='\t')
-                    pCa_values[curve_counter-1].append(d['hs_1_pCa'].iloc[-1])
-                    y = formatting['y_scaling_factor'] * \
-                            d[fig_data['data_field']].iloc[-50:-1].mean() # take the mean force over last 50 points
-                    y_values[curve_counter-1].append(y)
-                    if (np.amax(y) > max_y):
-                        max_y = np.amax(y)
+
+        if (curve_counter in curve_files):
+            for data_file_string in curve_files[curve_counter]:
+                d = rf.load_results(data_file_string,
+                                    columns=['hs_1_pCa', 'hs_1_length',
+                                             fig_data['data_field']],
+                                    tail_rows=50)
+                pCa_values[curve_counter-1].append(d['hs_1_pCa'].iloc[-1])
+                y = formatting['y_scaling_factor'] * \
+                        d[fig_data['data_field']].iloc[-50:-1].mean() # take the mean force over last 50 points
+                y_values[curve_counter-1].append(y)
+                if (np.amax(y) > max_y):
+                    max_y = np.amax(y)
                     
-                    # Store data for subsequent output
-                    curve_index.append(curve_counter)
-                    hs_force.append(y)
-                    hs_pCa.append(d['hs_1_pCa'].iloc[-1])
-                    hs_length.append(d['hs_1_length'].iloc[-1])
+                # Store data for subsequent output
+                curve_index.append(curve_counter)
+                hs_force.append(y)
+                hs_pCa.append(d['hs_1_pCa'].iloc[-1])
+                hs_length.append(d['hs_1_length'].iloc[-1])
 
             # Add in curve
             res=cv.fit_pCa_data(pCa_values[curve_counter-1],
@@ -635,6 +639,12 @@ def create_y_pCa_figure(fig_data, batch_file_string):
             
     plt.close()
 
+    # Collect the sheets
+    sheets = dict()
+    sheets['simulation_data'] = r
+    for (i,c) in enumerate(curve_data['curve']):
+        sheets['curve_%i' % (i+1)] = c
+
     # Save the data as an excel file if required in the batch file
     if('output_data_file_string' in fig_data):
         if (fig_data['relative_to'] == 'this_file'):
@@ -645,12 +655,62 @@ def create_y_pCa_figure(fig_data, batch_file_string):
 
         print('Writing tension-pCa data to %s' % output_file_string)
         with pd.ExcelWriter(output_file_string, engine='openpyxl') as writer:
-            r.to_excel(writer, sheet_name = 'simulation_data', index=False)
-            for (i,c) in enumerate(curve_data['curve']):
-                c.to_excel(writer,
-                           index=False,
-                           sheet_name = 'curve_%i' % (i+1))
-
+            for (sheet_name, df) in sheets.items():
+                df.to_excel(writer, sheet_name = sheet_name, index=False)
+
+    return sheets
+
+
+def fit_fv_curves(rc, initial_ml):
+    """ Fits hyperbolas and power curves to the data for one curve of a
+        force-velocity analysis and returns a dict with the fits and a
+        data frame for the curve sheet """
+
+    fv_curve = cv.fit_hyperbola(rc['m_force'], rc['m_velocity'])
+    pow_curve = cv.fit_power_curve(rc['m_force'], rc['m_power'])
+    rel_fv_curve = cv.fit_hyperbola(rc['m_f_to_f_max'], rc['m_velocity_l0_per_s'])
+    rel_pow_curve = cv.fit_power_curve(rc['m_f_to_f_max'], rc['m_rel_power'])
+
+    # Deduce v_max
+    fv_curve['v_max'] = ((fv_curve['x_0'] + fv_curve['a']) * 
+                            (fv_curve['b'] / fv_curve['a'])) - fv_curve['b']
+
+    # Calculate v_max in muscle lengths per second
+    fv_curve['v_max_l0_per_s'] = 1e9 * fv_curve['v_max'] / initial_ml
+
+    # Store the curve data
+    d_parameters = pd.DataFrame({'fv_x_0': fv_curve['x_0'],
+                                 'fv_a': fv_curve['a'],
+                                 'fv_b': fv_curve['b'],
+                                 'fv_v_max': fv_curve['v_max'],
+                                 'fv_v_max_l0_per_s': fv_curve['v_max_l0_per_s'],
+                                 'pow_x_0': pow_curve['x_0'],
+                                 'pow_a': pow_curve['a'],
+                                 'pow_b': pow_curve['b'],
+                                 'rel_fv_x_0': rel_fv_curve['x_0'],
+                                 'rel_fv_a': rel_fv_curve['a'],
+                                 'rel_fv_b': rel_fv_curve['b'],
+                                 'rel_pow_x_0': rel_pow_curve['x_0'],
+                                 'rel_pow_a': rel_pow_curve['a'],
+                                 'rel_pow_b': rel_pow_curve['b']},
+                                index=[0])
+    d_fits = pd.DataFrame({'fv_x_fit': fv_curve['x_fit'],
+                           'fv_y_fit': fv_curve['y_fit'],
+                           'pow_x_fit': pow_curve['x_fit'],
+                           'pow_y_fit': pow_curve['y_fit'],
+                           'rel_fv_x_fit': rel_fv_curve['x_fit'],
+                           'rel_fv_y_fit': rel_fv_curve['y_fit'],
+                           'rel_pow_x_fit': rel_pow_curve['x_fit'],
+                           'rel_pow_y_fit': rel_pow_curve['y_fit']})
+
+    fits = dict()
+    fits['fv'] = fv_curve
+    fits['pow'] = pow_curve
+    fits['rel_fv'] = rel_fv_curve
+    fits['rel_pow'] = rel_pow_curve
+    fits['data'] = pd.concat([d_parameters, d_fits])
+
+    return fits
 
 def create_fv_and_power_figure(fig_data, batch_file_string):
     """ Creates an fv and power figure """
@@ -693,39 +753,38 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
     m_power = []
     m_power_passive_corrected = []
 
+    # Find the results files for each curve
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
+
     while keep_going:
-        curve_folder = os.path.join(top_data_folder,
-                                    ('%i' % curve_counter))
-        if (os.path.isdir(curve_folder)):
+        if (curve_counter in curve_files):
             
-            # Find the results files and sort them in natural order
-            results_files = []
-            file_ind = []
-            for file in os.listdir(curve_folder):
-                if file.endswith('.txt'):
-                    results_files.append(file)
-                    file_ind.append(int(file.split('_')[1]))
-            si = np.argsort(np.asarray(file_ind))
+            # Sort the results files in natural order
+            results_files = curve_files[curve_counter]
+            file_ind = [int(os.path.basename(f).split('_')[1])
+                        for f in results_files]
+            si = np.argsort(np.asarray(file_ind), kind='stable')
             results_files = [results_files[i] for i in si]
             
-            # Make a figure to check 
-            fig = plt.figure(constrained_layout=True)
-            gs = fig.add_gridspec(nrows=2, ncols=1,
-                                  wspace = 0.5,
-                                  hspace=0.1)
-            fig.set_size_inches([3.5, 4])
-            ax_for = fig.add_subplot(gs[0,0])
-            ax_len = fig.add_subplot(gs[1, 0])
+            # Make a figure to check, unless only the data are needed
+            if ('output_image_file' in fig_data):
+                fig = plt.figure(constrained_layout=True)
+                gs = fig.add_gridspec(nrows=2, ncols=1,
+                                      wspace = 0.5,
+                                      hspace=0.1)
+                fig.set_size_inches([3.5, 4])
+                ax_for = fig.add_subplot(gs[0,0])
+                ax_len = fig.add_subplot(gs[1, 0])
             
-            for file in results_files:
-                data_file_string = os.path.join(curve_folder, file)
+            for data_file_string in results_files:
                 
                 # Display, as this can be slow
                 print('Fitting shortening velocity for: %s' %
                       data_file_string)
 
                 # Load up the results file
-                d = pd.read_csv(data_file_string, delimiter='\t')
+                d = rf.load_results(data_file_string,
+                                    columns=['time', 'm_force', 'm_length'])
                 initial_ml = d['m_length'].iloc[0] # muscle length at t = 0
 
                 # Filter to fit time_interval
@@ -737,8 +796,9 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
                                                  (0.5 * (fig_data['fit_time_interval_s'][-1] -
                                                        fig_data['fit_time_interval_s'][0]))))]
                 
-                ax_for.plot(d_display['time'], d_display['m_force'], 'b-')
-                ax_len.plot(d_display['time'], d_display['m_length'], 'b-')
+                if ('output_image_file' in fig_data):
+                    ax_for.plot(d_display['time'], d_display['m_force'], 'b-')
+                    ax_len.plot(d_display['time'], d_display['m_length'], 'b-')
 
                 # Now do the fit
                 if length_fit_mode == 'exponential':
@@ -780,7 +840,8 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
                     m_vel_l0_per_s = 1e9 * m_vel / initial_ml # velocity in ML s^-1
                    
                 # Plot
-                ax_len.plot(d_fit['time'], vel_data['y_fit'], 'r-')
+                if ('output_image_file' in fig_data):
+                    ax_len.plot(d_fit['time'], vel_data['y_fit'], 'r-')
           
                 # Deduce isometric time
                 d_isometric = d[(d['time'] > (fig_data['sim_release_s'] - 0.1)) &
@@ -810,25 +871,26 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
                 m_power_passive_corrected.append(m_pow_passive_corrected)
            
             
-            fit_traces_string = ('fv_traces_%i' % curve_counter)
-            if (fig_data['relative_to'] == 'this_file'):
-                fit_traces_string = \
-                        os.path.join(base_folder,
-                                     fit_traces_string)
-            else:
-                dir_name = os.path.dirname(fig_data['output_image_file'])
-                fit_traces_string = os.path.join(dir_name, fit_traces_string)
+            if ('output_image_file' in fig_data):
+                fit_traces_string = ('fv_traces_%i' % curve_counter)
+                if (fig_data['relative_to'] == 'this_file'):
+                    fit_traces_string = \
+                            os.path.join(base_folder,
+                                         fit_traces_string)
+                else:
+                    dir_name = os.path.dirname(fig_data['output_image_file'])
+                    fit_traces_string = os.path.join(dir_name, fit_traces_string)
 
-            # Check dir exists
-            dir_name = os.path.dirname(fit_traces_string)
+                # Check dir exists
+                dir_name = os.path.dirname(fit_traces_string)
             
-            if (not os.path.isdir(dir_name)):
-                os.makedirs(dir_name)
+                if (not os.path.isdir(dir_name)):
+                    os.makedirs(dir_name)
                 
-            for f in fig_data['output_image_formats']:
-                ofs = '%s.%s' % (fit_traces_string, f)
-                print('Saving fit traces figure to: %s' % ofs)
-                fig.savefig(ofs, dpi=200, bbox_inches='tight')
+                for f in fig_data['output_image_formats']:
+                    ofs = '%s.%s' % (fit_traces_string, f)
+                    print('Saving fit traces figure to: %s' % ofs)
+                    fig.savefig(ofs, dpi=200, bbox_inches='tight')
 
             curve_counter = curve_counter + 1
 
@@ -907,6 +969,13 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
         for c in range(1, curve_counter):
             # Pull off the curve data
             rc = r[r['curve'] == c].copy()
+
+            # Fit the curves
+            fits = fit_fv_curves(rc, initial_ml)
+            fv_curve = fits['fv']
+            pow_curve = fits['pow']
+            rel_fv_curve = fits['rel_fv']
+            rel_pow_curve = fits['rel_pow']
             
             # Deduce curve props        
             c_ind = (c-1) % len(formatting['marker_symbols'])
@@ -920,7 +989,6 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
             
             #x,y  = cv.remove_outliers(rc['m_force'], rc['m_velocity'])
             #fv_curve = cv.fit_hyperbola(x, y)
-            fv_curve = cv.fit_hyperbola(rc['m_force'], rc['m_velocity'])
 
             if formatting['labels'] != []:
 
@@ -942,7 +1010,6 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
             
             #x,y = cv.remove_outliers(rc['m_force'], rc['m_power'])
             #pow_curve = cv.fit_power_curve(x, y)
-            pow_curve = cv.fit_power_curve(rc['m_force'], rc['m_power'])
             
             ax_pow.plot(pow_curve['x_fit'], pow_curve['y_fit'],
                         color=ax_pow.lines[-1].get_color(),
@@ -956,7 +1023,6 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
             
             # x,y = cv.remove_outliers(rc['m_f_to_f_max'], rc['m_velocity_l0_per_s'])
             # rel_fv_curve = cv.fit_hyperbola(x, y)
-            rel_fv_curve = cv.fit_hyperbola(rc['m_f_to_f_max'], rc['m_velocity_l0_per_s'])
             
             ax_rel_fv.plot(rel_fv_curve['x_fit'], rel_fv_curve['y_fit'],
                            color=ax_rel_fv.lines[-1].get_color(),
@@ -970,7 +1036,6 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
             
             # x,y = cv.remove_outliers(rc['m_f_to_f_max'], rc['m_rel_power'])
             # rel_pow_curve = cv.fit_power_curve(x,y)
-            rel_pow_curve = cv.fit_power_curve(rc['m_f_to_f_max'], rc['m_rel_power'])
             
             ax_rel_pow.plot(rel_pow_curve['x_fit'], rel_pow_curve['y_fit'],
                         color=ax_pow.lines[-1].get_color(),
@@ -983,41 +1048,9 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
             rel_v_ticks = np.concatenate((rel_v_ticks, rc['m_velocity_l0_per_s']))
             p_ticks = np.concatenate((p_ticks, rc['m_power']))
             rel_p_ticks = np.concatenate((rel_p_ticks, rc['m_rel_power']))
-            
-            # Deduce v_max
-            fv_curve['v_max'] = ((fv_curve['x_0'] + fv_curve['a']) * 
-                                    (fv_curve['b'] / fv_curve['a'])) - fv_curve['b']
 
-            # Calculate v_max in muscle lengths per second
-            fv_curve['v_max_l0_per_s'] = 1e9 * fv_curve['v_max'] / initial_ml
-
-            
             # Store the curve data
-            d_parameters = pd.DataFrame({'fv_x_0': fv_curve['x_0'],
-                                         'fv_a': fv_curve['a'],
-                                         'fv_b': fv_curve['b'],
-                                         'fv_v_max': fv_curve['v_max'],
-                                         'fv_v_max_l0_per_s': fv_curve['v_max_l0_per_s'],
-                                         'pow_x_0': pow_curve['x_0'],
-                                         'pow_a': pow_curve['a'],
-                                         'pow_b': pow_curve['b'],
-                                         'rel_fv_x_0': rel_fv_curve['x_0'],
-                                         'rel_fv_a': rel_fv_curve['a'],
-                                         'rel_fv_b': rel_fv_curve['b'],
-                                         'rel_pow_x_0': rel_pow_curve['x_0'],
-                                         'rel_pow_a': rel_pow_curve['a'],
-                                         'rel_pow_b': rel_pow_curve['b']},
-                                        index=[0])
-            d_fits = pd.DataFrame({'fv_x_fit': fv_curve['x_fit'],
-                                   'fv_y_fit': fv_curve['y_fit'],
-                                   'pow_x_fit': pow_curve['x_fit'],
-                                   'pow_y_fit': pow_curve['y_fit'],
-                                   'rel_fv_x_fit': rel_fv_curve['x_fit'],
-                                   'rel_fv_y_fit': rel_fv_curve['y_fit'],
-                                   'rel_pow_x_fit': rel_pow_curve['x_fit'],
-                                   'rel_pow_y_fit': rel_pow_curve['y_fit']})
-            d_curve = pd.concat([d_parameters, d_fits])
-            curve_data['curve'].append(d_curve)
+            curve_data['curve'].append(fits['data'])
 
         # Tidy up
             
@@ -1133,6 +1166,19 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
             
     plt.close()
         
+    # Collect the sheets
+    sheets = dict()
+    sheets['simulation_data'] = r
+    if not ('output_image_file' in fig_data):
+        # Fit the curves without plotting them
+        curve_data = dict()
+        curve_data['curve'] = []
+        for c in range(1, curve_counter):
+            rc = r[r['curve'] == c].copy()
+            curve_data['curve'].append(fit_fv_curves(rc, initial_ml)['data'])
+    for (i,c) in enumerate(curve_data['curve']):
+        sheets['curve_%i' % (i+1)] = c
+        
     # Save the data as an excel file
     if ('output_data_file_string' in fig_data):
         if (fig_data['relative_to'] == 'this_file'):
@@ -1142,12 +1188,10 @@ def create_fv_and_power_figure(fig_data, batch_file_string):
             output_file_string = fig_data['output_data_file_string']
     
         with pd.ExcelWriter(output_file_string, engine='openpyxl') as writer:
-            r.to_excel(writer, sheet_name = 'simulation_data', index=False)
-            if ('output_image_file' in fig_data):
-                for (i,c) in enumerate(curve_data['curve']):
-                    c.to_excel(writer,
-                           index=False,
-                           sheet_name = ('curve_%i' % (i+1)))
+            for (sheet_name, df) in sheets.items():
+                df.to_excel(writer, sheet_name = sheet_name, index=False)
+
+    return sheets
 
 
 def create_ktr_figure(fig_data, batch_file_string):
@@ -1180,34 +1224,33 @@ def create_ktr_figure(fig_data, batch_file_string):
     hs_pCa = []
     hs_force = []
 
+    # Find the results files for each curve
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
+
     while keep_going:
-        curve_folder = os.path.join(top_data_folder,
-                                    ('%i' % curve_counter))
-        if (os.path.isdir(curve_folder)):
-            # Find the results files
-            for file in os.listdir(curve_folder):
-                if file.endswith('.txt'):
-                    data_file_string = os.path.join(curve_folder, file)
 
-                    # Load up the results file
-                    d = pd.read_csv(data_file_string, delimiter='\t')
+        if (curve_counter in curve_files):
+            for data_file_string in curve_files[curve_counter]:
+                # Load up the results file
+                d = rf.load_results(data_file_string,
+                                    columns=['time', 'force', 'pCa'])
 
-                    # Filter to fit time_interval
-                    d_fit = d.loc[(d['time'] >= fig_data['fit_time_interval_s'][0]) &
-                                  (d['time'] <= fig_data['fit_time_interval_s'][-1])]
+                # Filter to fit time_interval
+                d_fit = d.loc[(d['time'] >= fig_data['fit_time_interval_s'][0]) &
+                              (d['time'] <= fig_data['fit_time_interval_s'][-1])]
 
                     
-                    # Set the time origin to 0
-                    orig_time = d_fit['time'] - fig_data['fit_time_interval_s'][0]
+                # Set the time origin to 0
+                orig_time = d_fit['time'] - fig_data['fit_time_interval_s'][0]
 
-                    ktr_data = cv.fit_exponential_recovery(orig_time.to_numpy(),
-                                                    d_fit['force'].to_numpy())
+                ktr_data = cv.fit_exponential_recovery(orig_time.to_numpy(),
+                                                d_fit['force'].to_numpy())
                     
-                    # Store data
-                    curve.append(curve_counter)
-                    hs_ktr.append(ktr_data['k'])
-                    hs_pCa.append(d_fit['pCa'].iloc[-1])
-                    hs_force.append(formatting['x_scaling_factor'] * d_fit['force'].iloc[-1])
+                # Store data
+                curve.append(curve_counter)
+                hs_ktr.append(ktr_data['k'])
+                hs_pCa.append(d_fit['pCa'].iloc[-1])
+                hs_force.append(formatting['x_scaling_factor'] * d_fit['force'].iloc[-1])
 
             curve_counter = curve_counter + 1
 
@@ -1358,7 +1401,7 @@ def superpose_ktr_plots(fig_data, batch_file_string):
 
     for i in range(0, len(results_files)):
 
-        d = pd.read_csv(results_files[i], sep='\t')
+        d = rf.load_results(results_files[i])
         x = d['time']
 
         # Set max time on x axis
@@ -1512,25 +1555,25 @@ def dose_response(fig_data, batch_file_string):
     fig.set_size_inches([4, 3.5])
     ax = fig.add_subplot(gs[0,0])
 
+    # Find the results files for each curve
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
+
     while keep_going:
-        curve_folder = os.path.join(top_data_folder,
-                                    ('%i' % dose_counter))
-        if (os.path.isdir(curve_folder)):
-            # Find the results files
-            for file in os.listdir(curve_folder):
-                if file.endswith('.txt'):
 
-                    data_file_string = os.path.join(curve_folder, file)
-                    d = pd.read_csv(data_file_string, delimiter='\t')
+        if (dose_counter in curve_files):
+            for data_file_string in curve_files[dose_counter]:
+                d = rf.load_results(data_file_string,
+                                    columns=[fig_data['data_field']],
+                                    tail_rows=1)
 
-                    y = formatting['y_scaling_factor'] * \
-                            d[fig_data['data_field']].iloc[-1]
+                y = formatting['y_scaling_factor'] * \
+                        d[fig_data['data_field']].iloc[-1]
 
-                    if (np.amax(y) > max_y):
-                        max_y = np.amax(y)
+                if (np.amax(y) > max_y):
+                    max_y = np.amax(y)
 
-                    curve.append(dose_counter)
-                    y_values.append(y)
+                curve.append(dose_counter)
+                y_values.append(y)
 
             dose_counter = dose_counter + 1
 
@@ -1691,38 +1734,39 @@ def create_rates_figure(fig_data, batch_file_string):
     
     max_no_of_rates = 0
 
+    # Find the data folders
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
+
     # Loop through data folders
     while (keep_going):
         condition_folder = os.path.join(top_data_folder,
                                         ('%i' % model_counter))
 
-        if os.path.isdir(condition_folder):
-            for file in os.listdir(condition_folder):
-                if (file == 'rates.json'):
-                    
-                    fs = os.path.join(condition_folder, file)
-                    with open(fs, 'r') as f:
-                        d = json.load(f, strict=False)
+        if (model_counter in curve_files):
+            fs = os.path.join(condition_folder, 'rates.json')
+            if os.path.isfile(fs):
+                with open(fs, 'r') as f:
+                    d = json.load(f, strict=False)
                     
-                    # Scan through looking for myosins
-                    for (i,m) in enumerate(d['FiberSim_rates']['myosin']):
-                        # Read in the scheme
-                        # Pull of some data
-                        # Append the scheme to the holder as a Pandas
-                        # dataframe
+                # Scan through looking for myosins
+                for (i,m) in enumerate(d['FiberSim_rates']['myosin']):
+                    # Read in the scheme
+                    # Pull of some data
+                    # Append the scheme to the holder as a Pandas
+                    # dataframe
                         
-                        df = pd.read_csv(StringIO(m['scheme']), sep='\t')
-                        no_of_rates = len(df.columns) - 1
-                        max_no_of_rates = np.amax([max_no_of_rates, no_of_rates])
-                        m_schemes.append(df)
+                    df = pd.read_csv(StringIO(m['scheme']), sep='\t')
+                    no_of_rates = len(df.columns) - 1
+                    max_no_of_rates = np.amax([max_no_of_rates, no_of_rates])
+                    m_schemes.append(df)
                     
-                    # And now for mybpc
-                    for (i,c) in enumerate(d['FiberSim_rates']['mybpc']):
-                        # Same as for myosin above
-                        df = pd.read_csv(StringIO(c['scheme']), sep='\t')
-                        no_of_rates = len(df.columns) - 1
-                        max_no_of_rates = max([max_no_of_rates, no_of_rates])
-                        c_schemes.append(df)
+                # And now for mybpc
+                for (i,c) in enumerate(d['FiberSim_rates']['mybpc']):
+                    # Same as for myosin above
+                    df = pd.read_csv(StringIO(c['scheme']), sep='\t')
+                    no_of_rates = len(df.columns) - 1
+                    max_no_of_rates = max([max_no_of_rates, no_of_rates])
+                    c_schemes.append(df)
                         
             # Increment the folder counter
             model_counter = model_counter + 1
@@ -1826,21 +1870,11 @@ def create_superposed_traces_figure(fig_data, batch_file_string):
     else:
         top_data_folder = fig_data['results_folder']
         
-    # Loop through data folders
-    model_counter = 1
-    keep_going = True
-
-    while (keep_going):
-        condition_folder = os.path.join(top_data_folder,
-                                        ('%i' % model_counter))
-
-        if os.path.isdir(condition_folder):
-            model_counter = model_counter + 1
-        else:
-            keep_going = False
+    # Find the results files for each condition
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
 
     # Hold the no_of_conditions
-    no_of_conditions = model_counter-1
+    no_of_conditions = len(curve_files)
 
     # Keep track of max and mins
     min_hsl = np.inf
@@ -1860,195 +1894,191 @@ def create_superposed_traces_figure(fig_data, batch_file_string):
     # Create the figure
     for i in range(no_of_conditions):
         # Pull off the data files
-        condition_folder = os.path.join(top_data_folder,
-                                        ('%i' % (i+1)))
         file_counter = 1
-        for file in os.listdir(condition_folder):
-            if ((file.endswith('.txt')) and not file.endswith('rates.txt')):
-                fs = os.path.join(condition_folder, file)
-                # Force to numeric
-                d = pd.read_csv(fs, sep='\t', na_values=['-nan(ind)'])
+        for fs in curve_files[i+1]:
+            # Force to numeric
+            d = rf.load_results(fs)
                 
-                # Deduce the number of half-sarcomeres
-                pCa_names = [col for col in d if col.endswith('pCa')]
-                no_of_half_sarcomeres = len(pCa_names)
+            # Deduce the number of half-sarcomeres
+            pCa_names = [col for col in d if col.endswith('pCa')]
+            no_of_half_sarcomeres = len(pCa_names)
                 
-                if ((i==0) and (file_counter == 1)):
-                    # Check for series compliance to determine how to
-                    # make the figure
-                    print(d)
-                    if (d['sc_extension'].max() > 0):
-                        no_of_rows = 7
-                        pCa_row = 1
-                        hs_length_row = 2
-                        sc_length_row = 3
-                        force_row = 4
-                        thin_filament_row = 5
-                        thick_filament_row = 6
-                        mybpc_row = 7
-                    else:
-                        no_of_rows = 6
-                        pCa_row = 1
-                        hs_length_row = 2
-                        force_row = 3
-                        thin_filament_row = 4
-                        thick_filament_row = 5
-                        mybpc_row = 6
+            if ((i==0) and (file_counter == 1)):
+                # Check for series compliance to determine how to
+                # make the figure
+                print(d)
+                if (d['sc_extension'].max() > 0):
+                    no_of_rows = 7
+                    pCa_row = 1
+                    hs_length_row = 2
+                    sc_length_row = 3
+                    force_row = 4
+                    thin_filament_row = 5
+                    thick_filament_row = 6
+                    mybpc_row = 7
+                else:
+                    no_of_rows = 6
+                    pCa_row = 1
+                    hs_length_row = 2
+                    force_row = 3
+                    thin_filament_row = 4
+                    thick_filament_row = 5
+                    mybpc_row = 6
                     
-                    # Set-up the figure
-                    fig = plt.figure(constrained_layout = False)
-                    spec = gridspec.GridSpec(nrows=no_of_rows,
-                                             ncols=no_of_conditions,
-                                             figure=fig,
-                                             wspace = layout['grid_wspace'],
-                                             hspace = layout['grid_hspace'])
-                    fig.set_size_inches([3 * no_of_conditions, 2 * no_of_rows])
-
-                    ax=[]
+                # Set-up the figure
+                fig = plt.figure(constrained_layout = False)
+                spec = gridspec.GridSpec(nrows=no_of_rows,
+                                         ncols=no_of_conditions,
+                                         figure=fig,
+                                         wspace = layout['grid_wspace'],
+                                         hspace = layout['grid_hspace'])
+                fig.set_size_inches([3 * no_of_conditions, 2 * no_of_rows])
+
+                ax=[]
                 
-                if ('x_ticks' in formatting):
-                    d = d[(d['time'] > formatting['x_ticks'][0]) &
-                          (d['time'] <= formatting['x_ticks'][-1])]
-
-                # Keep track of max and mins
-                for hs in range(no_of_half_sarcomeres):
-                    hs_label = 'hs_%i_length' % (hs+1)
-                    min_hsl = np.amin([min_hsl, d[hs_label].min()])
-                    max_hsl = np.amax([max_hsl, d[hs_label].max()])
+            if ('x_ticks' in formatting):
+                d = d[(d['time'] > formatting['x_ticks'][0]) &
+                      (d['time'] <= formatting['x_ticks'][-1])]
+
+            # Keep track of max and mins
+            for hs in range(no_of_half_sarcomeres):
+                hs_label = 'hs_%i_length' % (hs+1)
+                min_hsl = np.amin([min_hsl, d[hs_label].min()])
+                max_hsl = np.amax([max_hsl, d[hs_label].max()])
                     
-                min_force = np.amin([min_force, d['hs_1_force'].min()])
-                max_force = np.amax([max_force, d['hs_1_force'].max()])
-
-                min_sc_length = np.amin([min_sc_length, d['sc_extension'].min()])
-                max_sc_length = np.amax([max_sc_length, d['sc_extension'].max()])
-
-                if (file_counter==1):
-                    # Make the plots
-                    for j in range(no_of_rows):
-                        ax.append(fig.add_subplot(spec[j,i]))
-
-                # Now plot
-                plot_index = (i*no_of_rows) + (pCa_row - 1)
-                ax[plot_index].plot(d['time'], d['hs_1_pCa'], '-',
-                                    color = color_map[i],
-                                    linewidth = formatting['data_linewidth'])
-                if ('column_titles' in formatting):
-                    ax[plot_index].title.set_text(formatting['column_titles'][i])
+            min_force = np.amin([min_force, d['hs_1_force'].min()])
+            max_force = np.amax([max_force, d['hs_1_force'].max()])
+
+            min_sc_length = np.amin([min_sc_length, d['sc_extension'].min()])
+            max_sc_length = np.amax([max_sc_length, d['sc_extension'].max()])
+
+            if (file_counter==1):
+                # Make the plots
+                for j in range(no_of_rows):
+                    ax.append(fig.add_subplot(spec[j,i]))
+
+            # Now plot
+            plot_index = (i*no_of_rows) + (pCa_row - 1)
+            ax[plot_index].plot(d['time'], d['hs_1_pCa'], '-',
+                                color = color_map[i],
+                                linewidth = formatting['data_linewidth'])
+            if ('column_titles' in formatting):
+                ax[plot_index].title.set_text(formatting['column_titles'][i])
                     
-                plot_index = (i*no_of_rows) + (hs_length_row - 1)
-                ax[plot_index].plot(d['time'], d['m_length'], 'k-',
-                                    linewidth = 1,
-                                    label = "M length")
-                ax[plot_index].plot(d['time'], d['hs_1_slack_length'], 'r-',
-                                    linewidth = 1,
-                                    label = "Slack length")
-                for hs in range(no_of_half_sarcomeres):
-                    hs_label = 'hs_%i_length' % (hs+1)
-                    ax[plot_index].plot(d['time'], d[hs_label], '-',
-                                    color = color_map[i],
-                                    linewidth = formatting['data_linewidth'])
-                # ax[plot_index].plot(d['time'], d['hs_1_command_length'], '--',
-                #                     color = color_map[i],
-                #                     linewidth = formatting['data_linewidth'])
+            plot_index = (i*no_of_rows) + (hs_length_row - 1)
+            ax[plot_index].plot(d['time'], d['m_length'], 'k-',
+                                linewidth = 1,
+                                label = "M length")
+            ax[plot_index].plot(d['time'], d['hs_1_slack_length'], 'r-',
+                                linewidth = 1,
+                                label = "Slack length")
+            for hs in range(no_of_half_sarcomeres):
+                hs_label = 'hs_%i_length' % (hs+1)
+                ax[plot_index].plot(d['time'], d[hs_label], '-',
+                                color = color_map[i],
+                                linewidth = formatting['data_linewidth'])
+            # ax[plot_index].plot(d['time'], d['hs_1_command_length'], '--',
+            #                     color = color_map[i],
+            #                     linewidth = formatting['data_linewidth'])
                 
-                if (no_of_rows == 7):
-                    plot_index = (i * no_of_rows) + (sc_length_row - 1)
-                    ax[plot_index].plot(d['time'], d['sc_extension'], '-',
-                                        color = color_map[i],
-                                        linewidth = formatting['data_linewidth'])
-
-                plot_index = (i * no_of_rows) + (force_row - 1)
-                ax[plot_index].plot(d['time'], d['hs_1_force'], '-',
+            if (no_of_rows == 7):
+                plot_index = (i * no_of_rows) + (sc_length_row - 1)
+                ax[plot_index].plot(d['time'], d['sc_extension'], '-',
                                     color = color_map[i],
-                                    linewidth = formatting['data_linewidth'],
-                                    label='Total')
+                                    linewidth = formatting['data_linewidth'])
+
+            plot_index = (i * no_of_rows) + (force_row - 1)
+            ax[plot_index].plot(d['time'], d['hs_1_force'], '-',
+                                color = color_map[i],
+                                linewidth = formatting['data_linewidth'],
+                                label='Total')
                 
-                for hs in range(no_of_half_sarcomeres):
-                    titin_label = 'hs_%i_titin_force' % (hs+1)
-                    plot_label = titin_label
-                    if (hs>0):
-                        plot_label = 'None'
+            for hs in range(no_of_half_sarcomeres):
+                titin_label = 'hs_%i_titin_force' % (hs+1)
+                plot_label = titin_label
+                if (hs>0):
+                    plot_label = 'None'
                 
-                    ax[plot_index].plot(d['time'], d[titin_label], ':',
-                                        color = color_map[i],
-                                        linewidth = formatting['data_linewidth'],
-                                        label=plot_label)
-
-                    viscous_label = 'hs_%i_viscous_force' % (hs+1)
-                    plot_label = viscous_label
-                    if (hs>0):
-                        plot_label = 'None'
-                    
-                    ax[plot_index].plot(d['time'], d[viscous_label], '--',
+                ax[plot_index].plot(d['time'], d[titin_label], ':',
                                     color = color_map[i],
                                     linewidth = formatting['data_linewidth'],
                                     label=plot_label)
 
-                # Now the a_states
-                # Deduce the number of states
-                a_pop_names = [col for col in d if ('_a_pop_' in col)]
-                no_of_a_states = int(len(a_pop_names) / no_of_half_sarcomeres)
+                viscous_label = 'hs_%i_viscous_force' % (hs+1)
+                plot_label = viscous_label
+                if (hs>0):
+                    plot_label = 'None'
+                    
+                ax[plot_index].plot(d['time'], d[viscous_label], '--',
+                                color = color_map[i],
+                                linewidth = formatting['data_linewidth'],
+                                label=plot_label)
+
+            # Now the a_states
+            # Deduce the number of states
+            a_pop_names = [col for col in d if ('_a_pop_' in col)]
+            no_of_a_states = int(len(a_pop_names) / no_of_half_sarcomeres)
                 
-                plot_index = (i * no_of_rows) + (thin_filament_row - 1)
-                for hs in range(no_of_half_sarcomeres):
-                    for a_counter in range(no_of_a_states):
-                        a_pop_string = ('hs_%i_a_pop_%i' %
-                                        (hs+1, a_counter+1))
-                        if ((file_counter == 1) and (hs==0)):
-                            label = a_pop_string
-                        else:
-                            label = None
+            plot_index = (i * no_of_rows) + (thin_filament_row - 1)
+            for hs in range(no_of_half_sarcomeres):
+                for a_counter in range(no_of_a_states):
+                    a_pop_string = ('hs_%i_a_pop_%i' %
+                                    (hs+1, a_counter+1))
+                    if ((file_counter == 1) and (hs==0)):
+                        label = a_pop_string
+                    else:
+                        label = None
             
-                        ax[plot_index].plot(d['time'], d[a_pop_string],
-                                '-',
-                                color = color_map[a_counter],
-                                linewidth = formatting['data_linewidth'],
-                                label=label)
-
-                # Now the m_states
-                # Deduce the number of states
-                m_pop_names = [col for col in d if ('_m_pop_' in col)]
-                no_of_m_states = int(len(m_pop_names) / no_of_half_sarcomeres)
-
-                plot_index = (i * no_of_rows) + (thick_filament_row - 1)
-                for hs in range(no_of_half_sarcomeres):
-                    for m_counter in range(no_of_m_states):
-                        m_pop_string = ('hs_%i_m_pop_%i' %
-                                        (hs+1, m_counter+1))
-                        if ((file_counter== 1) and (hs==0)):
-                            label = m_pop_string
-                        else:
-                            label = None
+                    ax[plot_index].plot(d['time'], d[a_pop_string],
+                            '-',
+                            color = color_map[a_counter],
+                            linewidth = formatting['data_linewidth'],
+                            label=label)
+
+            # Now the m_states
+            # Deduce the number of states
+            m_pop_names = [col for col in d if ('_m_pop_' in col)]
+            no_of_m_states = int(len(m_pop_names) / no_of_half_sarcomeres)
+
+            plot_index = (i * no_of_rows) + (thick_filament_row - 1)
+            for hs in range(no_of_half_sarcomeres):
+                for m_counter in range(no_of_m_states):
+                    m_pop_string = ('hs_%i_m_pop_%i' %
+                                    (hs+1, m_counter+1))
+                    if ((file_counter== 1) and (hs==0)):
+                        label = m_pop_string
+                    else:
+                        label = None
                             
-                        ax[plot_index].plot(d['time'], d[m_pop_string],
-                                            '-',
-                                            color = color_map[m_counter],
-                                            linewidth = formatting['data_linewidth'],
-                                            label=label)
+                    ax[plot_index].plot(d['time'], d[m_pop_string],
+                                        '-',
+                                        color = color_map[m_counter],
+                                        linewidth = formatting['data_linewidth'],
+                                        label=label)
                         
-                # Now the c_states
-                # Deduce the number of states
-                c_pop_names = [col for col in d if ('_c_pop_' in col)]
-                no_of_m_states = int(len(c_pop_names) / no_of_half_sarcomeres)
-
-                plot_index = (i * no_of_rows) + (mybpc_row - 1)
-                for hs in range(no_of_half_sarcomeres):
-                    for c_counter in range(no_of_m_states):
-                        c_pop_string = ('hs_%i_c_pop_%i' %
-                                        (hs+1, c_counter+1))
-                        if ((file_counter== 1) and (hs==0)):
-                            label = c_pop_string
-                        else:
-                            label = None
+            # Now the c_states
+            # Deduce the number of states
+            c_pop_names = [col for col in d if ('_c_pop_' in col)]
+            no_of_m_states = int(len(c_pop_names) / no_of_half_sarcomeres)
+
+            plot_index = (i * no_of_rows) + (mybpc_row - 1)
+            for hs in range(no_of_half_sarcomeres):
+                for c_counter in range(no_of_m_states):
+                    c_pop_string = ('hs_%i_c_pop_%i' %
+                                    (hs+1, c_counter+1))
+                    if ((file_counter== 1) and (hs==0)):
+                        label = c_pop_string
+                    else:
+                        label = None
                             
-                        ax[plot_index].plot(d['time'], d[c_pop_string],
-                                            '-',
-                                            color = color_map[c_counter],
-                                            linewidth = formatting['data_linewidth'],
-                                            label=label)
+                    ax[plot_index].plot(d['time'], d[c_pop_string],
+                                        '-',
+                                        color = color_map[c_counter],
+                                        linewidth = formatting['data_linewidth'],
+                                        label=label)
 
-                # Update counter
-                file_counter = file_counter + 1
+            # Update counter
+            file_counter = file_counter + 1
 
         # Handle formatting
         if (i==0):
@@ -2218,55 +2248,74 @@ def create_k_tr_analysis_figure(fig_data, batch_file_string):
     sims['raw'] = []
     sims['fit'] = []
 
+    # And lists of the data to fit
+    fit_x = []
+    fit_y = []
+
+    # Find the results files for each curve
+    curve_files = sim_catalog.return_curve_files(top_data_folder)
+
     while keep_going:
-        curve_folder = os.path.join(top_data_folder,
-                                    ('%i' % curve_counter))
-        if (os.path.isdir(curve_folder)):
-            # Find the results files
-            for file in os.listdir(curve_folder):
-                if (file.endswith('.txt') and not file.startswith('rates')):
-                    data_file_string = os.path.join(curve_folder, file)
-
-                    # Load up the results file
-                    d = pd.read_csv(data_file_string, delimiter='\t')
-
-                    # Filter to fit time_interval
-                    d_fit = d.loc[(d['time'] >= fig_data['k_tr_fit_time_s'][0]) &
-                                  (d['time'] <= fig_data['k_tr_fit_time_s'][-1])].copy()
-
-                    # Pull off time offset
-                    x = d_fit['time'].to_numpy()
+
+        if (curve_counter in curve_files):
+            for data_file_string in curve_files[curve_counter]:
+                # Load up the results file
+                d = rf.load_results(data_file_string,
+                                    columns=['time', 'hs_1_force',
+                                             'hs_1_pCa', 'hs_1_length',
+                                             'hs_1_command_length'])
+
+                # Filter to fit time_interval
+                d_fit = d.loc[(d['time'] >= fig_data['k_tr_fit_time_s'][0]) &
+                              (d['time'] <= fig_data['k_tr_fit_time_s'][-1])].copy()
+
+                # Pull off time offset
+                x = d_fit['time'].to_numpy()
+                if (len(x) > 0):
                     x = x - x[0]
-                    y = d_fit['hs_1_force'].to_numpy()
-                    try:
-                        k_tr_data = cv.fit_exponential_recovery(x,y)
-                    except:
-                        k_tr_data = dict()
-                        k_tr_data['k'] = np.nan
-                        k_tr_data['amp'] = np.nan
-                        k_tr_data['x_fit'] = x
-                        k_tr_data['y_fit'] = y
-
-                    # Store some values
-                    curve.append(curve_counter)
-                    force.append(d['hs_1_force'].iloc[-1])
-                    k_tr.append(k_tr_data['k'])
-                    k_tr_amp.append(k_tr_data['amp'])
-                    pCa.append(d['hs_1_pCa'].iloc[-1])
-                    hs_length.append(d['hs_1_length'].iloc[-1])
-                    k_tr_r_squared.append(k_tr_data['r_squared'])
-
-                    d_fit['x_fit'] = k_tr_data['x_fit'] + d_fit['time'].iloc[0]
-                    d_fit['y_fit'] = k_tr_data['y_fit']
-
-                    sims['raw'].append(d)
-                    sims['fit'].append(d_fit)
+                y = d_fit['hs_1_force'].to_numpy()
+                fit_x.append(x)
+                fit_y.append(y)
+
+                # Store some values
+                curve.append(curve_counter)
+                force.append(d['hs_1_force'].iloc[-1])
+                pCa.append(d['hs_1_pCa'].iloc[-1])
+                hs_length.append(d['hs_1_length'].iloc[-1])
+
+                sims['raw'].append(d)
+                sims['fit'].append(d_fit)
 
             curve_counter = curve_counter + 1
 
         else:
             keep_going = False
 
+    # Fit all the recoveries together. Curves that cannot be fitted are
+    # given NaN values by the batch fit, so this only catches failures
+    # of the batch as a whole
+    try:
+        k_tr_fits = cv.fit_exponential_recovery_batch(fit_x, fit_y)
+    except Exception:
+        k_tr_fits = []
+        for (x, y) in zip(fit_x, fit_y):
+            k_tr_data = dict()
+            k_tr_data['k'] = np.nan
+            k_tr_data['amp'] = np.nan
+            k_tr_data['x_fit'] = x
+            k_tr_data['y_fit'] = y
+            k_tr_data['r_squared'] = np.nan
+            k_tr_fits.append(k_tr_data)
+
+    for (k_tr_data, d_fit) in zip(k_tr_fits, sims['fit']):
+        k_tr.append(k_tr_data['k'])
+        k_tr_amp.append(k_tr_data['amp'])
+        k_tr_r_squared.append(k_tr_data['r_squared'])
+
+        if (len(d_fit) > 0):
+            d_fit['x_fit'] = k_tr_data['x_fit'] + d_fit['time'].iloc[0]
+            d_fit['y_fit'] = k_tr_data['y_fit']
+
     # Make a dataframe from the lists
     r = pd.DataFrame({'curve': curve,
                       'pCa': pCa,
@@ -2401,4 +2450,6 @@ def create_k_tr_analysis_figure(fig_data, batch_file_string):
             print('Saving k_tr_figure to: %s' % ofs)
             fig.savefig(ofs, dpi=200, bbox_inches='tight')
 
-    plt.close()
\ No newline at end of file
+    plt.close()
+
+    return {'simulation_data': r}
\ No newline at end of file
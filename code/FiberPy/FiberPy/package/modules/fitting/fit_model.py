@@ -6,17 +6,13 @@ Created on Tue Jan 23 17:36:17 2024
 """
 
 import os
-import re
 import json
+import time
 import shutil
-import copy
 import subprocess
 
 import concurrent.futures
 
-import emcee
-import corner
-
 import numpy as np
 import pandas as pd
 
@@ -27,13 +23,15 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
-from ..batch import batch
-
-from ..characterize import characterize_model
+from . import fit_workers
+from . import progress_log
+from . import swarm as swarm_lib
+from . import surrogate as surrogate_lib
 
-def fit_model(json_analysis_file_string):
+def fit_model(json_analysis_file_string, resume=False):
     """ Code takes a setup file with a model/fitting section, and
-        tries to fit the model to data """
+        tries to fit the model to data. If resume is True, the fit
+        continues from the files in the progress folder """
     
     # Check the analysis file
     if (not json_analysis_file_string):
@@ -78,12 +76,13 @@ def fit_model(json_analysis_file_string):
                                    fitting_struct['progress_folder'])
     progress_dir = str(Path(progress_dir).resolve().absolute())
     
-    # Clean progress_dir
-    try:
-        print('Trying to clean: %s' % progress_dir)
-        shutil.rmtree(progress_dir, ignore_errors = True)
-    except OSError as e:
-        print('Error: %s : %s' % (progress_dir, e.strerror))
+    # Clean progress_dir, unless the fit is being resumed
+    if not resume:
+        try:
+            print('Trying to clean: %s' % progress_dir)
+            shutil.rmtree(progress_dir, ignore_errors = True)
+        except OSError as e:
+            print('Error: %s : %s' % (progress_dir, e.strerror))
         
     # Check the progress dir is there
     if not os.path.isdir(progress_dir):
@@ -100,30 +99,103 @@ def fit_model(json_analysis_file_string):
                                                          'progress.xlsx')
     progress_data['best_file_string'] = os.path.join(progress_dir,
                                                      'best.xlsx')
-       
-    if (fitting_struct['single_run'] == 'True'):
-        run_single(p, json_analysis_file_string, progress_data)
-        exit(1)
     
-    # Set up the optimizer
-    if (fitting_struct['optimizer'] == 'particle_swarm'):
-        pso(p, json_analysis_file_string, progress_data)
-    elif (fitting_struct['optimizer'] == 'emcee'):
-        emcee_analysis(p, json_analysis_file_string, progress_data)
+    # Trials are appended to logs. The Excel files and the progress
+    # figure are updated from the logs at most every progress_interval_s
+    progress_data['progress_log'] = progress_log.progress_log(
+        os.path.join(progress_dir, 'progress.jsonl'))
+    progress_data['best_log'] = progress_log.progress_log(
+        os.path.join(progress_dir, 'best.jsonl'))
+    if ('progress_interval_s' in fitting_struct):
+        progress_data['progress_interval_s'] = \
+            fitting_struct['progress_interval_s']
     else:
-        bnds = []
-        for i in range(no_of_parameters):
-            bnds.append(tuple([0, 1]))
-        bnds = tuple(bnds)
-        
-        minimize(run_single, p, (json_analysis_file_string, progress_data),
-                 method=fitting_struct['optimizer'],
-                 bounds=bnds)
-        
-def emcee_analysis(p_vector, json_analysis_file_string, progress_data,
+        progress_data['progress_interval_s'] = 60
+    progress_data['last_progress_time'] = -np.inf
+    progress_data['resume'] = resume
+    
+    # The best thread is copied once its figures have been made
+    progress_data['best_thread'] = None
+    
+    # If the fit is being resumed, carry on from the logs, starting
+    # from the best fit so far
+    if resume:
+        no_of_trials = len(progress_data['progress_log'].entries)
+        progress_data['iteration'] = no_of_trials + 1
+        if progress_data['best_log'].entries:
+            best_entry = progress_data['best_log'].entries[-1]
+            progress_data['lowest_error'] = best_entry['error_total']
+            p = np.asarray([best_entry['p_%i' % (i+1)]
+                            for i in range(no_of_parameters)])
+            progress_data['best_p_vector'] = p
+        print('Resuming fit after %i trials' % no_of_trials)
+       
+    # Start the workers that run the simulations. By default, there is
+    # one for each particle or walker
+    if ('max_workers' in fitting_struct):
+        max_workers = fitting_struct['max_workers']
+    elif (fitting_struct['single_run'] == 'True'):
+        max_workers = 1
+    elif (fitting_struct['optimizer'] in ['particle_swarm', 'emcee']):
+        max_workers = round(2 * no_of_parameters)
+    elif (fitting_struct['optimizer'] == 'surrogate'):
+        max_workers = max(2, no_of_parameters)
+    else:
+        max_workers = 1
+    
+    pool = fit_workers.fit_worker_pool(json_analysis_file_string,
+                                       max_workers=max_workers)
+    
+    try:
+        if (fitting_struct['single_run'] == 'True'):
+            run_single(p, pool, progress_data)
+            return
+        
+        # Set up the optimizer
+        if (fitting_struct['optimizer'] == 'particle_swarm'):
+            pso_options = dict()
+            if ('swarm_strategy' in fitting_struct):
+                pso_options['strategy'] = fitting_struct['swarm_strategy']
+            if ('asynchronous_swarm' in fitting_struct):
+                pso_options['asynchronous'] = \
+                    (fitting_struct['asynchronous_swarm'] == 'True')
+            pso(p, pool, progress_data, **pso_options)
+        elif (fitting_struct['optimizer'] == 'emcee'):
+            emcee_analysis(p, pool, progress_data)
+        elif (fitting_struct['optimizer'] == 'surrogate'):
+            surrogate_options = dict()
+            for k in ['surrogate_batch_size', 'surrogate_initial_points',
+                      'max_evaluations']:
+                if (k in fitting_struct):
+                    surrogate_options[k] = fitting_struct[k]
+            surrogate(p, pool, progress_data, **surrogate_options)
+        else:
+            bnds = []
+            for i in range(no_of_parameters):
+                bnds.append(tuple([0, 1]))
+            bnds = tuple(bnds)
+            
+            minimize(run_single, p, (pool, progress_data),
+                     method=fitting_struct['optimizer'],
+                     bounds=bnds)
+    finally:
+        pool.close()
+        write_progress(progress_data, force=True)
+        
+def emcee_analysis(p_vector, pool, progress_data,
                   f_particles = 2,
                   max_iterations = 500):
     """ Run a Markov chain Monte Carlo (MCMC) Ensemble sampler """
+    
+    # These are only needed for MCMC, and are slow to import
+    import emcee
+    import corner
+    
+    # The chain is only valid if the log-likelihood does not change as
+    # it runs, so every batch is run at full fidelity
+    if pool.fidelity_schedule:
+        print('emcee: ignoring the fidelity_schedule')
+        pool.fidelity_schedule = []
         
     # Set the number of walkers
     no_of_dim = len(p_vector)
@@ -143,7 +215,16 @@ def emcee_analysis(p_vector, json_analysis_file_string, progress_data,
     backend = emcee.backends.HDFBackend(
         progress_data['mcmc_progress_file_string'])
     
-    backend.reset(no_of_walkers, no_of_dim)
+    # The backend holds the chain and the state of the random number
+    # generator, so a resumed fit continues from the last sample
+    if (progress_data['resume'] and os.path.isfile(
+            progress_data['mcmc_progress_file_string']) and
+            (backend.iteration > 0)):
+        pos = backend.get_last_sample()
+        max_iterations = max_iterations - backend.iteration
+        print('Resuming MCMC from iteration %i' % backend.iteration)
+    else:
+        backend.reset(no_of_walkers, no_of_dim)
     
     # Set up a file for the corner plot
     progress_data['mcmc_corner_file_string'] = os.path.join(
@@ -158,7 +239,7 @@ def emcee_analysis(p_vector, json_analysis_file_string, progress_data,
                     (emcee.moves.DEMove(), 0.8),
                     (emcee.moves.DESnookerMove(), 0.2)],
                 vectorize=True,
-                args=(json_analysis_file_string, progress_data))
+                args=(pool, progress_data))
     
     # Run
     burnin = 0
@@ -186,7 +267,7 @@ def log_prior(p_vector):
     else:
         return 0
 
-def emcee_walker(p_array, json_analysis_file_string, progress_data):
+def emcee_walker(p_array, pool, progress_data):
     """ Evaluates the system for an array of p_vectors """
     
     # Work out the size of the system
@@ -207,8 +288,7 @@ def emcee_walker(p_array, json_analysis_file_string, progress_data):
             lp[i] = -np.inf
     
     # Now do the FiberSim evaluation
-    least_squares_e = evaluate_positions(p_array, json_analysis_file_string,
-                                         progress_data)
+    least_squares_e = evaluate_positions(p_array, pool, progress_data)
     
     print(least_squares_e)
             
@@ -241,7 +321,7 @@ def test_function2(p):
     return e
     
         
-def pso(p_vector, json_analysis_file_string, progress_data,
+def pso(p_vector, pool, progress_data,
         f_particles = 2, bounds = [0, 1],
         inertia = 0.9, w_self = 0.5, w_family = 0.3,
         initial_vel = 0.1,
@@ -251,757 +331,487 @@ def pso(p_vector, json_analysis_file_string, progress_data,
         jitter = 0.03,
         throw = 1000,
         resize_bounds = 15,
-        resize_bounds_factor = 0.75):
+        resize_bounds_factor = 0.75,
+        strategy = 'global',
+        asynchronous = False):
+    """ Runs a particle swarm optimization. If asynchronous is True, each
+        particle is moved, and evaluated again, as soon as its last
+        evaluation finishes, rather than waiting for the whole swarm """
     
     # Set the number of particles
     n_particles = round(f_particles * len(p_vector))
     
-    # Set the initial values
-    rng = np.random.default_rng()
-    x = bounds[0] + (bounds[1] - bounds[0]) * \
-            rng.random([n_particles, len(p_vector)])
-    x[0,:] = p_vector
-    
-    # Set bounds for each parameter
-    x_bounds = np.zeros([len(p_vector), 2])
-    x_bounds[:, 0] = bounds[0]
-    x_bounds[:, 1] = bounds[1]
+    # Create the swarm
+    swarm = swarm_lib.particle_swarm(
+        p_vector, n_particles,
+        bounds = bounds,
+        inertia = inertia, w_self = w_self, w_family = w_family,
+        initial_vel = initial_vel,
+        vel_bounds = vel_bounds,
+        vel_factor = vel_factor,
+        jitter = jitter,
+        throw = throw,
+        resize_bounds = resize_bounds,
+        resize_bounds_factor = resize_bounds_factor,
+        strategy = strategy)
+    
+    # The swarm is written to a checkpoint after each iteration. A
+    # resumed fit restores the swarm, including its random number
+    # generator, from the checkpoint
+    checkpoint_file_string = os.path.join(progress_data['progress_folder'],
+                                          'swarm_checkpoint.json')
+    if (progress_data['resume'] and os.path.isfile(checkpoint_file_string)):
+        swarm.load_checkpoint(checkpoint_file_string)
+        print('Resuming swarm from iteration %i' % swarm.iteration)
+        
+        # Each iteration is one scheduled batch, so the fidelity
+        # schedule carries on from the same place
+        pool.no_of_batches = swarm.iteration
+    else:
+        swarm.save_checkpoint(checkpoint_file_string)
     
     # Add the bounds to the progress data
-    progress_data['x_bounds'] = x_bounds
-
-    # Set the initial values
-    global_best_value = np.Inf
-    global_best_x = np.NaN * np.ones(len(p_vector))
-    particle_best_value = np.Inf * np.ones(n_particles)
-    particle_best_x = np.NaN * np.ones([n_particles, len(p_vector)])
-    v = initial_vel * np.ones([n_particles, len(p_vector)])
-    particle_max_vel = vel_bounds[-1] * np.ones(n_particles)
-
-    
-    # Open the analysis_file_string and check for thread_folder
-    with open(json_analysis_file_string, 'r') as f:
-        json_data = json.load(f)
-    
-    # We are going to run simulations in parallel
+    progress_data['x_bounds'] = swarm.x_bounds
+    
+    if asynchronous:
+        # Each particle is submitted on its own, so the asynchronous
+        # swarm always runs at full fidelity
+        swarm.set_fidelity_level(0)
+        run_asynchronous_swarm(swarm, pool, progress_data,
+                               no_of_iterations, checkpoint_file_string)
+        return
+    
+    # If the fit stopped after the current positions were evaluated, but
+    # before the checkpoint was written, the errors are in the log
+    reuse_log = progress_data['resume']
+
+    while (swarm.iteration < no_of_iterations):
+        
+        # Errors at different fidelity levels cannot be compared, so the
+        # bests are reset when the fidelity schedule moves on
+        swarm.set_fidelity_level(
+            pool.return_fidelity_level(pool.no_of_batches))
+        
+        # Run the simulations and evaluate the fits
+        particle_values = evaluate_positions(swarm.x, pool, progress_data,
+                                             reuse_log=reuse_log)
+        reuse_log = False
+        swarm.record(np.arange(n_particles), particle_values)
+        
+        # Keep the candidates that were run again at full fidelity
+        promoted = progress_data['promoted_indices']
+        swarm.record_promoted(promoted, progress_data['promoted_values'],
+                              swarm.x[promoted, :])
+                
+        for i in range(n_particles):
+            print("particle_best_value[%i]: %g" %
+                  (i, swarm.particle_best_value[i]))
+            print(swarm.particle_best_x[i,:])
+                
+        # Update, resizing the bounds or throwing particles when required
+        swarm.update()
+        swarm.end_iteration()
+        swarm.save_checkpoint(checkpoint_file_string)
+        
+        progress_data['x_bounds'] = swarm.x_bounds
+
+def return_logged_errors(p_array, progress_data, fidelity_level=0):
+    """ Looks up the rows of p_array in the progress log, matching the
+        position and the fidelity level, and returns a tuple with an
+        array of the logged errors and an array that is True for the
+        rows that were found """
+    
+    p_array = np.array(p_array, dtype=float, ndmin=2)
+    p_labels = ['p_%i' % (j+1) for j in range(p_array.shape[1])]
+    
+    # Index the log by position. Positions are written to the log
+    # exactly, so they can be matched exactly
+    logged = dict()
+    for e in progress_data['progress_log'].entries:
+        if ('fidelity_level' in e):
+            e_level = e['fidelity_level']
+        else:
+            e_level = 0
+        if (e_level == fidelity_level):
+            logged[tuple(e[k] for k in p_labels)] = e['error_total']
+    
+    values = np.nan * np.ones(p_array.shape[0])
+    found = np.zeros(p_array.shape[0], dtype=bool)
+    for i in range(p_array.shape[0]):
+        key = tuple(p_array[i, :].tolist())
+        if (key in logged):
+            values[i] = logged[key]
+            found[i] = True
+    
+    return (values, found)
+
+def run_asynchronous_swarm(swarm, pool, progress_data, no_of_iterations,
+                           checkpoint_file_string):
+    """ Runs a swarm, moving each particle and starting its next
+        evaluation as soon as it finishes. An iteration is counted for
+        every n_particles evaluations, and a checkpoint is written after
+        each evaluation """
+    
+    n_particles = swarm.n_particles
+    no_of_evaluations = no_of_iterations * n_particles
+    
+    # Evaluations that were running when a fit stopped are started again
+    # from the checkpoint
+    no_of_submitted = swarm.no_of_evaluations
+    running = dict()
+    
+    # Particles waiting for the figures in their thread to be made
+    # before they are evaluated again, keyed by the figure future
+    held = dict()
+    
+    def submit(i):
+        # Start an evaluation for a particle, noting the particle, its
+        # position and the epoch of the swarm
+        nonlocal no_of_submitted
+        if (no_of_submitted < no_of_evaluations):
+            f = pool.submit((i+1), swarm.x[i, :])
+            running[f] = (i, swarm.x[i, :].copy(), swarm.epoch)
+            no_of_submitted = no_of_submitted + 1
+    
+    def finish(i, x, epoch, value):
+        # Record an evaluation, move the particle and evaluate it again
+        swarm.record(i, value, x=x, epoch=epoch)
+        
+        swarm.no_of_evaluations = swarm.no_of_evaluations + 1
+        if ((swarm.no_of_evaluations % n_particles) == 0):
+            swarm.end_iteration()
+            progress_data['x_bounds'] = swarm.x_bounds
+        
+        if (no_of_submitted < no_of_evaluations):
+            swarm.update(i)
+            f = pool.return_figure_future(i+1)
+            if (f is None):
+                submit(i)
+            else:
+                held[f] = i
+        
+        # Write the checkpoint once the particle has moved
+        swarm.save_checkpoint(checkpoint_file_string)
     
-    # Deduce the base directory
-    model_struct = json_data['FiberSim_setup']['model']
-    if (model_struct['relative_to'] == 'this_file'):
-        model_base_dir = Path(json_analysis_file_string).parent.absolute()
+    # A particle whose evaluation was logged, but not checkpointed,
+    # before the fit stopped does not have to be run again
+    if progress_data['resume']:
+        (logged_values, found) = return_logged_errors(swarm.x,
+                                                      progress_data)
     else:
-        model_base_dir = model_struct['relative_to']
+        found = np.zeros(n_particles, dtype=bool)
     
-    # Work out the char structure
-    char_struct = json_data['FiberSim_setup']['characterization'][0]
-    
-    print(char_struct)
+    for i in range(n_particles):
+        if found[i]:
+            print('Using the logged error for particle %i' % (i+1))
+            no_of_submitted = no_of_submitted + 1
+            finish(i, swarm.x[i, :].copy(), swarm.epoch, logged_values[i])
+        else:
+            submit(i)
     
-    for iter in range(no_of_iterations):
-        
-        # Set the thread_dir, try to clean it, make it if necessary
-        thread_dir = json_data['FiberSim_setup']['model']['fitting']['thread_folder']
-        thread_dir = str(Path(os.path.join(model_base_dir, thread_dir)).resolve())
+    while running or held:
         
-        try:
-            print('Trying to clean: %s' % thread_dir)
-            shutil.rmtree(thread_dir, ignore_errors = True)
-        except OSError as e:
-            print('Error: %s : %s' % (thread_dir, e.strerror))
+        (done, not_done) = concurrent.futures.wait(
+            list(running) + list(held),
+            return_when=concurrent.futures.FIRST_COMPLETED)
         
-        # Check the thread dir is there
-        if not os.path.isdir(thread_dir):
-            os.makedirs(thread_dir)
-            
-        # Create an array of parameter sets
-        pars = []
-        for i in range(n_particles):
-            par_set = dict()
-            par_set['id'] = (i+1)
-            par_set['x'] = x[i,:]
-            par_set['json_analysis_file_string'] = json_analysis_file_string
-            par_set['thread_space'] = \
-                str(Path(os.path.join(thread_dir,
-                                      ('thread_%i' % (i+1)))).resolve())
-            par_set['model_base_dir'] = model_base_dir
-            par_set['sim_folder'] = return_sim_dir(char_struct)
-            par_set['Python_objective_call'] = \
-                model_struct['fitting']['Python_objective_call']
-            if ('Python_best_call' in model_struct['fitting']):
-                par_set['Python_best_call'] = \
-                    model_struct['fitting']['Python_best_call']                    
-            pars.append(par_set)
-
-        # Run the simulation            
-        with concurrent.futures.ThreadPoolExecutor(max_workers = 100) as executor:
-            executor.map(thread_worker, pars)
-            
-        # Now analyze the simulations
-        for i in range(n_particles):
-            print('Evaluating fit for particle: %i' % (i+1))
-            
-            # Need to run this in series
-            series_setup_file_string = str(Path(os.path.join(
-                pars[i]['thread_space'],
-                'working',
-                'series_setup.json')).resolve())
-            characterize_model.characterize_model(series_setup_file_string)
-            particle_value = thread_evaluate(pars[i], progress_data)
-                
-            if (particle_value < particle_best_value[i]):
-                particle_best_value[i] = particle_value
-                particle_best_x[i,:] = copy.deepcopy(x[i,:])
-            
-            if (particle_best_value[i] < global_best_value):
-                global_best_value = particle_best_value[i]
-                global_best_x = copy.deepcopy(x[i,:])
-                
-        for i in range(n_particles):
-            print("particle_best_value[%i]: %g" % (i, particle_best_value[i]))
-            print(particle_best_x[i,:])
-                
-            # Update
-            for i in range(n_particles):
-                for j in range(len(p_vector)):
-                    
-                    v[i,j] = inertia*v[i,j] + \
-                        w_self * rng.random() * (particle_best_x[i,j] - x[i,j]) + \
-                        w_family * rng.random() * (global_best_x[j] - x[i,j])
-                    
-                    if (v[i,j] > particle_max_vel[i]):
-                        v[i,j] = particle_max_vel[i]
-                    if (v[i,j] < -particle_max_vel[i]):
-                        v[i,j]  = -particle_max_vel[i]
-                    
-                    x[i,j] = x[i,j] + v[i,j]
-                    
-                    # Add in some jitter
-                    x[i,j] = x[i,j] + jitter * (rng.random() - 0.5)
-                    
-                    if (x[i,j] < x_bounds[j, 0]):
-                        x[i,j] = x_bounds[j, 0]
-                    if (x[i,j] > x_bounds[j, 1]):
-                        x[i,j] = x_bounds[j, 1]
-                        
-                particle_max_vel[i] = particle_max_vel[i] * vel_factor
-                if (particle_max_vel[i] < vel_bounds[0]):
-                    particle_max_vel[i] = vel_bounds[0]
-                    
-        # Resize bounds if appropriate
-        if ((iter % resize_bounds) == (resize_bounds-1)):
-            # Adjust the bounds
-            for i in range(len(p_vector)):
-                
-                x_old_range = (x_bounds[i, 1] - x_bounds[i, 0])
-                x_new_range = resize_bounds_factor * x_old_range
-                
-                # Try to center the range around the best point
-                x_bounds[i, 0] = global_best_x[i] - (0.5 * x_new_range)
-                x_bounds[i, 1] = global_best_x[i] + (0.5 * x_new_range)
-                
-                # If you are clipping, preserve the range
-                if (x_bounds[i, 0] < bounds[0]):
-                    x_bounds[i, 0] = bounds[0]
-                    x_bounds[i, 1] = bounds[0] + x_new_range
-                    
-                if (x_bounds[i, 1] > bounds[1]):
-                    x_bounds[i, 1] = bounds[1]
-                    x_bounds[i, 0] = bounds[1] - x_new_range
+        # Record the finished particles in thread order. The best
+        # thread is copied once its figures have been made, so the
+        # swarm does not wait for them
+        for f in sorted([f for f in done if f in running],
+                        key=lambda f: running[f][0]):
+            (i, x, epoch) = running.pop(f)
             
-            # Now reset particles within the bounds
-            for i in range(n_particles):
-                for j in range(len(p_vector)):
-                    x[i, j] = x_bounds[j, 0] + (rng.random() *
-                                                (x_bounds[j, 1] - x_bounds[j, 0]))
-                
-                particle_best_value[i] = np.Inf
-                particle_best_x[i,:] = x[i,:]
-                particle_max_vel[i] = resize_bounds_factor * particle_max_vel[i]
-            
-            progress_data['x_bounds'] = x_bounds
-       
+            pars = pool.return_pars((i+1), x)
+            pars['figures'] = False
+            value = record_evaluations([(pars, f.result())], pool,
+                                       progress_data,
+                                       wait_for_figures=False)[0]
+            finish(i, x, epoch, value)
+        
+        # Copy the best thread, if its figures are ready, before the
+        # particles that were waiting for their figures run again
+        copy_best_thread(progress_data)
+        for f in [f for f in done if f in held]:
+            submit(held.pop(f))
+    
+    copy_best_thread(progress_data, wait=True)
                     
-        # Throw
-        if ((iter % throw) == (throw-1)):
-            # Throw out 1/3 of particles
-            for i in range(round(n_particles / 3)):
-                for j in range(len(p_vector)):
-                    x[i,j] = rng.random()
-                    v[i,j] = 0
-                particle_best_value[i] = np.Inf
-                particle_best_x[i,:] = x[i,:]
-                particle_max_vel[i] = vel_bounds[-1]
-                    
-                    
-def run_single(p_vector, json_analysis_file_string, progress_data):
-    """ Runs a single evaluation as a thread """
+def surrogate(p_vector, pool, progress_data,
+              surrogate_batch_size = None,
+              surrogate_initial_points = None,
+              max_evaluations = 200):
+    """ Fits a Gaussian process to the errors in the progress log and
+        runs simulations for batches of candidates chosen by expected
+        improvement, until max_evaluations trials have been run """
+    
+    no_of_parameters = len(p_vector)
+    
+    # By default, each batch fills the pool
+    if (surrogate_batch_size is None):
+        surrogate_batch_size = pool.max_workers
+    if (surrogate_initial_points is None):
+        surrogate_initial_points = (2 * no_of_parameters) + 1
+    
+    # A checkpoint is written after each batch with the seed, the state
+    # of the random number generator and the number of trials in the
+    # log. A resumed fit rebuilds the same design from the seed and
+    # proposes the same batches from the same trials
+    checkpoint_file_string = os.path.join(progress_data['progress_folder'],
+                                          'surrogate_checkpoint.json')
+    if (progress_data['resume'] and os.path.isfile(checkpoint_file_string)):
+        with open(checkpoint_file_string, 'r') as f:
+            state = json.load(f)
+        if (state['no_of_trials'] is None):
+            print('Resuming surrogate from the initial design')
+        else:
+            print('Resuming surrogate after %i trials' %
+                  state['no_of_trials'])
+    else:
+        state = dict()
+        state['seed'] = np.random.SeedSequence().entropy
+        state['rng'] = None
+        state['no_of_trials'] = None
+        state['no_of_batches'] = 0
+        save_surrogate_checkpoint(checkpoint_file_string, state)
+    
+    # The design and the proposals use separate streams from the seed
+    (design_seed, proposal_seed) = \
+        np.random.SeedSequence(state['seed']).spawn(2)
+    rng = np.random.default_rng(proposal_seed)
+    if (state['rng'] is not None):
+        rng.bit_generator.state = state['rng']
+    pool.no_of_batches = state['no_of_batches']
+    
+    # The first batch after a resume may already be in the log
+    reuse_log = progress_data['resume']
+    
+    # Start with the initial guess and a Latin hypercube. scipy.stats
+    # is slow to import, so it is only imported when it is needed
+    if (state['no_of_trials'] is None):
+        from scipy.stats import qmc
+        sampler = qmc.LatinHypercube(d=no_of_parameters,
+                                     seed=np.random.default_rng(design_seed))
+        p_array = np.vstack((p_vector,
+                             sampler.random(surrogate_initial_points - 1)))
+        evaluate_positions(p_array, pool, progress_data,
+                           reuse_log=reuse_log)
+        reuse_log = False
+        
+        state['rng'] = rng.bit_generator.state
+        state['no_of_trials'] = len(progress_data['progress_log'].entries)
+        state['no_of_batches'] = pool.no_of_batches
+        save_surrogate_checkpoint(checkpoint_file_string, state)
+    
+    p_labels = ['p_%i' % (i+1) for i in range(no_of_parameters)]
+    
+    while True:
+        
+        # Only use the trials that were in the log when the checkpoint
+        # was written, so that a resumed fit sees the same data
+        no_of_trials = state['no_of_trials']
+        if (no_of_trials >= max_evaluations):
+            break
+        
+        # Fit to the log of the errors, which span orders of magnitude
+        d = pd.DataFrame(
+            progress_data['progress_log'].entries[0:no_of_trials])
+        d = d[np.isfinite(d['error_total'])]
+        if ('fidelity_level' in d.columns):
+            d = d[~(d['fidelity_level'] > 0)]
+        
+        X = d[p_labels].to_numpy(dtype=float)
+        y = np.log10(np.maximum(d['error_total'].to_numpy(dtype=float),
+                                np.finfo(float).tiny))
+        
+        batch_size = min(surrogate_batch_size,
+                         max_evaluations - no_of_trials)
+        p_array = surrogate_lib.propose_batch(
+            X, y, batch_size, rng=rng, no_of_dimensions=no_of_parameters)
+        
+        print('surrogate: %i trials, lowest error: %g' %
+              (no_of_trials, progress_data['lowest_error']))
+        
+        evaluate_positions(p_array, pool, progress_data,
+                           reuse_log=reuse_log)
+        reuse_log = False
+        
+        state['rng'] = rng.bit_generator.state
+        state['no_of_trials'] = len(progress_data['progress_log'].entries)
+        state['no_of_batches'] = pool.no_of_batches
+        save_surrogate_checkpoint(checkpoint_file_string, state)
+
+def save_surrogate_checkpoint(checkpoint_file_string, state):
+    """ Writes the state of the surrogate optimizer to a file, replacing
+        the previous checkpoint only once the new one is complete """
+    
+    temp_file_string = '%s.tmp' % checkpoint_file_string
+    with open(temp_file_string, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_file_string, checkpoint_file_string)
+
+def run_single(p_vector, pool, progress_data):
+    """ Runs a single evaluation """
     
     print('\nrun_single')
-    print(json_analysis_file_string)
-    print('\n')
-    
     print(p_vector)
     
-    with open(json_analysis_file_string, 'r') as f:
-        json_data = json.load(f)
-        model_struct = json_data['FiberSim_setup']['model']
-        fitting_struct = model_struct['fitting']
-
-    # Deduce the base directory
-    model_struct = json_data['FiberSim_setup']['model']
-    if (model_struct['relative_to'] == 'this_file'):
-        model_base_dir = str(Path(json_analysis_file_string).parent.absolute())
-    else:
-        model_base_dir = model_struct['relative_to']
-
-
-    # Clean thread folder
-    char_struct = json_data['FiberSim_setup']['characterization'][0]
-    if (not char_struct['figures_only'] == 'True'):
-        thread_dir = str(Path(os.path.join(model_base_dir,
-                                           fitting_struct['thread_folder'])).resolve())
-        try:
-            print('Trying to clean: %s' % thread_dir)
-            shutil.rmtree(thread_dir, ignore_errors = True)
-        except OSError as e:
-            print('Error: %s : %s' % (thread_dir, e.strerror))
-            
-        # Check the progress dir is there
-        if not os.path.isdir(thread_dir):
-            os.makedirs(thread_dir)
-
-    # Run a simulation as a single thread
-    pars = dict()
-    pars['id'] = 1
-    pars['x'] = p_vector
-    pars['json_analysis_file_string'] = json_analysis_file_string
-    pars['thread_space'] = \
-        str(Path(os.path.join(model_base_dir,
-                              fitting_struct['thread_folder'],
-                              'thread_1')).resolve())
-    pars['model_base_dir'] = model_base_dir
-    pars['sim_folder'] = return_sim_dir(char_struct)
-    pars['Python_objective_call'] = \
-        fitting_struct['Python_objective_call']
-    
-    if ('Python_best_call' in fitting_struct):
-        pars['Python_best_call'] = fitting_struct['Python_best_call']
-    else:
-        pars['Python_best_call'] = []
-
-    print('Single run')
-    
-    # Run the simulation
-    thread_worker(pars)
-    
-    # Make the sim figures
-    series_setup_file_string = str(Path(os.path.join(
-        pars['thread_space'],
-        'working',
-        'series_setup.json')).resolve())
-    characterize_model.characterize_model(series_setup_file_string)
-    
-    # Evaluate fit
-    e = thread_evaluate(pars, progress_data)
+    # Run the simulation, with figures, and evaluate the fit
+    results = pool.evaluate(p_vector, figures=True, fidelity_level=0)
+    e = record_evaluations(results, pool, progress_data)[0]
     print('Finished single run')
     
     # Return error
     return e
 
-def evaluate_positions(p_array, json_analysis_file_string, progress_data):
-    """ Evaluates an array of p_vectors """
-    
-    # Open the analysis_file_string and check for thread_folder
-    with open(json_analysis_file_string, 'r') as f:
-        json_data = json.load(f)
-   
-    # Deduce the base directory
-    model_struct = json_data['FiberSim_setup']['model']
-    if (model_struct['relative_to'] == 'this_file'):
-        model_base_dir = Path(json_analysis_file_string).parent.absolute()
+def evaluate_positions(p_array, pool, progress_data, reuse_log=False):
+    """ Evaluates an array of p_vectors. If the batch was run at reduced
+        fidelity, the best candidates are run again at full fidelity, but
+        the values returned for the batch are all at reduced fidelity,
+        so that they can be ranked. The indices and full-fidelity values
+        of those candidates are left in progress_data['promoted_indices']
+        and progress_data['promoted_values']. If reuse_log is True,
+        trials that are already in the progress log, for example from
+        before a fit was resumed, are not run again """
+    
+    p_array = np.array(p_array, dtype=float, ndmin=2)
+    
+    # Look for the batch in the log, at the fidelity it is scheduled for
+    fidelity_level = pool.return_fidelity_level(pool.no_of_batches)
+    if reuse_log:
+        (particle_value, found) = return_logged_errors(p_array,
+                                                       progress_data,
+                                                       fidelity_level)
+    
+    if reuse_log and np.all(found):
+        print('Using the logged errors for %i trials' % len(p_array))
+        pool.no_of_batches = pool.no_of_batches + 1
     else:
-        model_base_dir = model_struct['relative_to']
-    
-    # Work out the char structure
-    char_struct = json_data['FiberSim_setup']['characterization'][0]
-    
-    print(char_struct)
-
-    # Set the thread dir, try to clean it, make it if necessary
-    thread_dir = json_data['FiberSim_setup']['model']['fitting']['thread_folder']
-    thread_dir = str(Path(os.path.join(model_base_dir, thread_dir)).resolve())
-    
-    try:
-        print('Trying to clean: %s' % thread_dir)
-        shutil.rmtree(thread_dir, ignore_errors = True)
-    except OSError as e:
-        print('Error: %s : %s' % (thread_dir, e.strerror))
-    
-    # Check the thread dir is there
-    if not os.path.isdir(thread_dir):
-        os.makedirs(thread_dir)
+        # Run the simulations and record the fits
+        results = pool.evaluate(p_array)
+        particle_value = record_evaluations(results, pool, progress_data)
+        fidelity_level = results[0][0]['fidelity_level']
+    
+    # Promote the best candidates
+    promoted = np.zeros(0, dtype=int)
+    full_value = np.zeros(0)
+    if (fidelity_level > 0):
+        no_to_promote = pool.return_no_to_promote(fidelity_level)
+        promoted = np.argsort(particle_value)[0:no_to_promote]
+        
+        if reuse_log:
+            (full_value, found) = return_logged_errors(
+                p_array[promoted, :], progress_data, 0)
+        else:
+            full_value = np.nan * np.ones(len(promoted))
+            found = np.zeros(len(promoted), dtype=bool)
         
-    # Work out the size of the system
-    if (len(p_array.shape) == 2):
-        no_of_p_vectors, no_of_dimensions = p_array.shape
-    else:
-        no_of_p_vectors = 1
-        no_of_dimensions = p_array.shape[0]
+        if not np.all(found):
+            print('Running %i candidates at full fidelity' %
+                  np.sum(~found))
+            full_results = pool.evaluate(p_array[promoted[~found], :],
+                                         fidelity_level=0)
+            full_value[~found] = record_evaluations(full_results, pool,
+                                                    progress_data)
     
-    pars = []
-    for i in range(no_of_p_vectors):
-        par_set = dict()
-        par_set['id'] = (i+1)
-        par_set['x'] = p_array[i,:]
-        par_set['json_analysis_file_string'] = json_analysis_file_string
-        par_set['thread_space'] = \
-            str(Path(os.path.join(thread_dir,
-                                  ('thread_%i' % (i+1)))).resolve())
-        par_set['model_base_dir'] = model_base_dir
-        par_set['sim_folder'] = return_sim_dir(char_struct)
-        par_set['Python_objective_call'] = \
-            model_struct['fitting']['Python_objective_call']
-        if ('Python_best_call' in model_struct['fitting']):
-            par_set['Python_best_call'] = \
-                model_struct['fitting']['Python_best_call']                    
-        pars.append(par_set)
-
-    # Run the simulation            
-    with concurrent.futures.ThreadPoolExecutor(max_workers = 100) as executor:
-        executor.map(thread_worker, pars)
-        
-    # Now analyze the simulations
-    particle_value = np.nan * np.ones(no_of_p_vectors)
-    for i in range(no_of_p_vectors):
-        print('Evaluating fit for particle: %i' % (i+1))
-        
-        # Need to run this in series
-        series_setup_file_string = str(Path(os.path.join(
-            pars[i]['thread_space'],
-            'working',
-            'series_setup.json')).resolve())
-        characterize_model.characterize_model(series_setup_file_string)
-        particle_value[i] = thread_evaluate(pars[i], progress_data)
+    progress_data['promoted_indices'] = promoted
+    progress_data['promoted_values'] = full_value
         
     # Return
     return particle_value
-    
 
-def thread_worker(pars):
+def record_evaluations(results, pool, progress_data, wait_for_figures=True):
+    """ Records the results from a batch of threads, in thread order,
+        and returns an array with the total error for each thread.
+        The best fit is updated once, for the lowest error in the batch.
+        If wait_for_figures is False, the best thread is copied later,
+        once its figures have been made """
     
-    print('Thread worker')
-    print(pars)
+    error_values = np.nan * np.ones(len(results))
+    prog_ds = []
     
-    # Pull off the thread information
-    json_analysis_file_string = pars['json_analysis_file_string']
-    thread_space = pars['thread_space']
+    for (i, (pars, trial_errors)) in enumerate(results):
+        print('Evaluating fit for particle: %i' % pars['id'])
+        prog_ds.append(thread_evaluate(pars, trial_errors, progress_data))
+        error_values[i] = trial_errors['error_total']
     
-    # Open the analysis file
-    with open(json_analysis_file_string, 'r') as f:
-        orig_setup = json.load(f)
-    
-    # Pull out the model_struct
-    model_struct = orig_setup['FiberSim_setup']['model']
+    # Append the batch to the progress log
+    progress_data['progress_log'].append(prog_ds)
     
-    # Deduce the base directory
-    if (model_struct['relative_to'] == 'this_file'):
-        model_base_dir = str(Path(json_analysis_file_string).parent.absolute())
-    else:
-        model_base_dir = model_struct['relative_to']
-
-    # Set the working directory
-    working_dir = os.path.join(thread_space, 'working')
-
-    try:
-        print('Trying to clean: %s' % working_dir)
-        shutil.rmtree(working_dir, ignore_errors = True)
-    except OSError as e:
-        print('Error: %s : %s' % (working_dir, e.strerror))
+    # Take action if the batch holds the best fit. Results at reduced
+    # fidelity are only used to rank candidates
+    full_i = [i for (i, (pars, trial_errors)) in enumerate(results)
+              if (pars['fidelity_level'] == 0)]
+    if full_i:
+        best_i = full_i[int(np.argmin(error_values[full_i]))]
+    if full_i and (error_values[best_i] <= progress_data['lowest_error']):
+        progress_data['lowest_error'] = error_values[best_i]
+        pars = results[best_i][0]
         
-    # Check the working dir is there
-    if not os.path.isdir(working_dir):
-        os.makedirs(working_dir)
-    print(model_struct)
+        # Add the entry to the best log
+        progress_data['best_log'].append([prog_ds[best_i]])
         
-    # Move the model file and the simulations to the working dir
-    file_names = [model_struct['fitting']['base_model'],
-                  model_struct['options_file']]
-    for fn in file_names:
-        orig_fn = os.path.join(model_base_dir, fn)
-        with open(orig_fn, 'r') as f:
-            orig_data = json.load(f)
-        new_fn = os.path.join(working_dir, fn)
-        with open(new_fn, 'w') as f:
-            json.dump(orig_data, f, indent=4)
-            
-    # Copy the setup
-    orig_setup_deepcopy = copy.deepcopy(orig_setup)
-
-    # And adjust it, creating two copies, one that doesn't plot figures,
-    # and a second one that does, while also running the objective function
-    (parallel_setup, series_setup) = return_sim_setups(orig_setup_deepcopy, pars)
-    
-    # Write to file
-    parallel_setup_file_string = os.path.join(working_dir, 'parallel_setup.json')
-    with open(parallel_setup_file_string, 'w') as f:
-        json.dump(parallel_setup, f, indent=4)
-
-    series_setup_file_string = os.path.join(working_dir, 'series_setup.json')
-    with open(series_setup_file_string, 'w') as f:
-        json.dump(series_setup, f, indent=4)
-       
-    print('ll')
-    print(parallel_setup_file_string)
-       
-    # Now run the simulation
-    characterize_model.characterize_model(parallel_setup_file_string)
-    
-def thread_evaluate(pars, progress_data):
-    """ Evaluates a simulation thread """
-    
-    # # Generate a path and a command string
-    obj_call = str(Path(os.path.join(pars['model_base_dir'],
-                                      pars['Python_objective_call'])).resolve())
+        # The copy of the best thread includes its figures, which are
+        # made in the pool. A copy that is still waiting for them is
+        # not needed any more
+        progress_data['best_thread'] = (pool.make_figures(pars), pars)
     
-    cmd_string = 'python %s %s' % (obj_call, pars['thread_space'])
-    
-    # Calculate the fit error
-    subprocess.call(cmd_string)
+    copy_best_thread(progress_data, wait=wait_for_figures)
+        
+    # Update the Excel files and the figure
+    write_progress(progress_data)
     
-    # At this point, error components should be in
-    # [thread_space]/working/trial_errors.xlsx
-    working_dir = str(Path(os.path.join(pars['thread_space'],
-                                        'working')).resolve())
-    trial_errors_file = os.path.join(working_dir, 'trial_errors.xlsx')
+    # Return
+    return error_values
     
-    # # Insert here for test function
-    # if not os.path.isdir(working_dir):
-    #     os.makedirs(working_dir)
-
-    # test_function(pars['x'], trial_errors_file)
-    # # end insert
-
-    trial_errors = pd.read_excel(trial_errors_file)
+def thread_evaluate(pars, trial_errors, progress_data):
+    """ Returns a dict with the progress entry for the error components
+        returned by a simulation thread """
     
-    # Make a dictionary from the trial_errors file
+    # Make a dictionary from the trial_errors
     prog_d = dict()
     prog_d['trial'] = progress_data['iteration']
     p_vector = pars['x']
     for i in range(len(p_vector)):
         prog_d['p_%i' % (i+1)] = p_vector[i]
-    prog_d['error_total'] = trial_errors['error_total'][0] 
+    prog_d['error_total'] = trial_errors['error_total']
+    if (pars['fidelity_level'] > 0):
+        prog_d['fidelity_level'] = pars['fidelity_level']
     
-    error_cpt_labels = trial_errors.columns
-    for err_lab in error_cpt_labels:
+    for err_lab in trial_errors.keys():
         if ('error_cpt' in err_lab):
-            prog_d[err_lab] = trial_errors[err_lab][0]
+            prog_d[err_lab] = trial_errors[err_lab]
             
-    for err_lab in error_cpt_labels:
+    for err_lab in trial_errors.keys():
         if ('test_value' in err_lab):
-            prog_d[err_lab] = trial_errors[err_lab][0]
-    
-    # If there is a progress file, append the new entry to the dataframe
-    trial_df = pd.DataFrame(data=prog_d, index=[0])
-    if (os.path.isfile(progress_data['progress_file_string'])):
-        prog_df = pd.read_excel(progress_data['progress_file_string'])
-        prog_df = pd.concat([prog_df, trial_df])        
-    else:
-        # Make a new dataframe
-        prog_df = trial_df
-    
-    # Clean the file and then write
-    if (os.path.exists(progress_data['progress_file_string'])):
-        os.remove(progress_data['progress_file_string'])
-    prog_df.to_excel(progress_data['progress_file_string'], index=False)
+            prog_d[err_lab] = trial_errors[err_lab]
             
     # Update
     progress_data['iteration'] = progress_data['iteration'] + 1
     
-    # Take action if this is the best fit
-    if (prog_d['error_total'] <= progress_data['lowest_error']):
-        progress_data['lowest_error'] = prog_d['error_total']
-        update_best_thread(progress_data,
-                    trial_df,
-                    pars)
-        
-    # Update a figure
-    plot_progress(progress_data)
-    
-    # Return error
-    return prog_d['error_total']
-    
-def return_sim_setups(orig_setup, pars):
-    """ Working from the original fitting setup, create a new setup with
-        parameter multipliers to run a simulation for a given pars struct """
-    
-    # Create a new setup
-    new_setup = dict()
-    
-    # Copy the FiberCpp element
-    new_setup['FiberSim_setup'] = dict()
-    new_setup['FiberSim_setup']['FiberCpp_exe'] = \
-        orig_setup['FiberSim_setup']['FiberCpp_exe']
-    
-    # Now the model
-    new_setup['FiberSim_setup']['model'] = dict()
-    new_setup['FiberSim_setup']['model']['relative_to'] = 'False'
-    new_setup['FiberSim_setup']['model']['options_file'] = str(Path(
-        os.path.join(pars['thread_space'],
-                     'working',
-                     orig_setup['FiberSim_setup']['model']['options_file'])).resolve())
-    
-    # Check for isotype_clones
-    if ('isotype_clones' in orig_setup['FiberSim_setup']['model']):
-        new_setup['FiberSim_setup']['model']['isotype_clones'] = \
-            orig_setup['FiberSim_setup']['model']['isotype_clones']
-   
-    # Now handle manipulations
-    manip = dict()
-    manip['base_model'] = str(Path(
-        os.path.join(pars['thread_space'],
-                     'working',
-                     orig_setup['FiberSim_setup']['model']['fitting']['base_model'])).resolve())
-    manip['generated_folder'] = str(Path(
-        os.path.join(pars['thread_space'],
-                     'generated')).resolve())
-
-    # Now the adjustments
-    manip['adjustments'] = \
-        return_adjustments(orig_setup['FiberSim_setup']['model']['fitting'],
-                           pars['x'])
-    
-    # Prepare the new setup structure
-    new_setup['FiberSim_setup']['model']['manipulations'] = manip
-
-    new_setup['FiberSim_setup']['characterization'] = []
-    
-    # Copy it so that we have a version that makes figures and one does not
-    no_figs_setup = copy.deepcopy(new_setup)
-    figs_setup = copy.deepcopy(new_setup)
-        
-    # Now add in the characterizations
-    for (ch_id, ch) in enumerate(orig_setup['FiberSim_setup']['characterization']):
-        
-        # Create a new characterization
-        new_ch = dict()
-        orig_ch = ch
-   
-        for k in orig_ch.keys():
-            new_ch[k] = orig_ch[k]
-            
-        # Adjust paths
-        new_ch['relative_to'] = 'False'
-        new_ch['sim_folder'] = str(Path(
-            os.path.join(pars['thread_space'],
-                            return_sim_dir(orig_ch))).resolve())
-        
-        # Include protocol files if required
-        if ('protocol_files' in orig_ch):
-            for (i, pf) in enumerate(orig_ch['protocol_files']):
-                new_ch['protocol_files'][i] = str(Path(
-                    os.path.join(new_ch['sim_folder'], pf)).resolve())
-                
-        if ('protocol' in orig_ch):
-            new_ch['protocol']['protocol_folder'] = str(Path(
-                os.path.join(new_ch['sim_folder'],
-                             orig_ch['protocol']['protocol_folder'])).resolve())
-        
-        # Add in the characterization with some adjustments for figures
-        no_figs_setup['FiberSim_setup']['characterization'].append(copy.deepcopy(new_ch))
-        no_figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_only'] = 'False'
-        no_figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_off'] = 'True'
-    
-        figs_setup['FiberSim_setup']['characterization'].append(copy.deepcopy(new_ch))
-        figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_only'] = 'True'
-        figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_off'] = 'False'
-    
     # Return
-    return (no_figs_setup, figs_setup)
-    
-def return_adjustments(manipulations, p_vector):
-    """ Returns adjustments from a fitting structure """
-        
-    # Set parameter multipliers for the adjustments
-    adj = manipulations['adjustments']       
-
-    # Cycle through the adjustments setting the multiplier based on the
-    # p_vector. We will make a new array of adjustments here to allow for
-    # base variants
-    
-    new_adjustments = []
-    p_counter = 0
-    
-    for (i, a) in enumerate(adj):
-        span = a['factor_bounds'][1] - a['factor_bounds'][0]
-        m = a['factor_bounds'][0] + p_vector[p_counter] * span
-        a['multipliers'] = []
-        if ('factor_mode' in a):
-            if (a['factor_mode'] == "log"):
-                a['multipliers'].append(np.power(10, m))
-        else:
-            a['multipliers'].append(m)
-        del a['factor_bounds']
-        
-        new_adjustments.append(a)
-        
-        p_counter = p_counter + 1
-        
-        # Check for a constraint
-        if ('also_linked' in a):
-            
-            # Special case
-            digits = [int(s) for s in re.findall(r'\d+', a['also_linked'])]
-            print(digits)
-            
-            linked_a = dict();
-            linked_a['variable'] = a['variable']
-            linked_a['isotype'] = digits[0]
-            linked_a['state'] = digits[1]
-            
-            if not ('extension' in a):
-                linked_a['transition'] = digits[2]
-                linked_a['parameter_number'] = digits[3]
-            else:
-                linked_a['extension'] = a['extension']
-
-            linked_a['multipliers'] = []
-            if ('factor_mode' in a):
-                if (a['factor_mode'] == "log"):
-                    mult = np.power(10, m)
-            else:
-                mult = m
-            linked_a['multipliers'].append(mult)
-            
-            new_adjustments.append(linked_a)
-        
-    # Now we need to check for base_variants
-    # We will handle these by adding new elements to the multipliers list for
-    # each adjustment
-    if ('base_variants' in 'manipulations'):
-        base_variants = manipulations['base_variants']
-        
-        # Cycle through the base variants
-        for (i,bv) in enumerate(base_variants):
+    return prog_d
     
-            # Work out the index for the parameter we are adding
-            new_mult_index = len(new_adjustments[0]['multipliers'])
-            
-            # And now the adjustments
-            for (j, a) in enumerate(bv['adjustments']):
-    
-                # Work out what the new value will be
-                if ('multipliers' in a):
-                    new_value = a['multipliers'][0]
-                else:
-                    span = a['factor_bounds'][1] - a['factor_bounds'][0]
-                    new_value = a['factor_bounds'][0] + p_vector[p_counter] * span
-                    if (a['factor_mode'] == 'log'):
-                        new_value = np.power(10, new_value)
-                    
-                    p_counter = p_counter + 1
-                
-                # Work out whether the adjustment is new or
-                # matches an existing entry         
-                matching_ind = return_matching_adjustment_index(
-                                    new_adjustments, a)
-                    
-                # Branch depending on match
-                if (matching_ind == -1):
-                    # There's no match
-                    # Duplicate the last multiplier for other adjustments
-                    # Add in a 1, x muliplier for the test
-                    
-                    for na in new_adjustments:
-                        y = na['multipliers']
-                        if (len(y) <= new_mult_index):
-                            na['multipliers'].append(y[-1])
-                        else:
-                            na['multipliers'][new_mult_index] = y[-1]
-                        
-                    # Now add in the new one
-                    a['multipliers'] = [new_value]
-                    a['multipliers'].insert(-1, 1)
-                    
-                    # Clean up the adjustment
-                    if ('factor_bounds' in a):
-                        del a['factor_bounds']
-                        
-                    if ('factor_mode' in a):
-                        del a['factor_mode']
-                    
-                    new_adjustments.append(a)
-                    
-                else:
-                    # There is a match.
-                    # Add in fixed multiplier for the match
-                    # Duplicate the last multiplier for the
-                    # non-matching adjustments
-                    
-                    for (k,na) in enumerate(new_adjustments):
-                        if (k == matching_ind):
-                            # Match
-                            y = na['multipliers']
-                            if (len(y) <= new_mult_index):
-                                na['multipliers'].append(new_value)
-                            else:
-                                na['multipliers'][new_mult_index] = new_value
-                        else:
-                            # Non-match
-                            y = na['multipliers']
-                            if (len(y) <= new_mult_index):
-                                na['multipliers'].append(y[-1])
-                            else:
-                                na['multipliers'][new_mult_index] = \
-                                    y[-1]
+def copy_best_thread(progress_data, wait=False):
+    """ Copies the best thread once its figures have been made, waiting
+        for them if wait is True """
     
-    # Return
-    return new_adjustments                                    
-
-
-def return_matching_adjustment_index(existing, test):
-    """ Compares the test adjustment to the existing ones and
-        returns an index for a match, or -1 if there is no match """
-    
-    for (i,a) in enumerate(existing):
-        if (test['variable'] == a['variable']):
-            if ('isotype' in a):
-                # It's a kinetic parameter, check the other matches
-                try:
-                    if (test['isotype'] == a['isotype']) and \
-                            (test['state'] == a['state']) and \
-                            (test['transition'] == a['transition']) and \
-                            (test['parameter_number'] == a['parameter_number']):
-                        # It's a match
-                        return i
-                except:
-                    pass
-            else:
-                # It's a non-kinetic parameter
-                if (test['class'] == a['class']):
-                    # It's a match
-                    return i
+    if (progress_data['best_thread'] is None):
+        return
     
-    # No match
-    return -1
+    (f, pars) = progress_data['best_thread']
+    if (f is not None):
+        if not (wait or f.done()):
+            return
+        f.result()
     
-def update_best_thread(progress_data, trial_df, pars):
+    progress_data['best_thread'] = None
+    update_best_thread(progress_data, pars)
+
+def update_best_thread(progress_data, pars):
     """ Updates best simulation """
 
-    # Update the best dataframe
-    if (os.path.isfile(progress_data['best_file_string'])):
-        best_df = pd.read_excel(progress_data['best_file_string'])
-        best_df = pd.concat([best_df, trial_df])
-    else:
-        best_df = trial_df
-        
-    # Clean the file
-    if (os.path.exists(progress_data['best_file_string'])):
-        os.remove(progress_data['best_file_string'])
-        
-    # Write it
-    best_df.to_excel(progress_data['best_file_string'], index=False)
-    
-    # Now get the model file from the generated dir and copy that
+    # Get the model file from the generated dir and copy that
     # To do this, we first need to set some paths
     generated_dir = str(Path(os.path.join(pars['thread_space'], 'generated')).resolve())
     old_file = os.path.join(generated_dir,
@@ -1031,25 +841,31 @@ def update_best_thread(progress_data, trial_df, pars):
             python_cmd = 'python %s' % best_call
             subprocess.call(python_cmd)
         
-def return_sim_dir(char_dict):
-    """ Parses a char_dict to get a simulation directory that is
-        appropriate for a thread structure """
+def write_progress(progress_data, force=False):
+    """ Exports the progress and best logs to Excel and updates the
+        progress figure, if progress_interval_s has passed since the last
+        update or force is True """
     
-    sim_dir = char_dict['sim_folder']
+    if not progress_data['progress_log'].entries:
+        return
     
-    keep_going = True
-    while (keep_going):
-        if (sim_dir.startswith('../')):
-            sim_dir = sim_dir[3::]
-        else:
-            keep_going = False
+    t = time.monotonic()
+    if not force and ((t - progress_data['last_progress_time']) <
+                      progress_data['progress_interval_s']):
+        return
     
-    return sim_dir
+    progress_data['progress_log'].write_excel(
+        progress_data['progress_file_string'])
+    progress_data['best_log'].write_excel(
+        progress_data['best_file_string'])
+    plot_progress(progress_data)
     
+    progress_data['last_progress_time'] = t
+
 def plot_progress(progress_data):
     
     # Load in the progress data
-    df = pd.read_excel(progress_data['progress_file_string'])
+    df = progress_data['progress_log'].return_data_frame()
     
     # Make a 2 panel figure
     no_of_rows = 3
@@ -0,0 +1,724 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluates parameter vectors for fit_model in a pool of worker processes
+
+The pool is started once for each fit. When a worker starts, it parses the
+setup file and loads the base model and the options, and it keeps them in
+memory for the rest of the fit. A task is a thread number and a parameter
+vector. The worker writes the adjusted setups to the working folder for
+that thread, runs the simulations and the objective, and returns the
+error components.
+
+The objective can be a function that is imported into each worker, set
+in the fitting section as
+
+    "Python_objective_function": {
+        "file": "../Python_code/return_fit.py",
+        "function": "return_errors"
+    }
+
+with the file relative to the setup. The function is called as
+function(analysis_results, thread_space), where analysis_results holds
+the DataFrames from the characterization analyses, keyed by the name of
+their data file (for example analysis_results['pCa_analysis']['curve_1']),
+and returns a dict of error components, error_cpt_1, error_cpt_2 and so
+on. error_total is the sum of the components unless it is returned as
+well. Otherwise, the Python_objective_call script is run for each
+evaluation and writes the errors to working/trial_errors.xlsx.
+
+Early batches can be run at reduced fidelity, with a schedule set in the
+fitting section as
+
+    "fidelity_schedule": [
+        {"batches": 10, "m_n": 4, "time_step_factor": 4,
+         "randomized_repeats": 1, "promote": 2},
+        {"batches": 10, "m_n": 9, "time_step_factor": 2, "promote": 2}
+    ]
+
+Each stage runs for the given number of batches, after which batches run
+at full fidelity. m_n sets the number of thick filaments, time_step_factor
+multiplies the time step of each characterization, and randomized_repeats
+caps the number of repeats. The best promote candidates from each batch
+at reduced fidelity are run again at full fidelity by fit_model. The
+particle swarm resets its bests when the fidelity level changes and
+starts full fidelity from the promoted candidates. emcee ignores the
+schedule, because its chain needs the same log-likelihood throughout.
+
+The figures are only made every figure_interval batches, which can be set
+in the fitting section. The other batches only run the analyses that the
+objective needs. The figures for a thread can be made later, for example
+when it turns out to be the best fit so far. They are made in the pool
+while the fit carries on, and the thread is not run again until they
+are finished.
+
+Simulations launched by the workers share the machine-wide job tokens, so
+the pool can hold one worker for each particle without running more
+FiberCpp processes than there are cores.
+"""
+
+import os
+import re
+import json
+import copy
+import shutil
+import subprocess
+import importlib.util
+
+import concurrent.futures
+
+import matplotlib
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from ..batch import job_server
+from ..batch import sim_cache
+
+from ..characterize import characterize_model
+
+
+# The fit setup held by each worker process
+worker_setup = None
+
+
+class fit_worker_pool():
+    """ Class for a pool of processes that evaluate parameter vectors """
+
+    def __init__(self, json_analysis_file_string, max_workers=1):
+
+        self.json_analysis_file_string = json_analysis_file_string
+        self.max_workers = max_workers
+        self.fit_setup = return_fit_setup(json_analysis_file_string)
+
+        # Work out how often to make figures
+        fitting_struct = self.fit_setup['setup']['FiberSim_setup']['model']['fitting']
+        if ('figure_interval' in fitting_struct):
+            self.figure_interval = fitting_struct['figure_interval']
+        else:
+            self.figure_interval = 1
+        self.no_of_batches = 0
+
+        # Futures for figures that are being made, keyed by thread
+        self.figure_futures = dict()
+
+        # And the fidelity schedule
+        if ('fidelity_schedule' in fitting_struct):
+            self.fidelity_schedule = fitting_struct['fidelity_schedule']
+        else:
+            self.fidelity_schedule = []
+
+        # Clean the thread folder once, at the start of the fit
+        char_struct = self.fit_setup['char_struct']
+        if not (('figures_only' in char_struct) and
+                (char_struct['figures_only'] == 'True')):
+            clean_folder(self.fit_setup['thread_dir'])
+
+        # Start the job server before the workers so that they inherit it
+        job_server.return_job_tokens()
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=init_worker,
+            initargs=(json_analysis_file_string,))
+
+    def return_pars(self, thread_number, x):
+        """ Returns the par_set for a thread """
+
+        return return_par_set(self.fit_setup, thread_number, x)
+
+    def evaluate(self, p_array, figures=None, fidelity_level=None):
+        """ Evaluates each row of p_array in its own thread and returns
+            a list of (pars, trial_errors) tuples in the same order.
+            If fidelity_level is None, the batch follows the fidelity
+            schedule. If figures is None, they are made every
+            figure_interval scheduled batches that run at full fidelity """
+
+        p_array = np.array(p_array, dtype=float, ndmin=2)
+
+        if (fidelity_level is None):
+            fidelity_level = self.return_fidelity_level(self.no_of_batches)
+            if (figures is None):
+                figures = ((fidelity_level == 0) and
+                           ((self.no_of_batches % self.figure_interval) == 0))
+            self.no_of_batches = self.no_of_batches + 1
+        elif (figures is None):
+            figures = False
+
+        futures = [self.submit((i+1), p_array[i, :], figures, fidelity_level)
+                   for i in range(p_array.shape[0])]
+
+        results = []
+        for (i, f) in enumerate(futures):
+            pars = self.return_pars((i+1), p_array[i, :])
+            pars['figures'] = figures
+            pars['fidelity_level'] = fidelity_level
+            results.append((pars, f.result()))
+
+        return results
+
+    def return_fidelity_level(self, batch_number):
+        """ Returns the fidelity level for a batch, 0 for full fidelity
+            or i for the i'th stage of the fidelity schedule """
+
+        last_batch = 0
+        for (i, stage) in enumerate(self.fidelity_schedule):
+            last_batch = last_batch + stage['batches']
+            if (batch_number < last_batch):
+                return (i+1)
+
+        return 0
+
+    def return_no_to_promote(self, fidelity_level):
+        """ Returns the number of candidates from a batch at a reduced
+            fidelity level to run again at full fidelity """
+
+        stage = self.fidelity_schedule[fidelity_level - 1]
+        if ('promote' in stage):
+            return stage['promote']
+        else:
+            return 1
+
+    def submit(self, thread_number, x, figures=False, fidelity_level=0):
+        """ Starts the evaluation of x in a thread and returns a future
+            for its trial_errors """
+
+        # The figures from the last simulations in the thread have to
+        # be made before they are cleared
+        if (thread_number in self.figure_futures):
+            self.figure_futures.pop(thread_number).result()
+
+        return self.executor.submit(run_worker, thread_number,
+                                    np.array(x, dtype=float), figures,
+                                    fidelity_level)
+
+    def make_figures(self, pars):
+        """ Starts making the figures for a thread that was run without
+            them and returns a future, or None if it already has them """
+
+        if pars['figures']:
+            return None
+
+        f = self.executor.submit(run_figures, pars['id'])
+        self.figure_futures[pars['id']] = f
+        pars['figures'] = True
+
+        return f
+
+    def return_figure_future(self, thread_number):
+        """ Returns the future for figures that are still being made for
+            a thread, or None """
+
+        if (thread_number in self.figure_futures) and \
+                not self.figure_futures[thread_number].done():
+            return self.figure_futures[thread_number]
+        else:
+            return None
+
+    def close(self):
+        """ Shuts down the workers """
+
+        self.executor.shutdown()
+
+
+def init_worker(json_analysis_file_string):
+    """ Loads the setup, base model and options into the worker """
+
+    global worker_setup
+
+    # Workers only write figures to file
+    matplotlib.use('Agg')
+
+    worker_setup = return_fit_setup(json_analysis_file_string)
+
+    model_struct = worker_setup['setup']['FiberSim_setup']['model']
+
+    worker_setup['model_files'] = dict()
+    for fn in [model_struct['fitting']['base_model'],
+               model_struct['options_file']]:
+        with open(os.path.join(worker_setup['model_base_dir'], fn), 'r') as f:
+            worker_setup['model_files'][fn] = json.load(f)
+
+    # The thread spaces this worker has written the model files to
+    worker_setup['prepared_threads'] = set()
+
+    # Import the objective function, if there is one
+    if ('Python_objective_function' in model_struct['fitting']):
+        worker_setup['objective'] = return_objective_function(
+            worker_setup['model_base_dir'],
+            model_struct['fitting']['Python_objective_function'])
+    else:
+        worker_setup['objective'] = None
+
+def run_worker(thread_number, x, figures=True, fidelity_level=0):
+    """ Runs the simulations for x in a thread and returns a dict with the
+        error components """
+
+    pars = return_par_set(worker_setup, thread_number, x)
+    pars['fidelity_level'] = fidelity_level
+
+    working_dir = os.path.join(pars['thread_space'], 'working')
+
+    # Write the model and options files the first time the thread is used
+    if not (pars['thread_space'] in worker_setup['prepared_threads']):
+        clean_folder(working_dir)
+        for (fn, data) in worker_setup['model_files'].items():
+            with open(os.path.join(working_dir, fn), 'w') as f:
+                json.dump(data, f, indent=4)
+        worker_setup['prepared_threads'].add(pars['thread_space'])
+
+    # Clear the results from the last evaluation
+    shutil.rmtree(os.path.join(pars['thread_space'],
+                               pars['sim_folder'].split('/')[0]),
+                  ignore_errors = True)
+
+    # Create two setups, one that doesn't plot figures, and a second one
+    # that does
+    (parallel_setup, series_setup) = return_sim_setups(
+        copy.deepcopy(worker_setup['setup']), pars)
+
+    parallel_setup_file_string = os.path.join(working_dir,
+                                              'parallel_setup.json')
+    with open(parallel_setup_file_string, 'w') as f:
+        json.dump(parallel_setup, f, indent=4)
+
+    series_setup_file_string = os.path.join(working_dir,
+                                            'series_setup.json')
+    with open(series_setup_file_string, 'w') as f:
+        json.dump(series_setup, f, indent=4)
+
+    # Run the simulations and then, if required, make the figures
+    analysis_results = dict()
+    characterize_model.characterize_model(parallel_setup_file_string,
+                                          analysis_results=analysis_results)
+    if figures:
+        characterize_model.characterize_model(series_setup_file_string,
+                                              analysis_results=analysis_results)
+
+    return return_trial_errors(pars, analysis_results)
+
+def run_figures(thread_number):
+    """ Makes the figures for the last simulations run in a thread """
+
+    thread_space = return_par_set(worker_setup, thread_number,
+                                  [])['thread_space']
+
+    characterize_model.characterize_model(
+        os.path.join(thread_space, 'working', 'series_setup.json'))
+
+def return_trial_errors(pars, analysis_results):
+    """ Runs the objective for a thread and returns a dict with the
+        error components """
+
+    # Call the objective function in this process if there is one
+    if (worker_setup['objective'] is not None):
+        trial_errors = dict(worker_setup['objective'](analysis_results,
+                                                      pars['thread_space']))
+        if not ('error_total' in trial_errors):
+            trial_errors['error_total'] = \
+                sum([v for (k, v) in trial_errors.items()
+                     if ('error_cpt' in k)])
+        return trial_errors
+
+    # Otherwise, run the objective script
+    # Generate a path and a command string
+    obj_call = str(Path(os.path.join(pars['model_base_dir'],
+                                     pars['Python_objective_call'])).resolve())
+
+    cmd_string = 'python %s %s' % (obj_call, pars['thread_space'])
+
+    # At this point, error components should be in
+    # [thread_space]/working/trial_errors.xlsx
+    trial_errors_file = os.path.join(pars['thread_space'], 'working',
+                                     'trial_errors.xlsx')
+    if (os.path.exists(trial_errors_file)):
+        os.remove(trial_errors_file)
+
+    # Calculate the fit error
+    subprocess.call(cmd_string)
+
+    trial_errors = pd.read_excel(trial_errors_file)
+
+    return {k: trial_errors[k][0] for k in trial_errors.columns}
+
+def return_objective_function(model_base_dir, objective_struct):
+    """ Imports the objective function from a Python file """
+
+    file_string = str(Path(os.path.join(model_base_dir,
+                                        objective_struct['file'])).resolve())
+
+    spec = importlib.util.spec_from_file_location(
+        Path(file_string).stem, file_string)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return getattr(module, objective_struct['function'])
+
+def return_fit_setup(json_analysis_file_string):
+    """ Returns a dict with the parsed setup and the folders for a fit """
+
+    with open(json_analysis_file_string, 'r') as f:
+        setup = json.load(f)
+
+    model_struct = setup['FiberSim_setup']['model']
+
+    # Deduce the base directory
+    if (model_struct['relative_to'] == 'this_file'):
+        model_base_dir = str(Path(json_analysis_file_string).parent.absolute())
+    else:
+        model_base_dir = model_struct['relative_to']
+
+    fit_setup = dict()
+    fit_setup['json_analysis_file_string'] = json_analysis_file_string
+    fit_setup['setup'] = setup
+    fit_setup['model_base_dir'] = model_base_dir
+    fit_setup['char_struct'] = setup['FiberSim_setup']['characterization'][0]
+    fit_setup['thread_dir'] = str(Path(os.path.join(
+        model_base_dir, model_struct['fitting']['thread_folder'])).resolve())
+
+    return fit_setup
+
+def return_par_set(fit_setup, thread_number, x):
+    """ Returns the par_set for a thread """
+
+    fitting_struct = fit_setup['setup']['FiberSim_setup']['model']['fitting']
+
+    par_set = dict()
+    par_set['id'] = thread_number
+    par_set['x'] = x
+    par_set['json_analysis_file_string'] = \
+        fit_setup['json_analysis_file_string']
+    par_set['thread_space'] = \
+        str(Path(os.path.join(fit_setup['thread_dir'],
+                              ('thread_%i' % thread_number))).resolve())
+    par_set['model_base_dir'] = fit_setup['model_base_dir']
+    par_set['sim_folder'] = return_sim_dir(fit_setup['char_struct'])
+    par_set['fidelity_level'] = 0
+    if ('Python_objective_call' in fitting_struct):
+        par_set['Python_objective_call'] = \
+            fitting_struct['Python_objective_call']
+    if ('Python_best_call' in fitting_struct):
+        par_set['Python_best_call'] = fitting_struct['Python_best_call']
+    else:
+        par_set['Python_best_call'] = []
+
+    return par_set
+
+def clean_folder(folder):
+    """ Deletes a folder, if it exists, and makes a new empty one """
+
+    try:
+        print('Trying to clean: %s' % folder)
+        shutil.rmtree(folder, ignore_errors = True)
+    except OSError as e:
+        print('Error: %s : %s' % (folder, e.strerror))
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+def return_sim_setups(orig_setup, pars):
+    """ Working from the original fitting setup, create a new setup with
+        parameter multipliers to run a simulation for a given pars struct """
+    
+    # Create a new setup
+    new_setup = dict()
+    
+    # Copy the FiberCpp element
+    new_setup['FiberSim_setup'] = dict()
+    new_setup['FiberSim_setup']['FiberCpp_exe'] = \
+        orig_setup['FiberSim_setup']['FiberCpp_exe']
+    
+    # Copy the simulation cache, making the path absolute
+    if ('sim_cache' in orig_setup['FiberSim_setup']):
+        new_setup['FiberSim_setup']['sim_cache'] = \
+            sim_cache.resolve_cache_struct(
+                orig_setup['FiberSim_setup']['sim_cache'],
+                pars['json_analysis_file_string'])
+    
+    # Now the model
+    new_setup['FiberSim_setup']['model'] = dict()
+    new_setup['FiberSim_setup']['model']['relative_to'] = 'False'
+    new_setup['FiberSim_setup']['model']['options_file'] = str(Path(
+        os.path.join(pars['thread_space'],
+                     'working',
+                     orig_setup['FiberSim_setup']['model']['options_file'])).resolve())
+    
+    # Check for isotype_clones
+    if ('isotype_clones' in orig_setup['FiberSim_setup']['model']):
+        new_setup['FiberSim_setup']['model']['isotype_clones'] = \
+            orig_setup['FiberSim_setup']['model']['isotype_clones']
+   
+    # Now handle manipulations
+    manip = dict()
+    manip['base_model'] = str(Path(
+        os.path.join(pars['thread_space'],
+                     'working',
+                     orig_setup['FiberSim_setup']['model']['fitting']['base_model'])).resolve())
+    manip['generated_folder'] = str(Path(
+        os.path.join(pars['thread_space'],
+                     'generated')).resolve())
+
+    # Now the adjustments
+    manip['adjustments'] = \
+        return_adjustments(orig_setup['FiberSim_setup']['model']['fitting'],
+                           pars['x'])
+    
+    # Prepare the new setup structure
+    new_setup['FiberSim_setup']['model']['manipulations'] = manip
+
+    new_setup['FiberSim_setup']['characterization'] = []
+    
+    # Copy it so that we have a version that makes figures and one does not
+    no_figs_setup = copy.deepcopy(new_setup)
+    figs_setup = copy.deepcopy(new_setup)
+        
+    # Now add in the characterizations
+    for (ch_id, ch) in enumerate(orig_setup['FiberSim_setup']['characterization']):
+        
+        # Create a new characterization
+        new_ch = dict()
+        orig_ch = ch
+   
+        for k in orig_ch.keys():
+            new_ch[k] = orig_ch[k]
+            
+        # Adjust paths
+        new_ch['relative_to'] = 'False'
+        new_ch['sim_folder'] = str(Path(
+            os.path.join(pars['thread_space'],
+                            return_sim_dir(orig_ch))).resolve())
+        
+        # Include protocol files if required
+        if ('protocol_files' in orig_ch):
+            for (i, pf) in enumerate(orig_ch['protocol_files']):
+                new_ch['protocol_files'][i] = str(Path(
+                    os.path.join(new_ch['sim_folder'], pf)).resolve())
+                
+        if ('protocol' in orig_ch):
+            new_ch['protocol']['protocol_folder'] = str(Path(
+                os.path.join(new_ch['sim_folder'],
+                             orig_ch['protocol']['protocol_folder'])).resolve())
+        
+        # Reduce the fidelity if required
+        if (pars['fidelity_level'] > 0):
+            set_fidelity(new_ch, orig_setup['FiberSim_setup']['model']['fitting']
+                         ['fidelity_schedule'][pars['fidelity_level'] - 1])
+        
+        # Add in the characterization with some adjustments for figures
+        no_figs_setup['FiberSim_setup']['characterization'].append(copy.deepcopy(new_ch))
+        no_figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_only'] = 'False'
+        no_figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_off'] = 'True'
+    
+        figs_setup['FiberSim_setup']['characterization'].append(copy.deepcopy(new_ch))
+        figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_only'] = 'True'
+        figs_setup['FiberSim_setup']['characterization'][ch_id]['figures_off'] = 'False'
+    
+    # Return
+    return (no_figs_setup, figs_setup)
+    
+def set_fidelity(ch, stage):
+    """ Adjusts a characterization to run at the fidelity set by a stage
+        of the fidelity schedule """
+    
+    # Use fewer thick filaments
+    if ('m_n' in stage):
+        ch['m_n'] = stage['m_n']
+    
+    # Cap the repeats
+    if (('randomized_repeats' in stage) and ('randomized_repeats' in ch)):
+        ch['randomized_repeats'] = min(ch['randomized_repeats'],
+                                       stage['randomized_repeats'])
+    
+    # Coarsen the time step, keeping the durations the same. The length
+    # ramps in pCa_length_control use a tenth of the time step, and
+    # protocol_builder keeps at least one point in each of them
+    if ('time_step_factor' in stage):
+        f = stage['time_step_factor']
+        if ('time_step_s' in ch):
+            ch['time_step_s'] = f * ch['time_step_s']
+        if ('protocol' in ch) and ('data' in ch['protocol']):
+            for ps in ch['protocol']['data']:
+                ps['time_step_s'] = f * ps['time_step_s']
+                ps['n_points'] = max([int(round(ps['n_points'] / f)), 1])
+
+def return_adjustments(manipulations, p_vector):
+    """ Returns adjustments from a fitting structure """
+        
+    # Set parameter multipliers for the adjustments
+    adj = manipulations['adjustments']       
+
+    # Cycle through the adjustments setting the multiplier based on the
+    # p_vector. We will make a new array of adjustments here to allow for
+    # base variants
+    
+    new_adjustments = []
+    p_counter = 0
+    
+    for (i, a) in enumerate(adj):
+        span = a['factor_bounds'][1] - a['factor_bounds'][0]
+        m = a['factor_bounds'][0] + p_vector[p_counter] * span
+        a['multipliers'] = []
+        if ('factor_mode' in a):
+            if (a['factor_mode'] == "log"):
+                a['multipliers'].append(np.power(10, m))
+        else:
+            a['multipliers'].append(m)
+        del a['factor_bounds']
+        
+        new_adjustments.append(a)
+        
+        p_counter = p_counter + 1
+        
+        # Check for a constraint
+        if ('also_linked' in a):
+            
+            # Special case
+            digits = [int(s) for s in re.findall(r'\d+', a['also_linked'])]
+            print(digits)
+            
+            linked_a = dict();
+            linked_a['variable'] = a['variable']
+            linked_a['isotype'] = digits[0]
+            linked_a['state'] = digits[1]
+            
+            if not ('extension' in a):
+                linked_a['transition'] = digits[2]
+                linked_a['parameter_number'] = digits[3]
+            else:
+                linked_a['extension'] = a['extension']
+
+            linked_a['multipliers'] = []
+            if ('factor_mode' in a):
+                if (a['factor_mode'] == "log"):
+                    mult = np.power(10, m)
+            else:
+                mult = m
+            linked_a['multipliers'].append(mult)
+            
+            new_adjustments.append(linked_a)
+        
+    # Now we need to check for base_variants
+    # We will handle these by adding new elements to the multipliers list for
+    # each adjustment
+    if ('base_variants' in 'manipulations'):
+        base_variants = manipulations['base_variants']
+        
+        # Cycle through the base variants
+        for (i,bv) in enumerate(base_variants):
+    
+            # Work out the index for the parameter we are adding
+            new_mult_index = len(new_adjustments[0]['multipliers'])
+            
+            # And now the adjustments
+            for (j, a) in enumerate(bv['adjustments']):
+    
+                # Work out what the new value will be
+                if ('multipliers' in a):
+                    new_value = a['multipliers'][0]
+                else:
+                    span = a['factor_bounds'][1] - a['factor_bounds'][0]
+                    new_value = a['factor_bounds'][0] + p_vector[p_counter] * span
+                    if (a['factor_mode'] == 'log'):
+                        new_value = np.power(10, new_value)
+                    
+                    p_counter = p_counter + 1
+                
+                # Work out whether the adjustment is new or
+                # matches an existing entry         
+                matching_ind = return_matching_adjustment_index(
+                                    new_adjustments, a)
+                    
+                # Branch depending on match
+                if (matching_ind == -1):
+                    # There's no match
+                    # Duplicate the last multiplier for other adjustments
+                    # Add in a 1, x muliplier for the test
+                    
+                    for na in new_adjustments:
+                        y = na['multipliers']
+                        if (len(y) <= new_mult_index):
+                            na['multipliers'].append(y[-1])
+                        else:
+                            na['multipliers'][new_mult_index] = y[-1]
+                        
+                    # Now add in the new one
+                    a['multipliers'] = [new_value]
+                    a['multipliers'].insert(-1, 1)
+                    
+                    # Clean up the adjustment
+                    if ('factor_bounds' in a):
+                        del a['factor_bounds']
+                        
+                    if ('factor_mode' in a):
+                        del a['factor_mode']
+                    
+                    new_adjustments.append(a)
+                    
+                else:
+                    # There is a match.
+                    # Add in fixed multiplier for the match
+                    # Duplicate the last multiplier for the
+                    # non-matching adjustments
+                    
+                    for (k,na) in enumerate(new_adjustments):
+                        if (k == matching_ind):
+                            # Match
+                            y = na['multipliers']
+                            if (len(y) <= new_mult_index):
+                                na['multipliers'].append(new_value)
+                            else:
+                                na['multipliers'][new_mult_index] = new_value
+                        else:
+                            # Non-match
+                            y = na['multipliers']
+                            if (len(y) <= new_mult_index):
+                                na['multipliers'].append(y[-1])
+                            else:
+                                na['multipliers'][new_mult_index] = \
+                                    y[-1]
+    
+    # Return
+    return new_adjustments                                    
+
+
+def return_matching_adjustment_index(existing, test):
+    """ Compares the test adjustment to the existing ones and
+        returns an index for a match, or -1 if there is no match """
+    
+    for (i,a) in enumerate(existing):
+        if (test['variable'] == a['variable']):
+            if ('isotype' in a):
+                # It's a kinetic parameter, check the other matches
+                try:
+                    if (test['isotype'] == a['isotype']) and \
+                            (test['state'] == a['state']) and \
+                            (test['transition'] == a['transition']) and \
+                            (test['parameter_number'] == a['parameter_number']):
+                        # It's a match
+                        return i
+                except:
+                    pass
+            else:
+                # It's a non-kinetic parameter
+                if (test['class'] == a['class']):
+                    # It's a match
+                    return i
+    
+    # No match
+    return -1
+
+def return_sim_dir(char_dict):
+    """ Parses a char_dict to get a simulation directory that is
+        appropriate for a thread structure """
+    
+    sim_dir = char_dict['sim_folder']
+    
+    keep_going = True
+    while (keep_going):
+        if (sim_dir.startswith('../')):
+            sim_dir = sim_dir[3::]
+        else:
+            keep_going = False
+    
+    return sim_dir
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only logs for the progress of a fit
+
+Each evaluation is appended to a JSON-lines file as a single line, so the
+cost of recording a trial does not grow with the length of the fit, and
+a fit that is killed loses at most the line being written. The log is
+held in memory as well and can be exported to Excel, or plotted, when it
+is needed.
+"""
+
+import os
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+def return_json_value(x):
+    """ Converts numpy scalars for json.dumps """
+
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError('%s is not JSON serializable' % type(x))
+
+
+class progress_log():
+    """ Class for an append-only log of trials """
+
+    def __init__(self, log_file_string):
+
+        self.log_file_string = log_file_string
+        self.entries = []
+        self.lock = threading.Lock()
+
+        # Read any existing entries
+        if os.path.isfile(log_file_string):
+            with open(log_file_string, 'rb+') as f:
+                data = f.read()
+
+                # The last line is cut short if the fit was killed while
+                # it was being written. Remove it, so that the next
+                # entry starts on a new line
+                if data and not data.endswith(b'\n'):
+                    data = data[0:(data.rfind(b'\n') + 1)]
+                    f.seek(len(data))
+                    f.truncate()
+
+            for line in data.decode('utf-8').splitlines():
+                try:
+                    self.entries.append(json.loads(line))
+                except ValueError:
+                    continue
+
+    def append(self, entries):
+        """ Appends a list of dicts to the log """
+
+        lines = ['%s\n' % json.dumps(e, default=return_json_value)
+                 for e in entries]
+
+        with self.lock:
+            self.entries.extend(entries)
+            with open(self.log_file_string, 'a') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def return_data_frame(self):
+        """ Returns the log as a DataFrame """
+
+        return pd.DataFrame(self.entries)
+
+    def write_excel(self, excel_file_string):
+        """ Exports the log to an Excel file """
+
+        if not self.entries:
+            return
+
+        self.return_data_frame().to_excel(excel_file_string, index=False)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Surrogate model used by the surrogate optimizer in fit_model
+
+A Gaussian process, with a Matern 5/2 kernel and a length scale for each
+parameter, is fitted to the log10 of the errors that have already been
+calculated. Candidates are proposed in batches. Each candidate maximizes
+the expected improvement over the best error so far, and is then added
+to the model at its predicted value (the kriging believer heuristic) so
+that the rest of the batch is drawn from other regions.
+
+Parameters are assumed to lie between 0 and 1, as they do in fit_model.
+"""
+
+import numpy as np
+
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+from scipy.special import ndtr
+
+
+# Bounds for the log of the hyperparameters
+log_length_scale_bounds = np.log([1e-2, 1e1])
+log_signal_var_bounds = np.log([1e-2, 1e2])
+log_noise_var_bounds = np.log([1e-6, 1e-1])
+
+
+def matern_52(X_1, X_2, length_scales, signal_var):
+    """ Returns the Matern 5/2 covariance between the rows of X_1 and X_2 """
+
+    d = (X_1[:, np.newaxis, :] - X_2[np.newaxis, :, :]) / length_scales
+    r = np.sqrt(5.0 * np.sum(d**2, axis=-1))
+
+    return signal_var * (1.0 + r + (r**2 / 3.0)) * np.exp(-r)
+
+
+class gaussian_process():
+    """ Class for a Gaussian process regression """
+
+    def __init__(self, no_of_dimensions):
+
+        self.log_length_scales = np.zeros(no_of_dimensions) + np.log(0.3)
+        self.log_signal_var = 0.0
+        self.log_noise_var = np.log(1e-4)
+
+    def fit(self, X, y, optimize=True):
+        """ Fits the model to the rows of X and the values in y. If
+            optimize is False, the hyperparameters are not changed """
+
+        self.X = np.atleast_2d(X)
+        y = np.asarray(y, dtype=float)
+
+        # Standardize the values
+        self.y_mean = np.mean(y)
+        self.y_std = np.std(y)
+        if not (self.y_std > 0):
+            self.y_std = 1.0
+        self.y = (y - self.y_mean) / self.y_std
+
+        if optimize and (len(y) > 1):
+            theta_0 = self.return_theta()
+            bounds = ([tuple(log_length_scale_bounds)] * len(self.log_length_scales) +
+                      [tuple(log_signal_var_bounds),
+                       tuple(log_noise_var_bounds)])
+            res = minimize(self.return_negative_log_likelihood, theta_0,
+                           method='L-BFGS-B', bounds=bounds)
+            if np.isfinite(res.fun):
+                self.set_theta(res.x)
+
+        self.factorize()
+
+    def return_theta(self):
+        """ Returns the hyperparameters as a vector """
+
+        return np.concatenate((self.log_length_scales,
+                               [self.log_signal_var, self.log_noise_var]))
+
+    def set_theta(self, theta):
+        """ Sets the hyperparameters from a vector """
+
+        self.log_length_scales = theta[0:-2]
+        self.log_signal_var = theta[-2]
+        self.log_noise_var = theta[-1]
+
+    def return_covariance(self, theta):
+        """ Returns the covariance matrix of the observations """
+
+        K = matern_52(self.X, self.X, np.exp(theta[0:-2]), np.exp(theta[-2]))
+        K[np.diag_indices_from(K)] += np.exp(theta[-1]) + 1e-10
+
+        return K
+
+    def return_negative_log_likelihood(self, theta):
+        """ Returns the negative log marginal likelihood """
+
+        try:
+            (L, lower) = cho_factor(self.return_covariance(theta), lower=True)
+        except np.linalg.LinAlgError:
+            return np.inf
+
+        alpha = cho_solve((L, lower), self.y)
+
+        return (0.5 * (self.y @ alpha)) + np.sum(np.log(np.diag(L)))
+
+    def factorize(self):
+        """ Factorizes the covariance matrix for predictions """
+
+        self.L = cho_factor(self.return_covariance(self.return_theta()),
+                            lower=True)
+        self.alpha = cho_solve(self.L, self.y)
+
+    def predict(self, X):
+        """ Returns the predicted mean and standard deviation at the rows
+            of X """
+
+        X = np.atleast_2d(X)
+
+        K_s = matern_52(X, self.X, np.exp(self.log_length_scales),
+                        np.exp(self.log_signal_var))
+
+        mean = K_s @ self.alpha
+        v = cho_solve(self.L, K_s.T)
+        var = np.exp(self.log_signal_var) - np.sum(K_s * v.T, axis=1)
+        std = np.sqrt(np.maximum(var, 1e-12))
+
+        return ((self.y_mean + self.y_std * mean), (self.y_std * std))
+
+
+def expected_improvement(mean, std, best_value, xi=0.01):
+    """ Returns the expected improvement below best_value """
+
+    improvement = best_value - mean - xi
+    z = improvement / std
+    pdf = np.exp(-0.5 * z**2) / np.sqrt(2 * np.pi)
+
+    return (improvement * ndtr(z)) + (std * pdf)
+
+def return_candidates(X, y, no_of_candidates, rng, local_sd=0.05,
+                      no_of_local_centers=5):
+    """ Returns random candidates spread across the parameter space, and
+        around the best points so far """
+
+    no_of_dimensions = X.shape[1]
+    no_of_local = no_of_candidates // 2
+
+    candidates = rng.random((no_of_candidates - no_of_local,
+                             no_of_dimensions))
+
+    centers = X[np.argsort(y)[0:no_of_local_centers], :]
+    local = centers[rng.integers(0, len(centers), no_of_local), :] + \
+        local_sd * rng.standard_normal((no_of_local, no_of_dimensions))
+
+    return np.clip(np.vstack((candidates, local)), 0, 1)
+
+def propose_batch(X, y, batch_size, rng=None, no_of_candidates=4000,
+                  no_of_dimensions=None):
+    """ Fits a surrogate to the rows of X and the values in y and returns
+        an array of batch_size candidates to evaluate next. If there are
+        fewer than two finite values, the candidates are drawn at random """
+
+    if (rng is None):
+        rng = np.random.default_rng()
+
+    y = np.asarray(y, dtype=float).ravel()
+    if (no_of_dimensions is None):
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        no_of_dimensions = X.shape[1]
+    else:
+        X = np.asarray(X, dtype=float).reshape(len(y), no_of_dimensions)
+
+    # Only finite values can be modeled
+    keep = np.isfinite(y)
+    X = X[keep, :]
+    y = y[keep]
+
+    # The model cannot be fitted yet, for example when the first
+    # simulations at full fidelity have failed
+    if (len(y) < 2):
+        return rng.random((batch_size, no_of_dimensions))
+
+    gp = gaussian_process(no_of_dimensions)
+    gp.fit(X, y)
+
+    X_batch = []
+    for i in range(batch_size):
+        candidates = return_candidates(gp.X, gp.y_mean + gp.y_std * gp.y,
+                                       no_of_candidates, rng)
+        (mean, std) = gp.predict(candidates)
+        ei = expected_improvement(mean, std, np.amin(y))
+        x_new = candidates[np.argmax(ei), :]
+        X_batch.append(x_new)
+
+        # Assume the prediction is right for the rest of the batch
+        if (i < (batch_size - 1)):
+            y_believed = gp.predict(x_new)[0]
+            gp.fit(np.vstack((gp.X, x_new)),
+                   np.concatenate((gp.y_mean + gp.y_std * gp.y, y_believed)),
+                   optimize=False)
+
+    return np.asarray(X_batch)
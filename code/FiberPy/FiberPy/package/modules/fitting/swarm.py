@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Particle swarm used by fit_model
+
+The positions, velocities and best values of the particles are held as
+arrays, and the update for any subset of the particles is calculated in
+one step. This allows the swarm to be updated a particle at a time, so
+that a new simulation can start as soon as a particle has been evaluated.
+
+Each particle is pulled towards its own best position and an attractor
+that is set by the strategy:
+    global  the best position found by the swarm
+    ring    the best position found by the particle or its two
+            neighbours, which explores for longer before converging
+A strategy can also be a function f(swarm, indices) that returns one
+attractor for each particle in indices.
+
+When early evaluations are run at reduced fidelity, errors at different
+fidelity levels cannot be compared. The best values are reset whenever
+the fidelity level changes. Candidates that were run again at full
+fidelity are held until the swarm reaches full fidelity, and are then
+recorded as the first full-fidelity bests.
+
+The state of the swarm, including the random number generator, can be
+written to a checkpoint file and restored.
+"""
+
+import os
+import json
+
+import numpy as np
+
+
+def return_global_attractor(swarm, indices):
+    """ Returns the global best position for each particle """
+
+    return np.tile(swarm.global_best_x, (len(indices), 1))
+
+def return_ring_attractor(swarm, indices):
+    """ Returns the best position of each particle and its neighbours """
+
+    neighbours = (indices[:, np.newaxis] + np.array([-1, 0, 1])) % \
+        swarm.n_particles
+    best = np.argmin(swarm.particle_best_value[neighbours], axis=1)
+
+    return swarm.particle_best_x[neighbours[np.arange(len(indices)), best]]
+
+swarm_strategies = {'global': return_global_attractor,
+                    'ring': return_ring_attractor}
+
+
+class particle_swarm():
+    """ Class for a particle swarm """
+
+    def __init__(self, p_vector, n_particles,
+                 bounds = [0, 1],
+                 inertia = 0.9, w_self = 0.5, w_family = 0.3,
+                 initial_vel = 0.1,
+                 vel_bounds = [0.02, 0.2],
+                 vel_factor = 1,
+                 jitter = 0.03,
+                 throw = 1000,
+                 resize_bounds = 15,
+                 resize_bounds_factor = 0.75,
+                 strategy = 'global',
+                 rng = None):
+
+        self.n_particles = n_particles
+        self.no_of_dimensions = len(p_vector)
+        self.bounds = bounds
+        self.inertia = inertia
+        self.w_self = w_self
+        self.w_family = w_family
+        self.vel_bounds = vel_bounds
+        self.vel_factor = vel_factor
+        self.jitter = jitter
+        self.throw_interval = throw
+        self.resize_interval = resize_bounds
+        self.resize_bounds_factor = resize_bounds_factor
+
+        if callable(strategy):
+            self.strategy = strategy
+        else:
+            self.strategy = swarm_strategies[strategy]
+
+        if (rng is None):
+            rng = np.random.default_rng()
+        self.rng = rng
+
+        # Set the initial values, with the first particle at p_vector
+        shape = (n_particles, self.no_of_dimensions)
+        self.x = bounds[0] + (bounds[1] - bounds[0]) * self.rng.random(shape)
+        self.x[0, :] = p_vector
+        self.v = initial_vel * np.ones(shape)
+
+        # Set bounds for each parameter
+        self.x_bounds = np.zeros((self.no_of_dimensions, 2))
+        self.x_bounds[:, 0] = bounds[0]
+        self.x_bounds[:, 1] = bounds[1]
+
+        self.global_best_value = np.inf
+        self.global_best_x = np.nan * np.ones(self.no_of_dimensions)
+        self.particle_best_value = np.inf * np.ones(n_particles)
+        self.particle_best_x = np.nan * np.ones(shape)
+        self.particle_max_vel = vel_bounds[-1] * np.ones(n_particles)
+
+        # The number of completed iterations, and a counter that changes
+        # each time particles are reset, so that results for positions
+        # from before the reset can be recognized
+        self.iteration = 0
+        self.epoch = 0
+
+        # The number of evaluations recorded by an asynchronous swarm
+        self.no_of_evaluations = 0
+
+        # The fidelity level of the values that set the bests, and the
+        # full-fidelity results held until the swarm reaches full fidelity
+        self.fidelity_level = None
+        self.promoted_index = []
+        self.promoted_value = []
+        self.promoted_x = []
+
+    def record(self, indices, values, x=None, epoch=None):
+        """ Records the values for the particles in indices, evaluated at
+            x, which defaults to their current positions """
+
+        indices = np.atleast_1d(indices)
+        values = np.atleast_1d(values)
+        if (x is None):
+            x = self.x[indices, :]
+        x = np.atleast_2d(x)
+
+        # Results from before a reset only count towards the global best
+        if (epoch is None) or (epoch == self.epoch):
+            improved = values < self.particle_best_value[indices]
+            self.particle_best_value[indices[improved]] = values[improved]
+            self.particle_best_x[indices[improved], :] = x[improved, :]
+
+        if np.any(values < self.global_best_value):
+            best = np.argmin(values)
+            self.global_best_value = values[best]
+            self.global_best_x = x[best, :].copy()
+
+    def set_fidelity_level(self, fidelity_level):
+        """ Sets the fidelity level for the values that will be recorded,
+            resetting the bests if it has changed """
+
+        if (self.fidelity_level is not None) and \
+                (fidelity_level != self.fidelity_level):
+            self.reset_bests()
+        self.fidelity_level = fidelity_level
+
+        # Record the candidates that were run at full fidelity
+        if (fidelity_level == 0):
+            for (i, value, x) in zip(self.promoted_index,
+                                     self.promoted_value,
+                                     self.promoted_x):
+                self.record(i, value, x=np.asarray(x))
+            self.promoted_index = []
+            self.promoted_value = []
+            self.promoted_x = []
+
+    def record_promoted(self, indices, values, x):
+        """ Records full-fidelity values for the particles in indices,
+            evaluated at the rows of x. They are held until the swarm
+            reaches full fidelity """
+
+        for (i, value, xi) in zip(np.atleast_1d(indices),
+                                  np.atleast_1d(values),
+                                  np.atleast_2d(x)):
+            if (self.fidelity_level == 0):
+                self.record(i, value, x=xi)
+            else:
+                self.promoted_index.append(int(i))
+                self.promoted_value.append(float(value))
+                self.promoted_x.append(xi.tolist())
+
+    def reset_bests(self):
+        """ Forgets the best values and positions, for example because
+            the values recorded next are from a different model """
+
+        self.global_best_value = np.inf
+        self.global_best_x = np.nan * np.ones(self.no_of_dimensions)
+        self.particle_best_value[:] = np.inf
+        self.particle_best_x[:] = np.nan
+
+        self.epoch = self.epoch + 1
+
+    def update(self, indices=None):
+        """ Moves the particles in indices, which defaults to all of them """
+
+        if (indices is None):
+            indices = np.arange(self.n_particles)
+        indices = np.atleast_1d(indices)
+
+        x = self.x[indices, :]
+        shape = x.shape
+
+        # Particles that do not have a best position yet stay put
+        particle_best_x = self.particle_best_x[indices, :]
+        particle_best_x = np.where(np.isnan(particle_best_x), x,
+                                   particle_best_x)
+        attractor = self.strategy(self, indices)
+        attractor = np.where(np.isnan(attractor), x, attractor)
+
+        v = self.inertia * self.v[indices, :] + \
+            self.w_self * self.rng.random(shape) * (particle_best_x - x) + \
+            self.w_family * self.rng.random(shape) * (attractor - x)
+
+        max_vel = self.particle_max_vel[indices, np.newaxis]
+        v = np.clip(v, -max_vel, max_vel)
+
+        # Add in some jitter
+        x = x + v + self.jitter * (self.rng.random(shape) - 0.5)
+        x = np.clip(x, self.x_bounds[:, 0], self.x_bounds[:, 1])
+
+        self.v[indices, :] = v
+        self.x[indices, :] = x
+
+        self.particle_max_vel[indices] = np.maximum(
+            self.particle_max_vel[indices] * self.vel_factor,
+            self.vel_bounds[0])
+
+    def end_iteration(self):
+        """ Counts an iteration and resizes the bounds or throws out
+            particles when they are due """
+
+        self.iteration = self.iteration + 1
+
+        if ((self.iteration % self.resize_interval) == 0):
+            self.resize_bounds()
+
+        if ((self.iteration % self.throw_interval) == 0):
+            self.throw()
+
+    def resize_bounds(self):
+        """ Shrinks the bounds around the global best position and resets
+            the particles within them """
+
+        x_new_range = self.resize_bounds_factor * \
+            (self.x_bounds[:, 1] - self.x_bounds[:, 0])
+
+        # Try to center the range around the best point
+        lower = self.global_best_x - (0.5 * x_new_range)
+        upper = self.global_best_x + (0.5 * x_new_range)
+
+        # If you are clipping, preserve the range
+        vi = (lower < self.bounds[0])
+        lower[vi] = self.bounds[0]
+        upper[vi] = self.bounds[0] + x_new_range[vi]
+
+        vi = (upper > self.bounds[1])
+        upper[vi] = self.bounds[1]
+        lower[vi] = self.bounds[1] - x_new_range[vi]
+
+        self.x_bounds[:, 0] = lower
+        self.x_bounds[:, 1] = upper
+
+        # Now reset particles within the bounds
+        self.x = lower + (upper - lower) * self.rng.random(self.x.shape)
+        self.particle_best_value[:] = np.inf
+        self.particle_best_x = self.x.copy()
+        self.particle_max_vel = self.resize_bounds_factor * \
+            self.particle_max_vel
+
+        self.epoch = self.epoch + 1
+
+    def throw(self):
+        """ Throws out a third of the particles """
+
+        vi = np.arange(round(self.n_particles / 3))
+
+        self.x[vi, :] = self.rng.random((len(vi), self.no_of_dimensions))
+        self.v[vi, :] = 0
+        self.particle_best_value[vi] = np.inf
+        self.particle_best_x[vi, :] = self.x[vi, :]
+        self.particle_max_vel[vi] = self.vel_bounds[-1]
+
+        self.epoch = self.epoch + 1
+
+    def return_state(self):
+        """ Returns the state of the swarm as a dict that can be written
+            to JSON """
+
+        state = dict()
+        for k in ['x', 'v', 'x_bounds', 'global_best_x',
+                  'particle_best_value', 'particle_best_x',
+                  'particle_max_vel']:
+            state[k] = getattr(self, k).tolist()
+        state['global_best_value'] = float(self.global_best_value)
+        state['iteration'] = self.iteration
+        state['epoch'] = self.epoch
+        state['no_of_evaluations'] = self.no_of_evaluations
+        state['fidelity_level'] = self.fidelity_level
+        state['promoted_index'] = self.promoted_index
+        state['promoted_value'] = self.promoted_value
+        state['promoted_x'] = self.promoted_x
+        state['rng'] = self.rng.bit_generator.state
+
+        return state
+
+    def set_state(self, state):
+        """ Restores the state of the swarm from a dict """
+
+        for k in ['x', 'v', 'x_bounds', 'global_best_x',
+                  'particle_best_value', 'particle_best_x',
+                  'particle_max_vel']:
+            setattr(self, k, np.asarray(state[k], dtype=float))
+        self.global_best_value = state['global_best_value']
+        self.iteration = state['iteration']
+        self.epoch = state['epoch']
+        if ('no_of_evaluations' in state):
+            self.no_of_evaluations = state['no_of_evaluations']
+        else:
+            self.no_of_evaluations = self.iteration * self.n_particles
+        for k in ['fidelity_level', 'promoted_index', 'promoted_value',
+                  'promoted_x']:
+            if (k in state):
+                setattr(self, k, state[k])
+        self.rng.bit_generator.state = state['rng']
+
+    def save_checkpoint(self, checkpoint_file_string):
+        """ Writes the state of the swarm to a file, replacing the
+            previous checkpoint only once the new one is complete """
+
+        temp_file_string = '%s.tmp' % checkpoint_file_string
+        with open(temp_file_string, 'w') as f:
+            json.dump(self.return_state(), f)
+        os.replace(temp_file_string, checkpoint_file_string)
+
+    def load_checkpoint(self, checkpoint_file_string):
+        """ Restores the state of the swarm from a file """
+
+        with open(checkpoint_file_string, 'r') as f:
+            self.set_state(json.load(f))
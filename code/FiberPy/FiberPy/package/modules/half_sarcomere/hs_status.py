@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Array-based reader for hs_status dump files
+
+half_sarcomere.half_sarcomere loads a dump file into nested lists, one
+per filament. The hs_status class here holds the same data as NumPy
+arrays instead. Each per-filament field, such as cb_state or bs_x, is
+stored as a 2D array with one row per filament, and each per-filament
+scalar, such as m_no_of_cbs, as a 1D array. For example
+
+    hs = hs_status.hs_status(dump_file)
+    hs['thick']['cb_state'][i, j]   # state of head j on thick filament i
+
+FiberCpp writes one field per line, so each line is converted straight
+into an array without building intermediate Python lists. Files that do
+not follow that layout are read with json instead.
+
+iterate_dump_folder() yields one hs_status at a time, so the memory used
+does not grow with the number of dump files.
+"""
+
+import os
+import json
+
+import numpy as np
+
+from natsort import natsorted
+
+
+class hs_status(dict):
+    """ Array-backed half-sarcomere status """
+
+    def __init__(self, json_file_string, fields=None):
+        """ Reads a status file
+
+        Parameters
+        ----------
+        json_file_string : string
+            Path to the dump file
+        fields : list, optional
+            Filament fields to read. All fields are read if this is None.
+            Skipping the fields that are not needed saves time and memory
+        """
+
+        self.json_file_string = json_file_string
+
+        try:
+            data = parse_status_lines(json_file_string, fields)
+        except ValueError:
+            # Fall back to the json parser
+            with open(json_file_string, 'r') as f:
+                json_data = json.load(f)
+            data = dict()
+            data['hs_data'] = json_data['hs_data']
+            data['titin'] = json_data['titin']
+            for fil_type in ['thick', 'thin']:
+                data[fil_type] = stack_filaments(json_data[fil_type], fields)
+
+        self['hs_data'] = data['hs_data']
+        self['titin'] = data['titin']
+        self['thick'] = data['thick']
+        self['thin'] = data['thin']
+
+    def no_of_filaments(self, fil_type):
+        """ Returns the number of thick or thin filaments """
+
+        for v in self[fil_type].values():
+            return len(v)
+        return 0
+
+
+def return_dump_files(dump_folder):
+    """ Returns the dump files in a folder in time order """
+
+    dump_files = []
+    for f in os.listdir(dump_folder):
+        if f.endswith('.json'):
+            dump_files.append(os.path.join(dump_folder, f))
+
+    return natsorted(dump_files)
+
+
+def iterate_dump_folder(dump_folder, fields=None):
+    """ Yields an hs_status for each dump file in a folder, in time order.
+        Only one file is held in memory at a time """
+
+    for f in return_dump_files(dump_folder):
+        yield hs_status(f, fields)
+
+
+def parse_status_lines(json_file_string, fields=None):
+    """ Parses a dump file written by FiberCpp line by line. Raises
+        ValueError if the file does not have the expected layout """
+
+    data = dict()
+    filaments = dict()
+    filaments['thick'] = []
+    filaments['thin'] = []
+
+    section = []
+    current = []
+
+    with open(json_file_string, 'r') as f:
+        for line in f:
+            s = line.strip()
+
+            if not s or (s in ['{', '}', '},', ']', '],']):
+                if current and (s in ['}', '},']):
+                    # End of a filament or a block
+                    if (section in ['thick', 'thin']):
+                        filaments[section].append(current)
+                    else:
+                        data[section] = current
+                    current = []
+                continue
+
+            if not s.startswith('"'):
+                raise ValueError('Unexpected line in %s' % json_file_string)
+
+            (key, sep, value) = s.partition('":')
+            if not sep:
+                raise ValueError('Unexpected line in %s' % json_file_string)
+            key = key[1:]
+            value = value.strip().rstrip(',')
+
+            # Start of a block
+            if (value == '{'):
+                section = key
+                current = dict()
+                continue
+            if (value == '['):
+                section = key
+                continue
+
+            if not isinstance(current, dict):
+                current = dict()
+
+            # Skip fields that are not needed, without parsing them
+            if (section in ['thick', 'thin']) and (fields is not None) and \
+                    not (key in fields):
+                continue
+
+            if (section in ['thick', 'thin']) and value.startswith('['):
+                current[key] = parse_array(value)
+            else:
+                current[key] = json.loads(value)
+
+    if not ('hs_data' in data) or not ('titin' in data):
+        raise ValueError('Missing blocks in %s' % json_file_string)
+
+    for fil_type in ['thick', 'thin']:
+        data[fil_type] = stack_filaments(filaments[fil_type], fields)
+
+    return data
+
+
+def parse_array(value):
+    """ Converts a string such as [1, 2, 3] to a NumPy array """
+
+    inner = value[1:-1]
+    if not inner.strip():
+        return np.zeros(0)
+
+    if any(c in inner for c in '.eEn'):
+        dtype = float
+    else:
+        dtype = int
+
+    a = np.fromstring(inner, dtype=dtype, sep=',')
+    if (len(a) != (inner.count(',') + 1)):
+        raise ValueError('Could not parse array')
+
+    return a
+
+
+def stack_filaments(filaments, fields=None):
+    """ Combines a list of filament dicts into a dict of arrays with one
+        row per filament """
+
+    d = dict()
+    if (len(filaments) == 0):
+        return d
+
+    for key in filaments[0]:
+        if (fields is not None) and not (key in fields):
+            continue
+
+        values = [np.asarray(fil[key]) for fil in filaments]
+
+        if (values[0].ndim == 0):
+            d[key] = np.asarray(values)
+        elif all(len(v) == len(values[0]) for v in values):
+            d[key] = np.stack(values)
+        else:
+            # Ragged fields stay as a list of arrays
+            d[key] = values
+
+    return d
@@ -17,6 +17,7 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
 from ..display.multi_panel import multi_panel_from_flat_data
+from ..analysis import results_files as rf
 
 
 class output_handler():
@@ -42,8 +43,7 @@ class output_handler():
         # have been passed in
         if sim_results_file_string:
             print('Loading sim data from %s' % sim_results_file_string)
-            sim_data = pd.read_csv(sim_results_file_string,
-                                   delimiter='\t')
+            sim_data = rf.load_results(sim_results_file_string)
 
         # Check we have data to do something with
         if not isinstance(sim_data, pd.DataFrame):
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Builds protocols from segments
+
+A protocol_builder holds a list of segments (holds, length ramps and k_tr
+release/restretch cycles) that set the dt, delta_hsl and mode columns.
+The pCa column is added afterwards, optionally with a step up at the start
+and a step down at the end. Jobs in a pCa sweep share the same segments,
+so the shared columns are built, and formatted as text, once and only the
+pCa column is formatted for each job.
+
+protocol_writer collects the protocols for a batch and writes them in
+blocks of about buffer_size characters. The files are identical to those
+written by protocols.write_protocol_to_file().
+"""
+
+import os
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+class protocol_builder():
+    """ Class for a protocol built from segments """
+
+    def __init__(self):
+
+        self.segments = []
+        self.columns = None
+        self.text_columns = None
+
+    def add_hold(self, duration_s, time_step_s, mode=-2):
+        """ Adds a period with no length change """
+
+        n_points = int(duration_s / time_step_s)
+        self.add_segment(return_hold_segment(n_points, time_step_s, mode))
+
+    def add_ramp(self, duration_s, time_step_s, delta_hsl_nm, mode=-1):
+        """ Adds a length change spread evenly over a period. The ramp
+            has at least one point, so a short ramp is not lost when the
+            time step is coarsened """
+
+        n_points = max([int(duration_s / time_step_s), 1])
+        self.add_segment(return_ramp_segment(n_points, time_step_s,
+                                             delta_hsl_nm, mode))
+
+    def add_k_tr(self, duration_s, time_step_s, ramp_s, magnitude_nm):
+        """ Adds a k_tr maneuver, a rapid release followed by a restretch
+            to the original length at the end of the period """
+
+        n_points = int(duration_s / time_step_s)
+        ramp_points = max([int(ramp_s / time_step_s), 1])
+        self.add_segment(return_k_tr_segment(n_points, time_step_s,
+                                             ramp_points, magnitude_nm))
+
+    def add_segment(self, segment):
+        """ Adds a segment, defined as a (dt, delta_hsl, mode) tuple """
+
+        self.segments.append(segment)
+        self.columns = None
+        self.text_columns = None
+
+    def return_columns(self):
+        """ Returns the dt, delta_hsl and mode arrays for the protocol """
+
+        if (self.columns is None):
+            self.columns = tuple(np.hstack([s[i] for s in self.segments])
+                                 for i in range(3))
+        return self.columns
+
+    def return_pCa(self, pCa, pCa_start=9.0, pCa_stop=9.0,
+                   pCa_step_up_s=None, pCa_step_down_s=None):
+        """ Returns the pCa array for a protocol at pCa, stepping up from
+            pCa_start and down to pCa_stop if the times are set """
+
+        (dt, delta_hsl, mode) = self.return_columns()
+
+        pCa_vector = pCa * np.ones(len(dt))
+
+        if (pCa_step_up_s is not None) or (pCa_step_down_s is not None):
+            t = np.cumsum(dt)
+            if (pCa_step_up_s is not None):
+                pCa_vector[t < pCa_step_up_s] = pCa_start
+            if (pCa_step_down_s is not None):
+                pCa_vector[t > pCa_step_down_s] = pCa_stop
+
+        return pCa_vector
+
+    def return_protocol(self, pCa_vector):
+        """ Returns the protocol as a DataFrame """
+
+        (dt, delta_hsl, mode) = self.return_columns()
+
+        return pd.DataFrame({'dt': dt,
+                             'pCa': pCa_vector,
+                             'delta_hsl': delta_hsl,
+                             'mode': mode})
+
+    def return_protocol_text(self, pCa_vector):
+        """ Returns the protocol as the text written to a protocol file """
+
+        if (self.text_columns is None):
+            (dt, delta_hsl, mode) = self.return_columns()
+            left = format_column(dt)
+            right = ['\t%s\t%s\n' % (x, m) for (x, m) in
+                     zip(format_column(delta_hsl), format_column(mode))]
+            self.text_columns = (left, right)
+
+        (left, right) = self.text_columns
+        pCa_strings = format_column(pCa_vector)
+
+        return 'dt\tpCa\tdelta_hsl\tmode\n' + \
+            ''.join(['%s\t%s%s' % row for row in
+                     zip(left, pCa_strings, right)])
+
+
+class protocol_writer():
+    """ Class that collects protocol files and writes them together """
+
+    def __init__(self, buffer_size=1048576):
+
+        self.buffer_size = buffer_size
+        self.protocols = []
+        self.queued_size = 0
+        self.no_of_protocols = 0
+        self.parent_dirs = set()
+
+    def add(self, prot_text, prot_file_string):
+        """ Queues a protocol, as text, to be written to prot_file_string.
+            The queue is written once it holds more than buffer_size
+            characters, so that a large batch is not held in memory """
+
+        self.protocols.append((prot_file_string, prot_text))
+        self.queued_size = self.queued_size + len(prot_text)
+
+        if (self.queued_size > self.buffer_size):
+            self.flush()
+
+    def flush(self):
+        """ Writes the queued protocols and empties the queue """
+
+        # Create each parent folder once
+        for parent_dir in set([os.path.dirname(p[0])
+                               for p in self.protocols]):
+            if parent_dir and not (parent_dir in self.parent_dirs):
+                if not os.path.isdir(parent_dir):
+                    print('Creating parent dir: %s' % parent_dir)
+                    os.makedirs(parent_dir)
+                self.parent_dirs.add(parent_dir)
+
+        for (prot_file_string, prot_text) in self.protocols:
+            with open(prot_file_string, 'w',
+                      buffering=self.buffer_size) as f:
+                f.write(prot_text)
+
+        self.no_of_protocols = self.no_of_protocols + len(self.protocols)
+        self.protocols = []
+        self.queued_size = 0
+
+    def write(self):
+        """ Writes any protocols that are still queued """
+
+        self.flush()
+
+        if (self.no_of_protocols > 0):
+            print('Wrote %i protocols' % self.no_of_protocols)
+            self.no_of_protocols = 0
+
+
+@lru_cache(maxsize=64)
+def return_hold_segment(n_points, time_step_s, mode):
+    """ Returns the arrays for a hold """
+
+    return freeze_segment(time_step_s * np.ones(n_points),
+                          np.zeros(n_points),
+                          mode * np.ones(n_points))
+
+@lru_cache(maxsize=64)
+def return_ramp_segment(n_points, time_step_s, delta_hsl_nm, mode):
+    """ Returns the arrays for a length ramp """
+
+    inc = delta_hsl_nm / float(n_points)
+
+    return freeze_segment(time_step_s * np.ones(n_points),
+                          inc * np.ones(n_points),
+                          mode * np.ones(n_points))
+
+@lru_cache(maxsize=64)
+def return_k_tr_segment(n_points, time_step_s, ramp_points, magnitude_nm):
+    """ Returns the arrays for a k_tr maneuver """
+
+    ramp_inc = magnitude_nm / float(ramp_points)
+
+    delta_hsl = np.zeros(n_points)
+    vi = np.arange(0, ramp_points+1)
+    delta_hsl[vi] = -ramp_inc
+    vi = np.arange(n_points-1-ramp_points, n_points)
+    delta_hsl[vi] = ramp_inc
+
+    return freeze_segment(time_step_s * np.ones(n_points),
+                          delta_hsl,
+                          -np.ones(n_points))
+
+def freeze_segment(*arrays):
+    """ Makes the arrays of a cached segment read-only """
+
+    for a in arrays:
+        a.flags.writeable = False
+    return arrays
+
+def format_column(y, float_format='%.5f'):
+    """ Returns a list of strings for a column, formatting each distinct
+        value once """
+
+    (values, inverse) = np.unique(y, return_inverse=True)
+    strings = [float_format % v for v in values]
+
+    return [strings[i] for i in inverse.ravel()]
@@ -10,8 +10,6 @@ import os
 import numpy as np
 import pandas as pd
 
-from scipy.integrate import solve_ivp
-
 def write_protocol_to_file(prot, prot_file_string):
     """ Writes a protocol defined as a Pandas dataframe to a file_string
         defined with an absolute path """
@@ -100,28 +98,13 @@ def create_twitch_protocol(time_step=0.001, n_points=600,
     """ Creates a twitch protocol """
     
     dt = time_step * np.ones(n_points)
-    activation = np.zeros(n_points)
-    myofil_Ca = np.nan * np.ones(n_points)
-    
-    for st in stimulus_times_s:
-        act_start_index = round(st / time_step)
-        act_stop_index = round((st + stimulus_duration_s) / time_step)
-        activation[act_start_index:(act_stop_index+1)] = 1
-    
-    # Solve two compartment problem
-    
-    def derivs(t, y):
-        dydt = np.zeros(2)
-        dydt[0] = ((k_leak + (act * k_act)) * y[1]) - (k_serca * y[0]);
-        dydt[1] = -dydt[0]
-        return dydt
     
-    y_temp = [0, Ca_content]
-    for i in range(n_points):
-        act = activation[i]
-        sol = solve_ivp(derivs, [0, time_step], y_temp, method='RK23')
-        y_temp = sol.y[:,-1]
-        myofil_Ca[i] = y_temp[0]
+    myofil_Ca = calculate_twitch_Ca(time_step=time_step, n_points=n_points,
+                                    stimulus_times_s=stimulus_times_s,
+                                    Ca_content=Ca_content,
+                                    stimulus_duration_s=stimulus_duration_s,
+                                    k_leak=k_leak, k_act=k_act,
+                                    k_serca=k_serca)
     
     pCa = -np.log10(myofil_Ca)
     
@@ -136,8 +119,110 @@ def create_twitch_protocol(time_step=0.001, n_points=600,
     df = pd.DataFrame(data=d)
 
     return df    
+
+def create_twitch_protocols(parameter_sets):
+    """ Creates a list of twitch protocols, one for each dict in
+        parameter_sets. Each dict holds keyword arguments for
+        create_twitch_protocol. Sets that share a time base and stimulus
+        pattern are calculated together """
+    
+    defaults = {'time_step': 0.001, 'n_points': 600,
+                'stimulus_times_s': [0.1], 'Ca_content': 1e-3,
+                'stimulus_duration_s': 0.01, 'k_leak': 6e-4,
+                'k_act': 8.2e-2, 'k_serca': 20}
+    sets = [{**defaults, **ps} for ps in parameter_sets]
+    
+    # Group the sets by their activation pattern
+    groups = dict()
+    for i, ps in enumerate(sets):
+        key = (ps['time_step'], ps['n_points'],
+               tuple(np.atleast_1d(ps['stimulus_times_s'])),
+               ps['stimulus_duration_s'])
+        groups.setdefault(key, []).append(i)
+    
+    protocols = [None] * len(sets)
+    for (key, indices) in groups.items():
+        myofil_Ca = calculate_twitch_Ca(
+            time_step=key[0], n_points=key[1],
+            stimulus_times_s=list(key[2]), stimulus_duration_s=key[3],
+            Ca_content=[sets[i]['Ca_content'] for i in indices],
+            k_leak=[sets[i]['k_leak'] for i in indices],
+            k_act=[sets[i]['k_act'] for i in indices],
+            k_serca=[sets[i]['k_serca'] for i in indices])
+        
+        for (row, i) in enumerate(indices):
+            ps = sets[i]
+            n_points = ps['n_points']
+            
+            if ('mode_vector' in ps) and (len(ps['mode_vector']) > 0):
+                mode_vector = ps['mode_vector']
+            else:
+                mode_vector = -2 * np.ones(n_points)
+            
+            if ('dhsl' in ps) and (len(ps['dhsl']) > 0):
+                dhsl = ps['dhsl']
+            else:
+                dhsl = np.zeros(n_points)
+            
+            d = {'dt': ps['time_step'] * np.ones(n_points),
+                 'pCa': -np.log10(myofil_Ca[row, :]),
+                 'dhsl': dhsl, 'mode': mode_vector}
+            protocols[i] = pd.DataFrame(data=d)
+    
+    return protocols
+
+def calculate_twitch_Ca(time_step=0.001, n_points=600,
+                        stimulus_times_s = [0.1],
+                        Ca_content=1e-3, stimulus_duration_s=0.01,
+                        k_leak=6e-4, k_act=8.2e-2, k_serca=20):
+    """ Returns the myofilament Ca concentration at the end of each time
+        step for a two compartment model
+        
+        Ca is released from the SR at a rate (k_leak + activation * k_act)
+        and pumped back at k_serca. The system is linear and activation
+        is constant between stimulus edges, so each of those intervals has
+        an exact exponential solution.
+        
+        Ca_content, k_leak, k_act and k_serca can be arrays, in which case
+        the result has one row for each parameter set """
     
+    activation = np.zeros(n_points)
     
+    for st in np.atleast_1d(stimulus_times_s):
+        act_start_index = round(st / time_step)
+        act_stop_index = round((st + stimulus_duration_s) / time_step)
+        activation[act_start_index:(act_stop_index+1)] = 1
     
-
-
+    # One row for each parameter set
+    batch = ((np.ndim(Ca_content) + np.ndim(k_leak) + np.ndim(k_act) +
+              np.ndim(k_serca)) > 0)
+    (Ca_content, k_leak, k_act, k_serca) = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(x, dtype=float))
+          for x in [Ca_content, k_leak, k_act, k_serca]])
+    
+    myofil_Ca = np.zeros((len(Ca_content), n_points))
+    
+    # Start and end of each interval with constant activation
+    edges = np.concatenate(([0], np.flatnonzero(np.diff(activation)) + 1,
+                            [n_points]))
+    
+    y = np.zeros(len(Ca_content))
+    for (start, stop) in zip(edges[:-1], edges[1:]):
+        k_rel = k_leak + (activation[start] * k_act)
+        k_tot = k_rel + k_serca
+        
+        # Myofilament Ca relaxes towards its steady-state value
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y_inf = np.where(k_tot > 0, k_rel * Ca_content / k_tot, y)
+        
+        n = np.arange(1, stop - start + 1)
+        decay = np.exp(-np.outer(k_tot, n * time_step))
+        myofil_Ca[:, start:stop] = y_inf[:, np.newaxis] + \
+            (y - y_inf)[:, np.newaxis] * decay
+        
+        y = myofil_Ca[:, stop-1]
+    
+    if not batch:
+        myofil_Ca = myofil_Ca[0, :]
+    
+    return myofil_Ca
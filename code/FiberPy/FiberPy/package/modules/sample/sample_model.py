@@ -10,8 +10,6 @@ import json
 import shutil
 import copy
 
-import multiprocessing
-import threading
 import subprocess
 
 import numpy as np
@@ -19,10 +17,10 @@ import pandas as pd
 
 from pathlib import Path
 
-from scipy.stats import qmc
-
 from ..protocols import protocols as prot
 from ..batch import batch
+from ..batch import job_server
+from ..batch import sim_cache
 
 
 def sample_model(json_analysis_file_string):
@@ -156,7 +154,9 @@ def generate_characterization_files(json_analysis_file_string):
     no_of_parameters = len(adjustments)
     no_of_samples = sampling_struct['no_of_samples']
 
-    # Generate the sample values
+    # Generate the sample values. scipy.stats is imported here because
+    # it is slow to import and only needed to set up the samples
+    from scipy.stats import qmc
     sampler = qmc.LatinHypercube(no_of_parameters, seed=1)
     sample_values = sampler.random(no_of_samples)
     
@@ -197,6 +197,13 @@ def generate_characterization_files(json_analysis_file_string):
                     new_options_file_string)
         
         
+        # Make the sim_cache path absolute
+        if ('sim_cache' in sample_characterize['FiberSim_setup']):
+            sample_characterize['FiberSim_setup']['sim_cache'] = \
+                sim_cache.resolve_cache_struct(
+                    sample_characterize['FiberSim_setup']['sim_cache'],
+                    json_analysis_file_string)
+        
         # Delete the sampling and replace with manipulations
         del sample_characterize['FiberSim_setup']['model']['sampling']
 
@@ -488,27 +495,18 @@ def characterize_unloaded_shortening(json_analysis_file_string,
     return new_struct
 
 def batch_command_strings(command_strings, figures_only=False):
-    """ Runs a list of command strings as separate threads """
+    """ Runs a list of command strings as separate processes """
     
     if not figures_only:
-        my_list = command_strings
-            
-        # Get max threads available
-        num_processes = multiprocessing.cpu_count()-1
+        # Start the machine-wide job server before the characterize
+        # processes are launched. They inherit its address and share
+        # its tokens, so the total number of FiberCpp processes is
+        # limited to the number of cores
+        job_server.return_job_tokens()
+        
+        # The characterize processes spend most of their time waiting
+        # for tokens, so they do not need tokens of their own
+        num_processes = job_server.return_max_jobs()
         print('Running batch using %i threads' % num_processes)
         
-        threads = []
-        while threads or my_list:
-            if (len(threads) < num_processes) and my_list:
-                t = threading.Thread(target=worker, args=[my_list.pop()])
-                t.setDaemon(True)
-                t.start()
-                threads.append(t)
-            else:
-                for thread in threads:
-                    if not thread.is_alive():
-                        threads.remove(thread)
-                        
-def worker(cmd):
-    subprocess.call(cmd)
-    
\ No newline at end of file
+        batch.run_commands(command_strings, num_processes)
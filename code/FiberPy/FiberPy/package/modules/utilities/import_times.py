@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the time taken to import the modules for each FiberPy subcommand
+
+Each subcommand is imported in a new interpreter, as it would be when
+FiberPy.py is launched, and the time is compared with a budget. The
+check also fails if a subcommand imports a module that it should not,
+which is how heavy imports usually creep back in.
+
+Most subcommands need numpy, pandas, scipy and matplotlib, which take
+most of the time and vary a lot from machine to machine. Their import
+is timed in the same run, as a reference, and budgets can be given as a
+multiple of it (budget_ref) rather than in seconds (budget_s). Each time
+is the fastest of a few repeats, to reduce the noise.
+"""
+
+import sys
+import json
+import subprocess
+
+from pathlib import Path
+
+
+# Code run in the new interpreter. It prints the import time and the
+# top-level packages that were imported
+timing_code = """
+import sys, time, json, importlib
+t = time.perf_counter()
+for m in %s:
+    importlib.import_module(m)
+t = time.perf_counter() - t
+print(json.dumps({'time_s': t,
+                  'packages': sorted(set(k.split('.')[0]
+                                         for k in sys.modules))}))
+"""
+
+# Packages timed as the reference for budget_ref
+reference_modules = ['numpy', 'pandas', 'scipy.optimize',
+                     'matplotlib.pyplot']
+
+
+def return_import_time(modules, working_dir):
+    """ Imports modules in a new interpreter and returns a dict with the
+        time taken, in s, and the top-level packages that were loaded """
+
+    result = subprocess.run([sys.executable, '-c',
+                             timing_code % repr(list(modules))],
+                            cwd=working_dir, capture_output=True, text=True)
+
+    if (result.returncode != 0):
+        return {'time_s': float('nan'), 'packages': [],
+                'error': result.stderr.strip().split('\n')[-1]}
+
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+def return_fastest_import_time(modules, working_dir, repeats):
+    """ Returns the result from return_import_time with the shortest
+        time from repeats attempts """
+
+    results = [return_import_time(modules, working_dir)
+               for i in range(repeats)]
+    for d in results:
+        if ('error' in d):
+            return d
+
+    return min(results, key=lambda d: d['time_s'])
+
+def check_import_times(import_budgets, budget_factor=1.0, working_dir=None,
+                       repeats=3):
+    """ Times the imports for each subcommand in import_budgets, a dict
+        of dicts with modules, budget_s or budget_ref and, optionally,
+        forbidden, and returns True if they are all within budget """
+
+    if (working_dir is None):
+        working_dir = str(Path(__file__).parents[3])
+
+    all_ok = True
+
+    d = return_fastest_import_time(reference_modules, working_dir, repeats)
+    reference_s = d['time_s']
+    print('%-24s %6.2f s' % ('reference', reference_s))
+
+    for (subcommand, b) in import_budgets.items():
+        d = return_fastest_import_time(b['modules'], working_dir, repeats)
+
+        if ('budget_ref' in b):
+            budget_s = budget_factor * b['budget_ref'] * reference_s
+        else:
+            budget_s = budget_factor * b['budget_s']
+        problems = []
+        if ('error' in d):
+            problems.append(d['error'])
+        elif not (d['time_s'] <= budget_s):
+            problems.append('over budget')
+        if ('forbidden' in b):
+            loaded = sorted(set(b['forbidden']) & set(d['packages']))
+            if loaded:
+                problems.append('imports %s' % ', '.join(loaded))
+
+        print('%-24s %6.2f s  budget %5.2f s  %s' %
+              (subcommand, d['time_s'], budget_s,
+               ('; '.join(problems) if problems else 'ok')))
+
+        if problems:
+            all_ok = False
+
+    return all_ok
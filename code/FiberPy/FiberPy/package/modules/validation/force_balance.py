@@ -6,11 +6,10 @@ Created on Wed May 12 12:08:32 2021
 """
 
 import os
-from natsort import natsorted
 import matplotlib.pyplot as plt
 import numpy as np
 
-from modules.half_sarcomere import half_sarcomere
+from modules.half_sarcomere import hs_status
 
 plt.rcParams.update({'font.family': "Arial"})
 plt.rcParams.update({'font.size': 14}) 
@@ -25,16 +24,9 @@ def compute_force_balance(dump_precision_list, dump_folder_list, output_folder)
 
     for dump_folder in dump_folder_list: # Loop over each dump folder
     
-        hs_file = []
+        hs_file = hs_status.return_dump_files(dump_folder)
         
-        for filenames in os.listdir(dump_folder):
-            
-            filenames = os.path.join(dump_folder, filenames)
-            hs_file.append(filenames)
-        
-        hs_file = natsorted(hs_file) # sorting the dump files   
-        
-        hs = half_sarcomere.half_sarcomere(hs_file[-1]) # get last dump_file
+        hs = hs_status.hs_status(hs_file[-1]) # get last dump_file
         
         thick_err, thin_err = get_hs_thin_and_thick_errors(hs)
         
@@ -77,8 +69,11 @@ def compute_force_balance(dump_precision_list, dump_folder_list, output_folder)
 
 def get_hs_thin_and_thick_errors(hs, show_error = False):
      
-    thick_error = get_thick_node_error(hs)
-    thin_error = get_thin_node_error(hs)
+    # The thick/thin index is shared by both calculations
+    adjacency = get_thin_thick_adjacency(hs)
+
+    thick_error = get_thick_node_error(hs, adjacency)
+    thin_error = get_thin_node_error(hs, adjacency)
             
     if show_error:
         plt.figure()
@@ -92,322 +87,221 @@ def get_hs_thin_and_thick_errors(hs, show_error = False):
     return thick_error, thin_error
      
 
-def get_thick_node_error(hs):
+def get_thick_node_error(hs, adjacency=None):
     """
     Get the maximum node error for thick filaments
     
+    The residuals are calculated for every node in the lattice at once.
+    hs can be a half_sarcomere or an hs_status. adjacency is the
+    thick/thin index from get_thin_thick_adjacency and is calculated if
+    it is not provided
     """
-    
-    hs_length = hs["hs_data"]["hs_length"]
-    thick_node_err = []
 
-    for i, thick_fil in enumerate(hs["thick"]): # Loop over all thick filaments 
+    (thick, thin) = return_filament_arrays(hs)
+    if (adjacency is None):
+        adjacency = get_thin_thick_adjacency(hs)
+
+    hs_length = hs["hs_data"]["hs_length"]
     
-        
-        node_err = 0.0
-        
-        k_m = thick_fil["m_k_stiff"]
-        m_rl = thick_fil["m_inter_crown_rest_length"]
-        cbs_per_node = thick_fil["m_cbs_per_node"]
-        
-        # First node
-        
-        x_0 = thick_fil["cb_x"][0]
-        x_1 = thick_fil["cb_x"][0 + cbs_per_node]
-        
-        lamb = thick_fil["m_lambda"]
-        
-        residual = k_m * (x_0 - x_1 - m_rl) - k_m * (hs_length - lamb - x_0 - m_rl)
-        residual += get_m_cb_force(hs, thick_fil, 0, 0 + cbs_per_node)
-        residual += get_m_pc_force(hs, thick_fil, 0)
-        residual += get_m_titin_force(hs, thick_fil, 0)
-        
-        node_err = max(node_err, abs(residual))
+    k_m = thick["m_k_stiff"][:, np.newaxis]
+    m_rl = thick["m_inter_crown_rest_length"][:, np.newaxis]
+    lamb = thick["m_lambda"]
+    cbs_per_node = thick["m_cbs_per_node"][0]
 
-        # Intermediate nodes
-        
-        for j in range(1, hs["hs_data"]["m_nodes_per_thick_filament"] - 1):
-            
-            x_0 = thick_fil["cb_x"][(j - 1) * cbs_per_node] # left node
-            x_1 = thick_fil["cb_x"][j * cbs_per_node]       # center node
-            x_2 = thick_fil["cb_x"][(j + 1) * cbs_per_node] # right node
-            
-            residual = -k_m * (x_0 - x_1 - m_rl) + k_m * (x_1- x_2 - m_rl) # TO CHECK
-            residual += get_m_cb_force(hs, thick_fil, j * cbs_per_node, (j + 1) * cbs_per_node)
-            residual += get_m_pc_force(hs, thick_fil, j)
-            residual += get_m_titin_force(hs, thick_fil, j) 
-            
-            # node_force = k_m * (x_0 - x_1 - m_rl) 
-            # real_node = thick_fil["node_forces"][j]
-            # diff = node_force - real_node
-            # print("node_force_diff =", diff)
+    cb_x = thick["cb_x"]
+    no_of_nodes = hs["hs_data"]["m_nodes_per_thick_filament"]
+    x = cb_x[:, 0:(no_of_nodes * cbs_per_node):cbs_per_node] # node positions
 
-            
-            node_err = max(node_err, abs(residual))
-            
-        # Last node
-        
-        x_0 = thick_fil["cb_x"][(hs["hs_data"]["m_nodes_per_thick_filament"] - 2) * cbs_per_node] # second to last node
-        x_1 = thick_fil["cb_x"][-1] # last element
-        
-        residual = - k_m * (x_0 - x_1 - m_rl) # FIXED ERROR
-        residual += get_m_cb_force(hs, thick_fil, (hs["hs_data"]["m_nodes_per_thick_filament"] - 1) * cbs_per_node, (hs["hs_data"]["m_nodes_per_thick_filament"] - 0) * cbs_per_node)
-        residual += get_m_pc_force(hs, thick_fil, hs["hs_data"]["m_nodes_per_thick_filament"] - 1)
-        residual += get_m_titin_force(hs, thick_fil, hs["hs_data"]["m_nodes_per_thick_filament"] - 1) 
-        
-        node_err = max(node_err, abs(residual)) 
-        
-        thick_node_err.append(node_err)
+    # Springs between nodes
+    d = k_m * (x[:, :-1] - x[:, 1:] - m_rl)
+    residual = np.zeros(x.shape)
+    residual[:, :-1] += d
+    residual[:, 1:] -= d
+
+    # First node is also linked to the M-line
+    residual[:, 0] -= k_m[:, 0] * (hs_length - lamb - x[:, 0] - m_rl[:, 0])
+
+    # Last node uses the last element
+    residual[:, -1] = -k_m[:, 0] * (x[:, -2] - cb_x[:, -1] - m_rl[:, 0])
+
+    # Cross-bridges, summed over each node
+    residual += return_cb_forces(hs, thick, thin).reshape(
+        (x.shape[0], no_of_nodes, cbs_per_node)).sum(axis=2)
+
+    # Bound pcs
+    (fil, pc, bs_x) = return_bound_pcs(thick, thin)
+    if (len(fil) > 0):
+        node = thick["pc_node_index"][fil, pc]
+        pc_force = thick["c_k_stiff"][fil] * \
+            (cb_x[fil, node * cbs_per_node] - bs_x)
+        np.add.at(residual, (fil, node), pc_force)
+
+    # Titin
+    t_m_node = hs["titin"]["t_attach_m_node"] - 1
+    residual[:, t_m_node] += np.bincount(adjacency[0],
+                                         weights=return_titin_forces(hs, thick, thin, adjacency),
+                                         minlength=x.shape[0])
+
+    thick_node_err = np.amax(np.abs(residual), axis=1)
         
-    thick_node_err = [x/k_m for x in thick_node_err] # convert to nm
+    thick_node_err = thick_node_err / k_m[:, 0] # convert to nm
         
     return thick_node_err
 
-def get_thin_node_error(hs):
+def get_thin_node_error(hs, adjacency=None):
     """
     Get the maximum node error for thin filaments
     
+    The residuals are calculated for every node in the lattice at once.
+    hs can be a half_sarcomere or an hs_status
     """
 
-    thin_node_err = []
+    (thick, thin) = return_filament_arrays(hs)
+    if (adjacency is None):
+        adjacency = get_thin_thick_adjacency(hs)
 
-    for i, thin_fil in enumerate(hs["thin"]): # Loop over all thin filaments 
-    
-        nearest_thicks = get_nearest_thick_fil(hs, thin_fil)
-        
-        node_err = 0.0
-        
-        k_a = thin_fil["a_k_stiff"]
-        a_rl = thin_fil["a_inter_bs_rest_length"]
-        bs_per_node = thin_fil["a_bs_per_node"]
-        
-        # First node
-        
-        x_0 = thin_fil["bs_x"][0]
-        x_1 = thin_fil["bs_x"][0 + bs_per_node]
-                
-        residual = k_a * (x_0 - a_rl) - k_a * (x_1 - x_0 - a_rl) # FIXED ERROR
-        residual -= get_a_cb_force(hs, thin_fil, 0, 0 + bs_per_node)
-        residual -= get_a_pc_force(hs, thin_fil, 0, 0 + bs_per_node)
-        residual -= get_a_titin_force(hs, thin_fil, 0, nearest_thicks)
-        
-        node_err = max(node_err, abs(residual)) 
-        
+    k_a = thin["a_k_stiff"][:, np.newaxis]
+    a_rl = thin["a_inter_bs_rest_length"][:, np.newaxis]
+    bs_per_node = thin["a_bs_per_node"][0]
 
-        # Intermediate nodes
-        
-        for j in range(1, hs["hs_data"]["a_nodes_per_thin_filament"] - 1):
-            
-            x_0 = thin_fil["bs_x"][(j - 1) * bs_per_node] # left node
-            x_1 = thin_fil["bs_x"][j * bs_per_node]       # center node
-            x_2 = thin_fil["bs_x"][(j + 1) * bs_per_node] # right node
-                        
-            
-            residual = k_a * (x_1 - x_0 - a_rl) - k_a * (x_2- x_1 - a_rl)
-            residual -= get_a_cb_force(hs, thin_fil, j * bs_per_node, (j + 1 ) * bs_per_node)
-            residual -= get_a_pc_force(hs, thin_fil, j * bs_per_node, (j + 1 ) * bs_per_node)
-            residual -= get_a_titin_force(hs, thin_fil, j, nearest_thicks)
-            
-            node_err = max(node_err, abs(residual)) 
-            
-        # Last node
-        
-        x_0 = thin_fil["bs_x"][(hs["hs_data"]["a_nodes_per_thin_filament"]  - 2) * bs_per_node] # second to last node
-        x_1 = thin_fil["bs_x"][(hs["hs_data"]["a_nodes_per_thin_filament"]  - 1) * bs_per_node] # last element
-        
-        residual = k_a * (x_1 - x_0 - a_rl)
-        residual -= get_a_cb_force(hs, thin_fil, (hs["hs_data"]["a_nodes_per_thin_filament"] - 1) * bs_per_node, hs["hs_data"]["a_nodes_per_thin_filament"] * bs_per_node)
-        residual -= get_a_pc_force(hs, thin_fil, (hs["hs_data"]["a_nodes_per_thin_filament"] - 1) * bs_per_node, hs["hs_data"]["a_nodes_per_thin_filament"] * bs_per_node)
-        residual -= get_a_titin_force(hs, thin_fil, hs["hs_data"]["a_nodes_per_thin_filament"]- 1, nearest_thicks)
-            
-        node_err = max(node_err, abs(residual))
-                
-        thin_node_err.append(node_err)  # store the max node error for each filament
+    bs_x = thin["bs_x"]
+    no_of_nodes = hs["hs_data"]["a_nodes_per_thin_filament"]
+    x = bs_x[:, 0:(no_of_nodes * bs_per_node):bs_per_node] # node positions
+
+    # Springs between nodes
+    d = k_a * (x[:, 1:] - x[:, :-1] - a_rl)
+    residual = np.zeros(x.shape)
+    residual[:, 1:] += d
+    residual[:, :-1] -= d
+
+    # First node is also linked to the Z-disk
+    residual[:, 0] += k_a[:, 0] * (x[:, 0] - a_rl[:, 0])
+
+    # Cross-bridges, summed over each node
+    bound = (thin["bound_to_m_type"] == 1) # a cb is bound
+    (a_f, a_n) = np.nonzero(bound)
+    m_f = thin["bound_to_m_f"][a_f, a_n]
+    m_n = thin["bound_to_m_n"][a_f, a_n]
+    cb_force = np.zeros(bs_x.shape)
+    cb_force[a_f, a_n] = thick["m_k_cb"][m_f] * \
+        (thick["cb_x"][m_f, m_n] +
+         return_cb_extensions(hs, thick["cb_state"][m_f, m_n]) -
+         bs_x[a_f, a_n])
+
+    # Bound pcs. Each bound site is matched to the first pc on its thick
+    # filament that is bound to a site with the same index
+    bound = (thin["bound_to_m_type"] == 2) # a pc is bound
+    (a_f, a_n) = np.nonzero(bound)
+    if (len(a_f) > 0):
+        m_f = thin["bound_to_m_f"][a_f, a_n]
+        match = (thick["pc_bound_to_a_n"][m_f] == a_n[:, np.newaxis])
+        if not np.all(np.any(match, axis=1)):
+            raise RuntimeError("Bound pc not found on thick filament")
+        pc = np.argmax(match, axis=1)
+        node = thick["pc_node_index"][m_f, pc]
+        cb_force[a_f, a_n] += thick["c_k_stiff"][m_f] * \
+            (thick["cb_x"][m_f, node * thick["m_cbs_per_node"][m_f]] -
+             bs_x[a_f, a_n])
+
+    residual -= cb_force[:, 0:(no_of_nodes * bs_per_node)].reshape(
+        (x.shape[0], no_of_nodes, bs_per_node)).sum(axis=2)
+
+    # Titin
+    t_a_node = hs["titin"]["t_attach_a_node"] - 1
+    residual[:, t_a_node] -= np.bincount(adjacency[1],
+                                         weights=return_titin_forces(hs, thick, thin, adjacency),
+                                         minlength=x.shape[0])
+
+    thin_node_err = np.amax(np.abs(residual), axis=1) # store the max node error for each filament
         
-    thin_node_err = [x/k_a for x in thin_node_err] # convert to nm
+    thin_node_err = thin_node_err / k_a[:, 0] # convert to nm
         
     return thin_node_err
-           
 
-def get_m_cb_force(hs, thick_fil, idx_1, idx_2):
+def return_filament_arrays(hs):
     """
-    Calculate bound cbs force contribution to thick node forces
+    Returns the thick and thin filament data as dicts of arrays
     """
-    
-    cb_force = 0.0
-    
-    for cb_idx in range(idx_1, idx_2):
-        
-        if thick_fil["cb_bound_to_a_f"][cb_idx] >= 0:
-            
-          cb_state = thick_fil["cb_state"][cb_idx]
-          cb_extension = hs["hs_data"]["cb_extensions"][cb_state - 1]
-          
-          thin_fil_id = thick_fil["cb_bound_to_a_f"][cb_idx]
-          thin_fil = hs["thin"][thin_fil_id]
-          
-          bs_idx = thick_fil["cb_bound_to_a_n"][cb_idx]
-          bs_x = thin_fil["bs_x"][bs_idx]
-          
-          cb_x = thick_fil["cb_x"][cb_idx]
-    
-          delta_x = cb_x + cb_extension - bs_x
-    
-          cb_force += thick_fil["m_k_cb"] * delta_x
-  
-    return cb_force
 
-def get_a_cb_force(hs, thin_fil, idx_1, idx_2):
+    if isinstance(hs["thick"], list):
+        return (hs_status.stack_filaments(hs["thick"]),
+                hs_status.stack_filaments(hs["thin"]))
+
+    return (hs["thick"], hs["thin"])
+
+def return_cb_extensions(hs, cb_state):
     """
-    Calculate bound cbs force contribution to thick node forces
+    Returns the extension for each cb state
     """
-    cb_force = 0.0
-      
-    for bs_idx in range(idx_1, idx_2):
-          
-        if thin_fil["bound_to_m_type"][bs_idx] == 1: # a cb is bound FIXED ERROR
-        
-          thick_fil_id = thin_fil["bound_to_m_f"][bs_idx]
-          thick_fil = hs["thick"][thick_fil_id]
-          
-          cb_idx = thin_fil["bound_to_m_n"][bs_idx]
-          cb_x = thick_fil["cb_x"][cb_idx]
-          
-          cb_state = cb_state = thick_fil["cb_state"][cb_idx]
-          cb_extension = hs["hs_data"]["cb_extensions"][cb_state - 1]
-          
-          bs_x = thin_fil["bs_x"][bs_idx]
-          
-          delta_x = cb_x + cb_extension - bs_x
-        
-          cb_force += thick_fil["m_k_cb"] * delta_x
-    
-    return cb_force
-  
-def get_m_pc_force(hs, thick_fil, thick_node):
+
+    cb_extensions = np.asarray(hs["hs_data"]["cb_extensions"])
+    return cb_extensions[np.clip(cb_state - 1, 0, len(cb_extensions) - 1)]
+
+def return_cb_forces(hs, thick, thin):
     """
-    Calculate bound pcs force contribution to thick node forces
+    Returns the force from each bound cb, zero for unbound cbs
     """
-    
-    pc_force = 0.0
-    
-    for i, pc in enumerate(thick_fil["pc_node_index"]):
-        
-        if pc == thick_node: # check if there is a pc on that node
-        
-            if thick_fil['pc_bound_to_a_f'][i] >= 0: # check if pc is attached to actin:
-                
-                pc_idx = thick_node * thick_fil["m_cbs_per_node"] # get pc idx
-                pc_x = thick_fil["cb_x"][pc_idx]
-                
-                thin_fil_id = thick_fil['pc_bound_to_a_f'][i]
-                thin_fil = hs["thin"][thin_fil_id]
-                
-                bs_idx = thick_fil['pc_bound_to_a_n'][i]
-                bs_x = thin_fil["bs_x"][bs_idx]
-                
-                delta_x = pc_x - bs_x
-                
-                pc_force += thick_fil["c_k_stiff"] * delta_x
-  
-    return pc_force
-
-def get_a_pc_force(hs, thin_fil, idx_1, idx_2):
+
+    cb_force = np.zeros(thick["cb_x"].shape)
+
+    (m_f, m_n) = np.nonzero(thick["cb_bound_to_a_f"] >= 0)
+    a_f = thick["cb_bound_to_a_f"][m_f, m_n]
+    a_n = thick["cb_bound_to_a_n"][m_f, m_n]
+
+    cb_force[m_f, m_n] = thick["m_k_cb"][m_f] * \
+        (thick["cb_x"][m_f, m_n] +
+         return_cb_extensions(hs, thick["cb_state"][m_f, m_n]) -
+         thin["bs_x"][a_f, a_n])
+
+    return cb_force
+
+def return_bound_pcs(thick, thin):
     """
-    Calculate bound pcs force contribution to thin node forces
+    Returns the filament and pc indices of the bound pcs, and the
+    positions of the sites they are bound to
     """
-    pc_force = 0.0
-      
-    for bs_idx in range(idx_1, idx_2):
-        
-        if thin_fil["bound_to_m_type"][bs_idx] == 2: # a pc is bound        
-          
-            thick_fil_id = thin_fil["bound_to_m_f"][bs_idx]
-            thick_fil = hs["thick"][thick_fil_id]
-            
-            pc_idx = thick_fil["pc_bound_to_a_n"].index(bs_idx) 
-            pc_node_index = thick_fil["pc_node_index"][pc_idx]
-            pc_x = thick_fil["cb_x"][pc_node_index * thick_fil["m_cbs_per_node"]]
-            
-            #pc_idx = thin_fil["bound_to_m_n"][bs_idx]            
-            #pc_x = thick_fil["cb_x"][pc_idx]
-        
-            bs_x = thin_fil["bs_x"][bs_idx]
-        
-            delta_x = pc_x - bs_x
 
-            pc_force += thick_fil["c_k_stiff"] * delta_x
+    if not ("pc_bound_to_a_f" in thick) or \
+            (np.size(thick["pc_bound_to_a_f"]) == 0):
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
 
-    return pc_force
+    (fil, pc) = np.nonzero(thick["pc_bound_to_a_f"] >= 0)
+    bs_x = thin["bs_x"][thick["pc_bound_to_a_f"][fil, pc],
+                        thick["pc_bound_to_a_n"][fil, pc]]
 
+    return (fil, pc, bs_x)
 
-def get_m_titin_force(hs, thick_fil, cb_node, bs_per_node=2, cb_per_node=6):
-      """
-      Returns titin contribution to thick node force
-    
-      """
-      titin_force = 0
-      
-      if cb_node == hs["titin"]["t_attach_m_node"] - 1:
-          
-          cb_idx = cb_node * cb_per_node 
-          cb_x = thick_fil["cb_x"][cb_idx]
-          
-          bs_idx = bs_per_node * (hs["titin"]["t_attach_a_node"] - 1)
-
-          for thin_id in thick_fil["nearest_actin_filaments"]:
-              
-            thin_fil = hs["thin"][thin_id]
-            
-            bs_x = thin_fil["bs_x"][bs_idx]
-            
-            delta_x = cb_x - bs_x 
-            
-            titin_force += hs["titin"]["t_k_stiff"] * (delta_x - hs["titin"]["t_offset"])
-    
-      return titin_force
-  
-  
-def get_a_titin_force(hs, thin_fil, bs_node, nearest_thicks, bs_per_node=2, cb_per_node=6):
-      """
-      Returns titin contribution to thin node force
-    
-      """
-      titin_force = 0
-      
-      if bs_node == hs["titin"]["t_attach_a_node"] - 1:
-          
-          bs_idx = bs_node * bs_per_node 
-          bs_x = thin_fil["bs_x"][bs_idx]
-          
-          cb_idx = cb_per_node * ( hs["titin"]["t_attach_m_node"] - 1 )
-    
-          for thick_fil_id in nearest_thicks:
-              
-            thick_fil = hs["thick"][thick_fil_id]
-            
-            cb_x = thick_fil["cb_x"][cb_idx]
+def return_titin_forces(hs, thick, thin, adjacency, bs_per_node=2, cb_per_node=6):
+    """
+    Returns the titin force for each thick/thin pair in the adjacency
+    index
+    """
 
-            delta_x = cb_x - bs_x 
-            
-            titin_force += hs["titin"]["t_k_stiff"] * (delta_x - hs["titin"]["t_offset"])
-    
-      return titin_force
-  
-def get_nearest_thick_fil(hs, thin_fil):
+    cb_idx = cb_per_node * (hs["titin"]["t_attach_m_node"] - 1)
+    bs_idx = bs_per_node * (hs["titin"]["t_attach_a_node"] - 1)
+
+    delta_x = thick["cb_x"][adjacency[0], cb_idx] - \
+        thin["bs_x"][adjacency[1], bs_idx]
+
+    return hs["titin"]["t_k_stiff"] * (delta_x - hs["titin"]["t_offset"])
+
+def get_thin_thick_adjacency(hs):
     """
-    Returns array of the 3 nearest thick filaments  
-    
+    Returns an index of the thick/thin filament pairs linked by titin
+    as two arrays, the thick filament and the thin filament for each pair.
+    The thick filaments next to thin filament i are
+    adjacency[0][adjacency[1] == i]
     """
-    nearest_thicks = []
-    
-    for thick_fil in hs["thick"]:
-        
-      if thin_fil["thin_id"] in thick_fil["nearest_actin_filaments"]:
-          
-          nearest_thicks.append(thick_fil["thick_id"])
 
-    return nearest_thicks
+    (thick, thin) = return_filament_arrays(hs)
+
+    nearest = np.asarray(thick["nearest_actin_filaments"])
+    thick_id = np.repeat(thick["thick_id"], nearest.shape[1])
+
+    # Filament ids are also their indices
+    order = np.argsort(nearest.ravel(), kind='stable')
+
+    return (thick_id[order], nearest.ravel()[order])
 
 def check_total_force(hs):
     """
@@ -420,23 +314,15 @@ def check_total_force(hs):
     prop_fibrosis = hs["hs_data"]["prop_fibrosis"]
     prop_myofilaments = hs["hs_data"]["prop_myofilaments"]
     m_filament_density = hs["hs_data"]["m_filament_density"]
-       
-    computed_force = 0.0
-    
-    for thick_fil in hs["thick"]:
-        
-        k_m = thick_fil["m_k_stiff"]       
-        m_rl = thick_fil["m_inter_crown_rest_length"]          
-        lamb = thick_fil["m_lambda"]
-        
-        cb_x_m_line = thick_fil["cb_x"][0]
-        
-        computed_force += k_m * (hs_length - lamb - m_rl - cb_x_m_line)
-        
-    computed_force /= len(hs["thick"])     # average over all thick filaments
+
+    (thick, thin) = return_filament_arrays(hs)
+
+    computed_force = np.mean(thick["m_k_stiff"] *
+                             (hs_length - thick["m_lambda"] -
+                              thick["m_inter_crown_rest_length"] -
+                              thick["cb_x"][:, 0])) # average over all thick filaments
     computed_force *= (1 - prop_fibrosis) * prop_myofilaments * m_filament_density * 1e-9 # force in N/m²
        
     err_force = (hs_force - computed_force)/hs_force * 100
     
     return abs(err_force)
-                                                
@@ -2,7 +2,6 @@ import os
 import json
 
 import numpy as np
-from natsort import natsorted
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
@@ -18,7 +17,7 @@ plt.rcParams.update({'font.size': 14})
 # MODULES_ROOT = os.path.realpath(os.path.join(ROOT, "..", ".."))
 # sys.path.append(MODULES_ROOT)
 
-from modules.half_sarcomere import half_sarcomere
+from modules.half_sarcomere import hs_status
         
 ### Create stretch, node force and angle bins
 
@@ -43,20 +42,13 @@ A_STEP = 9
 
 NB_A_INTER = int((A_MAX - A_MIN)/A_STEP)
 
+# Codes for the state types
+D_TYPE = 2
+A_TYPE = 3
+
 def compute_rate(model_file, protocol_file, dump_folder, output_folder, adj_bs = 0):
     """Approximates the governing rate functions for mybpc"""
 
-    ### Get the hs_status dump files ###
-
-    hs_file = []
-
-    for filenames in os.listdir(dump_folder):
-        filenames = os.path.join(dump_folder, filenames)
-
-        hs_file.append(filenames)
-
-    hs_file = natsorted(hs_file) # sorting the dump files
-    
     ### Get the time step ###
 
     protocol = np.loadtxt(protocol_file, skiprows=1)
@@ -70,242 +62,30 @@ def compute_rate(model_file, protocol_file, dump_folder, output_folder, adj_bs =
     
     max_no_of_trans = c_kinetics[0][-1]["transition"][-1]["index"] + 1 
     
-    attachement_trans = [] # List of indices for the 'a' type of transition
-    
     ### Initialize transition arrays
     
     complete_transition = np.zeros((len(c_kinetics), max_no_of_trans, NB_INTER, NB_A_INTER),dtype=int)
     potential_transition = np.zeros((len(c_kinetics), max_no_of_trans, NB_INTER, NB_A_INTER),dtype=int)
 
     ### Fill the transition matrices
-    
-    # HS at t
-    hs_0 = half_sarcomere.half_sarcomere(hs_file[0])
-  
-    for ind in range(1,len(hs_file)): 
-        # HS at t + dt
-        hs_1 = half_sarcomere.half_sarcomere(hs_file[ind])
-      
-        for i, thick_fil_0 in enumerate(hs_0["thick"]): # Loop over all thick filaments
-            
-            thick_fil_1 = hs_1["thick"][i] 
-   
-            for pc_ind, state_0 in enumerate(thick_fil_0["pc_state"]): # loop over all pcs
-                
-                pc_iso_0 = thick_fil_0["pc_iso"][pc_ind] # pc isotype at t
-                pc_iso_1 = thick_fil_1["pc_iso"][pc_ind] # pc isotype at t + dt
-               
-                # Check isotype does not change through time
-                if pc_iso_0 != pc_iso_1:                    
-                    raise RuntimeError(f"Isotype #{pc_iso_0} turned into isotype #{pc_iso_1}")
-                    
-                pc_state_0 = thick_fil_0["pc_state"][pc_ind] # CB state at t
-                pc_state_1 = thick_fil_1["pc_state"][pc_ind] # CB state at t + dt
-                
-                pc_0_type = c_kinetics[pc_iso_0-1][pc_state_0-1]["state_type"] # CB type at t
-                pc_1_type = c_kinetics[pc_iso_1-1][pc_state_1-1]["state_type"] # CB type at t + dt
-                                                
-                ### Determine if a transition occurred ###
-                
-                if pc_state_0 != pc_state_1: # A transition occurred
-                
-                    pot_trans = False
-                   
-                    # Find transition index
-                    for trans in c_kinetics[pc_iso_0-1][pc_state_0-1]["transition"]:  # look through all transitions for pc_state_0
-                        if trans["to"] == pc_state_1:
-                            idx = trans["index"]
-                            pot_trans = True
-                            
-                    if pot_trans == False:
-                         raise RuntimeError(f"Transition index not found for transition from state {pc_state_0} to state {pc_state_1}")
-                    
-                    # Fill the element of the transition counter matrix
-                    # with the proper transition index and stretch values
-                    
-                    if pc_0_type == 'D':
-                        
-                        if pc_1_type == 'A': # Get the pc stretch
-                        
-                            if idx not in attachement_trans: 
-                                attachement_trans.append(idx) 
-                            
-                            thin_ind = thick_fil_1["pc_bound_to_a_f"][pc_ind]
-                            thin_fil = hs_0["thin"][thin_ind] 
-                            bs_ind_1 = thick_fil_1["pc_bound_to_a_n"][pc_ind]
-                            
-                            # Find cb associated with this pc
-                            pc_node_idx = thick_fil_0["pc_node_index"][pc_ind] # crown index                           
-                            cb_ind = pc_node_idx * 6 # cb index
-                            
-                            stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind_1] # x at t0 !
-                            pc_stretch_0 = get_stretch_interval(stretch)
-                            
-                            for j in range(0, 2*adj_bs+1): # Get the angle difference
-                            
-                                bs_ind = thick_fil_1[f"pc_nearest_a_n[x_{j}]"][pc_ind] # nearest BS have been recalculated
-                                
-                                found = False
-                                if bs_ind == bs_ind_1: 
-                                    found = True
-                                    angle_diff = thick_fil_1[f"pc_nearest_bs_angle_diff[x_{j}]"][pc_ind]                                    
-                                    pc_align_factor_0 =  get_alignment_interval(angle_diff)
-                                    
-                                    complete_transition[pc_iso_0-1,idx,pc_stretch_0, pc_align_factor_0 ] += 1
-                                    break
-                                
-                            if found == False:
-                                print("not found")
-                            
-                        elif pc_1_type == 'D': 
-                                                                      
-                            thin_ind = thick_fil_0["pc_nearest_a_f"][pc_ind]
-                            thin_fil = hs_0["thin"][thin_ind]
-                            
-                            for j in range(0, 2*adj_bs+1): # Loop over the nearest BS
-            
-                                bs_ind = thick_fil_1[f"pc_nearest_a_n[x_{j}]"][pc_ind] 
-
-                                # Find cb associated with this pc
-                                pc_node_idx = thick_fil_0["pc_node_index"][pc_ind]  # crown index                          
-                                cb_ind = pc_node_idx * 6
-                                      
-                                stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind] # x at t0 !
-                                                
-                                pc_stretch_0 = get_stretch_interval(stretch)
-                                
-                                angle_diff = thick_fil_1[f"pc_nearest_bs_angle_diff[x_{j}]"][pc_ind]                                    
-                                pc_align_factor_0 =  get_alignment_interval(angle_diff)
-                                
-                                complete_transition[pc_iso_0-1,idx,pc_stretch_0, pc_align_factor_0] += 1
-                                                                
-                    elif pc_0_type == 'A': # Get the pc stretch                    
-                        
-                        thin_ind = thick_fil_0["pc_bound_to_a_f"][pc_ind]
-                        thin_fil_0 = hs_0["thin"][thin_ind]
-                        bs_ind_0 = thick_fil_0["pc_bound_to_a_n"][pc_ind]
-                        
-                        # Find cb associated with this pc
-                        pc_node_idx = thick_fil_0["pc_node_index"][pc_ind]  # crown index                           
-                        cb_ind = pc_node_idx * 6    # crown index 
-                    
-                        stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil_0["bs_x"][bs_ind_0] 
-                        pc_stretch_0 = get_stretch_interval(stretch)
-                        
-                        for j in range(0, 2*adj_bs+1): # Get the angle difference
-                    
-                            bs_ind = thick_fil_0[f"pc_nearest_a_n[x_{j}]"][pc_ind]  
-                            found = False
-                            
-                            if bs_ind == bs_ind_0:
-                                
-                                found = True
-                                angle_diff = thick_fil_0[f"pc_nearest_bs_angle_diff[x_{j}]"][pc_ind]                                    
-                                pc_align_factor_0 =  get_alignment_interval(angle_diff)
-                                
-                                complete_transition[pc_iso_0-1,idx,pc_stretch_0, pc_align_factor_0 ] += 1
-                                break
-                            
-                        if found == False:
-                            print("not found")
-                                
-                ### Determine all potential transitions depending on state type (D and A) ###
-                                
-                # Attached (A)
-                
-                if pc_0_type == 'A': # Get pc stretch
 
-                    thin_ind = thick_fil_0["pc_bound_to_a_f"][pc_ind]
-                    bs_ind_0 = thick_fil_0["pc_bound_to_a_n"][pc_ind]
-                    thin_fil = hs_0["thin"][thin_ind]  
-                    
-                    # Find cb associated with this pc
-                    pc_node_idx = thick_fil_1["pc_node_index"][pc_ind]  # crown index                           
-                    cb_ind = pc_node_idx * 6
-                    
-                    stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind_0] 
+    # Only read the fields that are needed from each dump
+    fields = ['pc_state', 'pc_iso', 'pc_node_index', 'pc_bound_to_a_f',
+              'pc_bound_to_a_n', 'pc_nearest_a_f', 'cb_x', 'bs_x']
+    for j in range(0, 2*adj_bs+1):
+        fields.append(f"pc_nearest_a_n[x_{j}]")
+        fields.append(f"pc_nearest_a_n_states[x_{j}]")
+        fields.append(f"pc_nearest_bs_angle_diff[x_{j}]")
 
-                    pc_stretch_0 = get_stretch_interval(stretch)
-                    
-                    for j in range(0, 2*adj_bs+1): # Get the angle difference
-            
-                        bs_ind = thick_fil_0[f"pc_nearest_a_n[x_{j}]"][pc_ind]  
-                        found = False
-                        
-                        if bs_ind == bs_ind_0:
-                            found = True
-                            angle_diff = thick_fil_0[f"pc_nearest_bs_angle_diff[x_{j}]"][pc_ind]                                    
-                            pc_align_factor_0 =  get_alignment_interval(angle_diff)
-                            
-                            for trans in c_kinetics[pc_iso_0-1][pc_state_0-1]["transition"]: 
-                                
-                                # All transitions from an attached state are possible
-                                
-                                idx_pot = trans["index"]
-                                
-                                potential_transition[pc_iso_0-1, idx_pot, pc_stretch_0, pc_align_factor_0] += 1 
-                                
-                            break
-                    
-                    if found == False:
-                        print("not found")
-                        
-                # Detached (D)
-                
-                elif pc_0_type == 'D':
-                    
-                    # Get array of nearest BS and calculate stretch and angle difference array
-                
-                    bs_ind = np.zeros(2*adj_bs + 1, dtype = int)
-                    stretch = np.zeros(2*adj_bs + 1)
-                    angle = np.zeros(2*adj_bs + 1)
-                    
-                    thin_ind = thick_fil_0["pc_nearest_a_f"][pc_ind]
-                    thin_fil = hs_0["thin"][thin_ind] 
-                    
-                    for j in range(0, 2*adj_bs+1):
-    
-                        bs_ind[j] = thick_fil_1[f"pc_nearest_a_n[x_{j}]"][pc_ind] # nearest bs have been recalculated                                      
-                        
-                        # Find cb associated with this pc
-                        pc_node_idx = thick_fil_1["pc_node_index"][pc_ind] # crown index                            
-                        cb_ind = pc_node_idx * 6
-                        
-                        stretch[j] = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind[j]] # x has not been recalculated
-                        
-                        angle[j] = thick_fil_1[f"pc_nearest_bs_angle_diff[x_{j}]"][pc_ind]  # nearest bs have been recalculated                                    
+    kinetics_tables = get_kinetics_tables(c_kinetics)
 
-                                           
-                    for trans in c_kinetics[pc_iso_0-1][pc_state_0-1]["transition"]:
-                        
-                        new_state = trans["to"]
-                        idx_pot = trans["index"]
-                        
-                        if c_kinetics[pc_iso_0-1][new_state-1]["state_type"]== 'A':
-                            
-                            # Check if the potential binding sites are available 
-                            
-                            for k in range(0, 2*adj_bs +1):
-                                
-                                bs_availability = thick_fil_1[f"pc_nearest_a_n_states[x_{k}]"][pc_ind] 
-                            
-                                if bs_availability == 2: # bs is free and available for attachment
-        
-                                    pc_stretch_0 = get_stretch_interval(stretch[k])                                    
-                                    pc_align_factor_0 =  get_alignment_interval(angle[k])
-                                    potential_transition[pc_iso_0-1, idx_pot, pc_stretch_0, pc_align_factor_0] += 1 
-                        
-                        elif c_kinetics[pc_iso_0-1][new_state-1]["state_type"]== 'D': # Transition to another "D" state is always possible
-                            for k in range(0, 2*adj_bs +1):   
-                                pc_stretch_0 = get_stretch_interval(stretch[k])
-                                pc_align_factor_0 =  get_alignment_interval(angle[k])
-                                potential_transition[pc_iso_0-1, idx_pot, pc_stretch_0, pc_align_factor_0[k]] += 1                                                           
-                
-                else:
-                    raise RuntimeError(f"State #{pc_state_0} is neither type A, D or S")
-                                
-              
-        hs_0 = hs_1 
+    # Compare each dump (HS at t + dt) with the one before (HS at t)
+    hs_0 = None
+    for hs_1 in hs_status.iterate_dump_folder(dump_folder, fields):
+        if (hs_0 is not None):
+            count_transitions(c_kinetics, kinetics_tables, hs_0, hs_1, adj_bs,
+                              complete_transition, potential_transition)
+        hs_0 = hs_1
 
     ### Calculate the rates
     
@@ -441,6 +221,184 @@ def compute_rate(model_file, protocol_file, dump_folder, output_folder, adj_bs =
         
     plot_rate(calculated_rates_dict, c_kinetics, model_file, output_folder)
 
+def count_transitions(c_kinetics, kinetics_tables, hs_0, hs_1, adj_bs,
+                      complete_transition, potential_transition):
+    """ Adds the transitions between two consecutive dumps to the
+        complete and potential transition counts, handling the pcs on
+        all the thick filaments together """
+
+    (state_type, trans_index) = kinetics_tables
+
+    thick_0 = hs_0["thick"]
+    thick_1 = hs_1["thick"]
+    bs_x = hs_0["thin"]["bs_x"]
+
+    no_of_adj = 2*adj_bs + 1
+
+    state_0 = thick_0["pc_state"]
+    state_1 = thick_1["pc_state"]
+    iso_0 = thick_0["pc_iso"]
+    iso_1 = thick_1["pc_iso"]
+
+    # Check isotype does not change through time
+    bad = (iso_0 != iso_1)
+    if np.any(bad):
+        (f, c) = np.argwhere(bad)[0]
+        raise RuntimeError(f"Isotype #{iso_0[f, c]} turned into isotype #{iso_1[f, c]}")
+
+    type_0 = state_type[iso_0-1, state_0] # pc type at t
+    type_1 = state_type[iso_0-1, state_1] # pc type at t + dt
+    changed = (state_0 != state_1)
+
+    idx = trans_index[iso_0-1, state_0, state_1]
+    bad = changed & (idx < 0)
+    if np.any(bad):
+        (f, c) = np.argwhere(bad)[0]
+        raise RuntimeError(f"Transition index not found for transition from state {state_0[f, c]} to state {state_1[f, c]}")
+
+    bad = ~((type_0 == A_TYPE) | (type_0 == D_TYPE))
+    if np.any(bad):
+        (f, c) = np.argwhere(bad)[0]
+        raise RuntimeError(f"State #{state_0[f, c]} is neither type A, D or S")
+
+    # Nearest binding sites, their states and the angle differences
+    near_n_0 = np.stack([thick_0[f"pc_nearest_a_n[x_{j}]"]
+                         for j in range(no_of_adj)])
+    near_n_1 = np.stack([thick_1[f"pc_nearest_a_n[x_{j}]"]
+                         for j in range(no_of_adj)])
+    near_states_1 = np.stack([thick_1[f"pc_nearest_a_n_states[x_{j}]"]
+                              for j in range(no_of_adj)])
+    angle_bin_0 = get_alignment_bins(np.stack(
+        [thick_0[f"pc_nearest_bs_angle_diff[x_{j}]"] for j in range(no_of_adj)]))
+    angle_bin_1 = get_alignment_bins(np.stack(
+        [thick_1[f"pc_nearest_bs_angle_diff[x_{j}]"] for j in range(no_of_adj)]))
+
+    # Position of the first cb on the crown of each pc, at t
+    cb_x_0 = np.take_along_axis(thick_0["cb_x"], thick_0["pc_node_index"] * 6,
+                                axis=1)
+    cb_x_1 = np.take_along_axis(thick_0["cb_x"], thick_1["pc_node_index"] * 6,
+                                axis=1)
+
+    # pcs attached at t
+    bound_x_0 = bs_x[thick_0["pc_bound_to_a_f"], thick_0["pc_bound_to_a_n"]]
+    match_A = (near_n_0 == thick_0["pc_bound_to_a_n"])
+    found_A = np.any(match_A, axis=0)
+    angle_bin_A = np.take_along_axis(angle_bin_0,
+                                     np.argmax(match_A, axis=0)[np.newaxis],
+                                     axis=0)[0]
+
+    # pcs that attach between t and t + dt
+    stretch_bin_DA = get_stretch_bins(
+        cb_x_0 - bs_x[thick_1["pc_bound_to_a_f"], thick_1["pc_bound_to_a_n"]])
+    match_DA = (near_n_1 == thick_1["pc_bound_to_a_n"])
+    found_DA = np.any(match_DA, axis=0)
+    angle_bin_DA = np.take_along_axis(angle_bin_1,
+                                      np.argmax(match_DA, axis=0)[np.newaxis],
+                                      axis=0)[0]
+
+    # Detached pcs, using the nearest binding sites at t + dt
+    near_x = bs_x[thick_0["pc_nearest_a_f"][np.newaxis], near_n_1]
+
+    iso = iso_0 - 1
+
+    ### Complete transitions
+
+    # Attachment
+    mask = changed & (type_0 == D_TYPE) & (type_1 == A_TYPE)
+    for i in range(np.count_nonzero(mask & ~found_DA)):
+        print("not found")
+    add_counts(complete_transition, mask & found_DA, iso, idx,
+               stretch_bin_DA, angle_bin_DA)
+
+    # Between detached states, for each nearest binding site
+    mask = changed & (type_0 == D_TYPE) & (type_1 == D_TYPE)
+    stretch_bin_D = get_stretch_bins(cb_x_0 - near_x)
+    for j in range(no_of_adj):
+        add_counts(complete_transition, mask, iso, idx,
+                   stretch_bin_D[j], angle_bin_1[j])
+
+    # From attached states
+    mask = changed & (type_0 == A_TYPE)
+    for i in range(np.count_nonzero(mask & ~found_A)):
+        print("not found")
+    add_counts(complete_transition, mask & found_A, iso, idx,
+               get_stretch_bins(cb_x_0 - bound_x_0), angle_bin_A)
+
+    ### Potential transitions, for each isotype and state
+
+    stretch_bin_A = get_stretch_bins(cb_x_1 - bound_x_0)
+    stretch_bin_D = get_stretch_bins(cb_x_1 - near_x)
+
+    for i in range(np.count_nonzero((type_0 == A_TYPE) & ~found_A)):
+        print("not found")
+
+    for i, isotype in enumerate(c_kinetics):
+        for s in range(1, len(isotype)+1):
+
+            in_state = (iso_0 == (i+1)) & (state_0 == s)
+            if not np.any(in_state):
+                continue
+
+            for trans in isotype[s-1]["transition"]:
+
+                idx_pot = trans["index"]
+                new_type = state_type[i, trans["to"]]
+
+                if (state_type[i, s] == A_TYPE):
+
+                    # All transitions from an attached state are possible
+                    add_counts(potential_transition, in_state & found_A,
+                               i, idx_pot, stretch_bin_A, angle_bin_A)
+
+                elif (state_type[i, s] == D_TYPE):
+
+                    if (new_type == A_TYPE):
+                        # Check if the potential binding sites are available
+                        for k in range(no_of_adj):
+                            mask = in_state & (near_states_1[k] == 2)
+                            add_counts(potential_transition, mask, i, idx_pot,
+                                       stretch_bin_D[k], angle_bin_1[k])
+
+                    elif (new_type == D_TYPE):
+                        # Transition to another "D" state is always possible
+                        for k in range(no_of_adj):
+                            add_counts(potential_transition, in_state, i, idx_pot,
+                                       stretch_bin_D[k], angle_bin_1[k])
+
+def add_counts(counts, mask, iso, idx, bin_1, bin_2):
+    """ Adds one to counts[iso, idx, bin_1, bin_2] for each True element
+        of mask """
+
+    if not np.any(mask):
+        return
+
+    index = [np.broadcast_to(v, mask.shape)[mask]
+             for v in [iso, idx, bin_1, bin_2]]
+    flat_index = np.ravel_multi_index(index, counts.shape)
+    counts += np.bincount(flat_index,
+                          minlength=counts.size).reshape(counts.shape)
+
+def get_kinetics_tables(c_kinetics):
+    """ Returns look-up arrays for the state type of each (isotype, state)
+        and the transition index of each (isotype, state, new state) """
+
+    type_codes = {'D': D_TYPE, 'A': A_TYPE}
+
+    no_of_states = max([len(isotype) for isotype in c_kinetics])
+
+    state_type = np.zeros((len(c_kinetics), no_of_states+1), dtype=int)
+    trans_index = -np.ones((len(c_kinetics), no_of_states+1, no_of_states+1),
+                           dtype=int)
+
+    for i, isotype in enumerate(c_kinetics):
+        for s, state in enumerate(isotype):
+            if state["state_type"] in type_codes:
+                state_type[i, s+1] = type_codes[state["state_type"]]
+            for trans in state["transition"]:
+                trans_index[i, s+1, trans["to"]] = trans["index"]
+
+    return (state_type, trans_index)
+
 def plot_rate(calculated_rates, c_kinetics, model_file, output_folder):
     
     angle = np.arange(A_MIN,A_MAX, A_STEP)
@@ -721,6 +679,16 @@ def get_node_force_interval(node):
 
     return no_interval
 
+def get_stretch_bins(stretch):
+    """ Array version of get_stretch_interval """
+    return np.clip(np.floor((stretch - X_MIN) / X_STEP),
+                   0, NB_INTER-1).astype(int)
+
+def get_alignment_bins(angle):
+    """ Array version of get_alignment_interval """
+    return np.clip(np.floor((angle - A_MIN) / A_STEP),
+                   0, NB_A_INTER-1).astype(int)
+
 def get_alignment_interval(angle):
     
     # Get the alignment factor bins for calculating probabilities 
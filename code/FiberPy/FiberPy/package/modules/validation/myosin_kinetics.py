@@ -2,7 +2,6 @@ import os
 import json
 
 import numpy as np
-from natsort import natsorted
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
@@ -15,7 +14,7 @@ import math
 # MODULES_ROOT = os.path.realpath(os.path.join(ROOT, "..", ".."))
 # sys.path.append(MODULES_ROOT)
 
-from modules.half_sarcomere import half_sarcomere
+from modules.half_sarcomere import hs_status
         
 ### Create stretch, node force and angle bins
 
@@ -39,23 +38,17 @@ A_MAX = 180
 A_STEP = 9
 
 NB_A_INTER = int((A_MAX - A_MIN)/A_STEP)
+
+# Codes for the state types
+S_TYPE = 1
+D_TYPE = 2
+A_TYPE = 3
         
 
 def compute_rate(model_file, protocol_file, dump_folder, output_folder, adj_bs = 0):
     
     """Approximates the governing rate functions for myosin"""
 
-    ### Get the hs_status dump files ###
-
-    hs_file = []
-
-    for filenames in os.listdir(dump_folder):
-        filenames = os.path.join(dump_folder, filenames)
-
-        hs_file.append(filenames)
-
-    hs_file = natsorted(hs_file) # sorting the dump files
-    
     ### Get the time step ###
 
     protocol = np.loadtxt(protocol_file, skiprows=1)
@@ -68,11 +61,6 @@ def compute_rate(model_file, protocol_file, dump_folder, output_folder, adj_bs =
     m_kinetics = get_m_kinetics(model_file) 
     max_no_of_trans = m_kinetics[0][-1]["transition"][-1]["index"] + 1 
     
-    attachement_trans = [] # List of indices for the 'a' type of transition
-    detachment_trans = [] # List of indices for the 'd' type of transition
-    srx_recr_trans = [] # List of indices for the SRX-to-DRX type of transition
-
-        
     ### Initialize transition matrices
     
     complete_transition = np.zeros((len(m_kinetics), max_no_of_trans, NB_INTER, NB_A_INTER),dtype=int)
@@ -80,316 +68,23 @@ def compute_rate(model_file, protocol_file, dump_folder, output_folder, adj_bs =
     
     
     ### Fill the transition matrices
-               
-    # # HS at t
-    hs_0 = half_sarcomere.half_sarcomere(hs_file[0])
-  
-    for ind in range(1,len(hs_file)): 
-        # HS at t + dt
-        hs_1 = half_sarcomere.half_sarcomere(hs_file[ind])
-      
-        for i, thick_fil_0 in enumerate(hs_0["thick"]): # Loop over all thick filaments
-            
-            thick_fil_1 = hs_1["thick"][i] 
-   
-            for cb_ind, state_0 in enumerate(thick_fil_0["cb_state"]): # loop over all CBs
-                
-                cb_iso_0 = thick_fil_0["cb_iso"][cb_ind] # CB isotype at t
-                cb_iso_1 = thick_fil_1["cb_iso"][cb_ind] # CB isotype at t + dt
-               
-                # Check isotype does not change through time
-                if cb_iso_0 != cb_iso_1:                    
-                    raise RuntimeError(f"Isotype #{cb_iso_0} turned into isotype #{cb_iso_1}")
-                    
-                cb_state_0 = thick_fil_0["cb_state"][cb_ind] # CB state at t
-                cb_state_1 = thick_fil_1["cb_state"][cb_ind] # CB state at t + dt
-                
-                cb_0_type = m_kinetics[cb_iso_0-1][cb_state_0-1]["state_type"] # CB type at t
-                cb_1_type = m_kinetics[cb_iso_1-1][cb_state_1-1]["state_type"] # CB type at t + dt
-                                                
-                ### Determine if a transition occurred ###
-                
-                if cb_state_0 != cb_state_1: # A transition occurred
-                
-                    pot_trans = False
-                   
-                    # Find transition index
-                    for trans in m_kinetics[cb_iso_0-1][cb_state_0-1]["transition"]:  # look through all transitions for cb_state_0
-                        if trans["to"] == cb_state_1:
-                            idx = trans["index"]
-                            pot_trans = True
-                            
-                    if pot_trans == False:
-                          raise RuntimeError(f"Transition index not found for transition from state {cb_state_0} to state {cb_state_1}")
-                    
-                    # Fill the element of the transition counter matrix
-                    # with the proper transition index and stretch values
-                    
-                    if cb_0_type == 'S': 
-                        
-                        if idx not in srx_recr_trans: 
-                            srx_recr_trans.append(idx)
-                                         
-                        if (cb_ind % 2) == 0: # Only even heads can "actively" transition
-                                                 
-                            # Get myosin node index
-                            
-                            node_index = int(np.floor(cb_ind/6))
-                            
-                            # Get node force
-                            
-                            node_force = thick_fil_0["node_forces"][node_index]
-                            cb_node_force_0 = get_node_force_interval(node_force)
-                            
-                            for j in range(0, 2*adj_bs+1): # Fill matrix for each angle
-    
-                                angle_diff = thick_fil_1[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind]                                    
-                                cb_align_factor_0 =  get_alignment_interval(angle_diff)
-                            
-                                complete_transition[cb_iso_0-1,idx,cb_node_force_0, cb_align_factor_0] += 1
-                            
-                            # Check that dimer myosins transition together
-                            if thick_fil_1["cb_state"][cb_ind] != thick_fil_1["cb_state"][cb_ind + 1]:
-                                raise RuntimeError(f"Dimers did not follow the same transition from \
-                                                state {cb_state_0} to state {cb_state_1}")                                                        
-                                                       
-                    elif cb_0_type == 'D':
-                        
-                        if cb_1_type == 'A': # Get the CB stretch
-                        
-                            if idx not in attachement_trans: 
-                                attachement_trans.append(idx) 
-                            
-                            thin_ind = thick_fil_1["cb_bound_to_a_f"][cb_ind]
-                            thin_fil = hs_0["thin"][thin_ind] 
-                            bs_ind_1 = thick_fil_1["cb_bound_to_a_n"][cb_ind]
-                            
-                            stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind_1] 
-                            cb_stretch_0 = get_stretch_interval(stretch)
-                            
-                            for j in range(0, 2*adj_bs+1): # Get the angle difference
-                            
-                                bs_ind = thick_fil_1[f"cb_nearest_a_n[x_{j}]"][cb_ind]    
-                                found = False
-                                
-                                if bs_ind == bs_ind_1:
-                                    found = True
-                                    angle_diff = thick_fil_1[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind]                                    
-                                    cb_align_factor_0 =  get_alignment_interval(angle_diff)
-                                    
-                                    complete_transition[cb_iso_0-1,idx,cb_stretch_0, cb_align_factor_0 ] += 1
-                                    break
-
-                            if found == False:
-                                print("Attachment site not found")
-                                break
-                            
-                        elif cb_1_type == 'D': 
-                                                                      
-                            thin_ind = thick_fil_0["cb_nearest_a_f"][cb_ind]
-                            thin_fil = hs_0["thin"][thin_ind]
-                            
-                            for j in range(0, 2*adj_bs+1): # Loop over the nearest BS
-            
-                                bs_ind = thick_fil_1[f"cb_nearest_a_n[x_{j}]"][cb_ind]                                       
-                                stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind] 
-                                                
-                                cb_stretch_0 = get_stretch_interval(stretch)
-                                
-                                angle_diff = thick_fil_1[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind]                                    
-                                cb_align_factor_0 =  get_alignment_interval(angle_diff)
-                                
-                                complete_transition[cb_iso_0-1,idx,cb_stretch_0, cb_align_factor_0] += 1
-                                
-                        elif cb_1_type == 'S':                        
-                            
-                            if (cb_ind % 2) == 0: # Only even heads can "actively" transition
-                            
-                                if thick_fil_0["cb_state"][cb_ind+1] == cb_state_0: # Transition can occur only if both dimer heads are in the same state at t
-                        
-                                    # Get myosin node index
-                                
-                                    node_index = int(np.floor(cb_ind/6))
-                                
-                                    # Get node force
-                                    
-                                    node_force = thick_fil_0["node_forces"][node_index]
-                                    cb_node_force_0 = get_node_force_interval(node_force)
-                                    
-                                    for j in range(0, 2*adj_bs+1): # Loop over angle difference
-    
-                                        angle_diff = thick_fil_1[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind]                                    
-                                        cb_align_factor_0 =  get_alignment_interval(angle_diff)
-                                    
-                                        complete_transition[cb_iso_0-1,idx,cb_node_force_0,cb_align_factor_0] += 1
-                                
-                    elif cb_0_type == 'A': # Get the CB stretch    
-                    
-                        if cb_1_type == 'D' and idx not in detachment_trans:
-                            detachment_trans.append(idx)
-                        
-                        thin_ind = thick_fil_0["cb_bound_to_a_f"][cb_ind]
-                        thin_fil_0 = hs_0["thin"][thin_ind]
-                        bs_ind_0 = thick_fil_0["cb_bound_to_a_n"][cb_ind]
-                    
-                        stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil_0["bs_x"][bs_ind_0] 
-                        cb_stretch_0 = get_stretch_interval(stretch)
-                        
-                        for j in range(0, 2*adj_bs+1): # Get the angle difference
-                    
-                            found = False        
-                            bs_ind = thick_fil_0[f"cb_nearest_a_n[x_{j}]"][cb_ind]  
-                            
-                            if bs_ind == bs_ind_0:
-                                found = True
-                                angle_diff = thick_fil_0[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind]                                    
-                                cb_align_factor_0 =  get_alignment_interval(angle_diff)
-                                
-                                complete_transition[cb_iso_0-1,idx,cb_stretch_0, cb_align_factor_0 ] += 1
-                                break
-                                
-                        if found == False:
-                            print("Attachment site not found due to filaments compliance")
-                            break
-
-                ### Determine all potential transitions depending on state type (S, D and A) ###
-                
-                # SRX (S)
-                
-                if cb_0_type == 'S':
-                    
-                    if (cb_ind % 2) == 0: # Only even heads can "actively" transition
-                    
-                        for trans in m_kinetics[cb_iso_0-1][cb_state_0-1]["transition"]: 
 
-                            idx_pot = trans["index"]
-                        
-                            if thick_fil_0["cb_state"][cb_ind+1] == cb_state_0: # Transition can occur only if both dimer heads are in the same state at t
-                         
-                                # Get myosin node index
-                                
-                                node_index = int(np.floor(cb_ind/6))
-                                
-                                # Get node force
-                                
-                                node_force = thick_fil_0["node_forces"][node_index]
-                                cb_node_force_0 = get_node_force_interval(node_force)
-                                
-                                for j in range(0, 2*adj_bs+1): # Loop over angle differences
-    
-                                    angle = thick_fil_1[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind]                                    
-                                    cb_align_factor_0 =  get_alignment_interval(angle)
-                               
-                                    potential_transition[cb_iso_0-1,idx_pot,cb_node_force_0, cb_align_factor_0] += 1
-
-                
-                # Attached (A)
-                
-                elif cb_0_type == 'A': # Get CB stretch
-
-                    thin_ind = thick_fil_0["cb_bound_to_a_f"][cb_ind]
-                    bs_ind_0 = thick_fil_0["cb_bound_to_a_n"][cb_ind]
-                    thin_fil = hs_0["thin"][thin_ind]   # Correction 
-                    
-                    stretch = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind_0] 
-
-                    cb_stretch_0 = get_stretch_interval(stretch)
-                    
-                    for j in range(0, 2*adj_bs+1):
-                        
-                        found = False
-                        bs_ind = thick_fil_0[f"cb_nearest_a_n[x_{j}]"][cb_ind]  
-                        
-                        if bs_ind == bs_ind_0:
-                            
-                            found = True 
-                            angle = thick_fil_0[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind] 
-                                   
-                            cb_align_factor_0 =  get_alignment_interval(angle)
-                            
-                            for trans in m_kinetics[cb_iso_0-1][cb_state_0-1]["transition"]: 
-                        
-                                # All transitions from an attached state are possible
-                        
-                                idx_pot = trans["index"]
-                        
-                                potential_transition[cb_iso_0-1, idx_pot, cb_stretch_0, cb_align_factor_0] += 1 
-                                
-                            break
-                        
-                    if found == False:
-                        print("Attachment site not found due to filaments compliance")
-                        break
-                               
-                # Detached (D)
-                
-                elif cb_0_type == 'D':
-                    
-                    # Get array of nearest BS and calculate stretch and angle difference array
-                
-                    bs_ind = np.zeros(2*adj_bs + 1, dtype = int)
-                    stretch = np.zeros(2*adj_bs + 1)
-                    angle = np.zeros(2*adj_bs + 1)
-                    
-                    thin_ind = thick_fil_0["cb_nearest_a_f"][cb_ind]
-                    thin_fil = hs_0["thin"][thin_ind] # 
-                    
-                    for j in range(0, 2*adj_bs+1):
-    
-                        bs_ind[j] = thick_fil_1[f"cb_nearest_a_n[x_{j}]"][cb_ind] # nearest bs have been recalculated                                      
-                        stretch[j] = thick_fil_0["cb_x"][cb_ind] - thin_fil["bs_x"][bs_ind[j]]
-                        
-                        angle[j] = thick_fil_1[f"cb_nearest_bs_angle_diff[x_{j}]"][cb_ind]                                    
-
-                                           
-                    for trans in m_kinetics[cb_iso_0-1][cb_state_0-1]["transition"]:
-                        
-                        new_state = trans["to"]
-                        idx_pot = trans["index"]
-                        
-                        if m_kinetics[cb_iso_0-1][new_state-1]["state_type"]== 'A':
-                            
-                            # Check if the potential binding sites are available 
-                            
-                            for k in range(0, 2*adj_bs +1):
-                                
-                                bs_availability = thick_fil_1[f"cb_nearest_a_n_states[x_{k}]"][cb_ind] 
-                            
-                                if bs_availability == 2: # bs is free and available for attachment
-        
-                                    cb_stretch_0 = get_stretch_interval(stretch[k])                                    
-                                    cb_align_factor_0 =  get_alignment_interval(angle[k])
-                                    potential_transition[cb_iso_0-1, idx_pot, cb_stretch_0, cb_align_factor_0] += 1 
-
-                        elif m_kinetics[cb_iso_0-1][new_state-1]["state_type"]== 'S':
-                            
-                                if (cb_ind % 2) == 0: # Only even heads can "actively" transition
-                    
-                                    if thick_fil_0["cb_state"][cb_ind+1] == cb_state_0: # Transition can occur only if both dimer heads are in the same state at t
-                     
-                                        # Get myosin node index
-                                        
-                                        node_index = int(np.floor(cb_ind/6))
-                                        
-                                        # Get node force
-                                        
-                                        node_force = thick_fil_0["node_forces"][node_index]
-                                        cb_node_force_0 = get_node_force_interval(node_force)
-                                        
-                                        for k in range(0, 2*adj_bs +1):
-                                            cb_align_factor_0 =  get_alignment_interval(angle[k])
-                                            potential_transition[cb_iso_0-1,idx_pot,cb_node_force_0, cb_align_factor_0] += 1 
-                        
-                        elif m_kinetics[cb_iso_0-1][new_state-1]["state_type"]== 'D': # Transition to another "D" state is always possible
-                            for k in range(0, 2*adj_bs +1): 
-                                cb_stretch_0 = get_stretch_interval(stretch[k])
-                                cb_align_factor_0 =  get_alignment_interval(angle[k])
-                                potential_transition[cb_iso_0-1, idx_pot, cb_stretch_0, cb_align_factor_0] += 1                                                           
-                
-                else:
-                    raise RuntimeError(f"State #{cb_state_0} is neither type A, D or S")
-                                
-              
+    # Only read the fields that are needed from each dump
+    fields = ['cb_state', 'cb_iso', 'cb_x', 'cb_bound_to_a_f',
+              'cb_bound_to_a_n', 'cb_nearest_a_f', 'node_forces', 'bs_x']
+    for j in range(0, 2*adj_bs+1):
+        fields.append(f"cb_nearest_a_n[x_{j}]")
+        fields.append(f"cb_nearest_a_n_states[x_{j}]")
+        fields.append(f"cb_nearest_bs_angle_diff[x_{j}]")
+
+    kinetics_tables = get_kinetics_tables(m_kinetics)
+
+    # Compare each dump (HS at t + dt) with the one before (HS at t)
+    hs_0 = None
+    for hs_1 in hs_status.iterate_dump_folder(dump_folder, fields):
+        if (hs_0 is not None):
+            count_transitions(m_kinetics, kinetics_tables, hs_0, hs_1, adj_bs,
+                              complete_transition, potential_transition)
         hs_0 = hs_1
         
 
@@ -569,6 +264,233 @@ def compute_rate(model_file, protocol_file, dump_folder, output_folder, adj_bs =
                 
     # return calculated_rates_dict
 
+def count_transitions(m_kinetics, kinetics_tables, hs_0, hs_1, adj_bs,
+                      complete_transition, potential_transition):
+    """ Adds the transitions between two consecutive dumps to the
+        complete and potential transition counts
+
+    The heads on all the thick filaments are handled together. For each
+    head, the state at t is compared with the state at t + dt, the
+    stretch, node force and alignment are binned, and the counts are
+    accumulated with np.bincount.
+    """
+
+    (state_type, trans_index) = kinetics_tables
+
+    thick_0 = hs_0["thick"]
+    thick_1 = hs_1["thick"]
+    bs_x = hs_0["thin"]["bs_x"]
+
+    no_of_adj = 2*adj_bs + 1
+
+    state_0 = thick_0["cb_state"]
+    state_1 = thick_1["cb_state"]
+    iso_0 = thick_0["cb_iso"]
+    iso_1 = thick_1["cb_iso"]
+    (no_of_fils, no_of_cbs) = state_0.shape
+    cb_index = np.broadcast_to(np.arange(no_of_cbs), state_0.shape)
+
+    type_0 = state_type[iso_0-1, state_0] # CB type at t
+    type_1 = state_type[iso_0-1, state_1] # CB type at t + dt
+    changed = (state_0 != state_1)
+
+    # Only even heads can "actively" transition, and some transitions can
+    # occur only if both dimer heads are in the same state at t
+    even = ((cb_index % 2) == 0)
+    partner = np.arange(no_of_cbs) ^ 1
+    same_dimer_0 = even & (state_0[:, partner] == state_0)
+
+    # Nearest binding sites, their states and the angle differences
+    near_n_0 = np.stack([thick_0[f"cb_nearest_a_n[x_{j}]"]
+                         for j in range(no_of_adj)])
+    near_n_1 = np.stack([thick_1[f"cb_nearest_a_n[x_{j}]"]
+                         for j in range(no_of_adj)])
+    near_states_1 = np.stack([thick_1[f"cb_nearest_a_n_states[x_{j}]"]
+                              for j in range(no_of_adj)])
+    angle_bin_0 = get_alignment_bins(np.stack(
+        [thick_0[f"cb_nearest_bs_angle_diff[x_{j}]"] for j in range(no_of_adj)]))
+    angle_bin_1 = get_alignment_bins(np.stack(
+        [thick_1[f"cb_nearest_bs_angle_diff[x_{j}]"] for j in range(no_of_adj)]))
+
+    # Heads attached at t
+    stretch_A = thick_0["cb_x"] - \
+        bs_x[thick_0["cb_bound_to_a_f"], thick_0["cb_bound_to_a_n"]]
+    stretch_bin_A = get_stretch_bins(stretch_A)
+    match_A = (near_n_0 == thick_0["cb_bound_to_a_n"])
+    found_A = np.any(match_A, axis=0)
+    angle_bin_A = np.take_along_axis(angle_bin_0,
+                                     np.argmax(match_A, axis=0)[np.newaxis],
+                                     axis=0)[0]
+
+    # Heads that attach between t and t + dt
+    stretch_DA = thick_0["cb_x"] - \
+        bs_x[thick_1["cb_bound_to_a_f"], thick_1["cb_bound_to_a_n"]]
+    stretch_bin_DA = get_stretch_bins(stretch_DA)
+    match_DA = (near_n_1 == thick_1["cb_bound_to_a_n"])
+    found_DA = np.any(match_DA, axis=0)
+    angle_bin_DA = np.take_along_axis(angle_bin_1,
+                                      np.argmax(match_DA, axis=0)[np.newaxis],
+                                      axis=0)[0]
+
+    # Detached heads, using the nearest binding sites at t + dt
+    stretch_bin_D = get_stretch_bins(
+        thick_0["cb_x"] - bs_x[thick_0["cb_nearest_a_f"][np.newaxis], near_n_1])
+
+    # Node forces for each head
+    force_bin = get_node_force_bins(
+        np.take_along_axis(thick_0["node_forces"], cb_index // 6, axis=1))
+
+    # Heads are processed in order along each filament. If the binding
+    # site of an attached head cannot be found, the rest of that filament
+    # is skipped for this time step
+    missing_A = (type_0 == A_TYPE) & ~found_A
+    missing_DA = (type_0 == D_TYPE) & changed & (type_1 == A_TYPE) & ~found_DA
+    missing = missing_A | missing_DA
+    first_missing = np.where(np.any(missing, axis=1),
+                             np.argmax(missing, axis=1), no_of_cbs)
+    processed = (cb_index < first_missing[:, np.newaxis])
+    reached = (cb_index <= first_missing[:, np.newaxis])
+
+    for f in np.flatnonzero(first_missing < no_of_cbs):
+        if missing_DA[f, first_missing[f]]:
+            print("Attachment site not found")
+        else:
+            print("Attachment site not found due to filaments compliance")
+
+    # Check the transitions are consistent with the model
+    bad = reached & (iso_0 != iso_1)
+    if np.any(bad):
+        (f, c) = np.argwhere(bad)[0]
+        raise RuntimeError(f"Isotype #{iso_0[f, c]} turned into isotype #{iso_1[f, c]}")
+
+    idx = trans_index[iso_0-1, state_0, state_1]
+    bad = reached & changed & (idx < 0)
+    if np.any(bad):
+        (f, c) = np.argwhere(bad)[0]
+        raise RuntimeError(f"Transition index not found for transition from state {state_0[f, c]} to state {state_1[f, c]}")
+
+    bad = processed & changed & (type_0 == S_TYPE) & even & \
+        (state_1 != state_1[:, partner])
+    if np.any(bad):
+        (f, c) = np.argwhere(bad)[0]
+        raise RuntimeError(f"Dimers did not follow the same transition from \
+                                                state {state_0[f, c]} to state {state_1[f, c]}")
+
+    bad = processed & (type_0 == 0)
+    if np.any(bad):
+        (f, c) = np.argwhere(bad)[0]
+        raise RuntimeError(f"State #{state_0[f, c]} is neither type A, D or S")
+
+    ### Complete transitions
+
+    m = processed & changed
+    iso = iso_0 - 1
+
+    # From SRX, binned by node force
+    mask = m & (type_0 == S_TYPE) & even
+    for j in range(no_of_adj):
+        add_counts(complete_transition, mask, iso, idx, force_bin, angle_bin_1[j])
+
+    # Attachment, binned by the stretch to the new binding site
+    mask = m & (type_0 == D_TYPE) & (type_1 == A_TYPE)
+    add_counts(complete_transition, mask, iso, idx, stretch_bin_DA, angle_bin_DA)
+
+    # Between detached states, for each nearest binding site
+    mask = m & (type_0 == D_TYPE) & (type_1 == D_TYPE)
+    for j in range(no_of_adj):
+        add_counts(complete_transition, mask, iso, idx, stretch_bin_D[j], angle_bin_1[j])
+
+    # Into SRX
+    mask = m & (type_0 == D_TYPE) & (type_1 == S_TYPE) & same_dimer_0
+    for j in range(no_of_adj):
+        add_counts(complete_transition, mask, iso, idx, force_bin, angle_bin_1[j])
+
+    # From attached states
+    mask = m & (type_0 == A_TYPE)
+    add_counts(complete_transition, mask, iso, idx, stretch_bin_A, angle_bin_A)
+
+    ### Potential transitions, for each isotype and state
+
+    for i, isotype in enumerate(m_kinetics):
+        for s in range(1, len(isotype)+1):
+
+            in_state = processed & (iso_0 == (i+1)) & (state_0 == s)
+            if not np.any(in_state):
+                continue
+
+            for trans in isotype[s-1]["transition"]:
+
+                idx_pot = trans["index"]
+                new_type = state_type[i, trans["to"]]
+
+                if (state_type[i, s] == S_TYPE):
+
+                    mask = in_state & same_dimer_0
+                    for j in range(no_of_adj):
+                        add_counts(potential_transition, mask, i, idx_pot,
+                                   force_bin, angle_bin_1[j])
+
+                elif (state_type[i, s] == A_TYPE):
+
+                    # All transitions from an attached state are possible
+                    add_counts(potential_transition, in_state, i, idx_pot,
+                               stretch_bin_A, angle_bin_A)
+
+                elif (state_type[i, s] == D_TYPE):
+
+                    if (new_type == A_TYPE):
+                        # Check if the potential binding sites are available
+                        for k in range(no_of_adj):
+                            mask = in_state & (near_states_1[k] == 2)
+                            add_counts(potential_transition, mask, i, idx_pot,
+                                       stretch_bin_D[k], angle_bin_1[k])
+
+                    elif (new_type == S_TYPE):
+                        mask = in_state & same_dimer_0
+                        for k in range(no_of_adj):
+                            add_counts(potential_transition, mask, i, idx_pot,
+                                       force_bin, angle_bin_1[k])
+
+                    elif (new_type == D_TYPE):
+                        # Transition to another "D" state is always possible
+                        for k in range(no_of_adj):
+                            add_counts(potential_transition, in_state, i, idx_pot,
+                                       stretch_bin_D[k], angle_bin_1[k])
+
+def add_counts(counts, mask, iso, idx, bin_1, bin_2):
+    """ Adds one to counts[iso, idx, bin_1, bin_2] for each True element
+        of mask """
+
+    if not np.any(mask):
+        return
+
+    index = [np.broadcast_to(v, mask.shape)[mask]
+             for v in [iso, idx, bin_1, bin_2]]
+    flat_index = np.ravel_multi_index(index, counts.shape)
+    counts += np.bincount(flat_index,
+                          minlength=counts.size).reshape(counts.shape)
+
+def get_kinetics_tables(m_kinetics):
+    """ Returns look-up arrays for the state type of each (isotype, state)
+        and the transition index of each (isotype, state, new state) """
+
+    type_codes = {'S': S_TYPE, 'D': D_TYPE, 'A': A_TYPE}
+
+    no_of_states = max([len(isotype) for isotype in m_kinetics])
+
+    state_type = np.zeros((len(m_kinetics), no_of_states+1), dtype=int)
+    trans_index = -np.ones((len(m_kinetics), no_of_states+1, no_of_states+1),
+                           dtype=int)
+
+    for i, isotype in enumerate(m_kinetics):
+        for s, state in enumerate(isotype):
+            if state["state_type"] in type_codes:
+                state_type[i, s+1] = type_codes[state["state_type"]]
+            for trans in state["transition"]:
+                trans_index[i, s+1, trans["to"]] = trans["index"]
+
+    return (state_type, trans_index)
+
 def plot_rate(calculated_rates, m_kinetics, model_file, output_folder):
     
     angle = np.arange(A_MIN,A_MAX, A_STEP)
@@ -899,6 +821,21 @@ def get_node_force_interval(node):
 
     return no_interval
 
+def get_stretch_bins(stretch):
+    """ Array version of get_stretch_interval """
+    return np.clip(np.floor((stretch - X_MIN) / X_STEP),
+                   0, NB_INTER-1).astype(int)
+
+def get_node_force_bins(node):
+    """ Array version of get_node_force_interval """
+    return np.clip(np.floor((node - F_MIN) / F_STEP),
+                   0, NB_INTER-1).astype(int)
+
+def get_alignment_bins(angle):
+    """ Array version of get_alignment_interval """
+    return np.clip(np.floor((angle - A_MIN) / A_STEP),
+                   0, NB_A_INTER-1).astype(int)
+
 def get_alignment_interval(angle):
     
     # Get the alignment factor bins for calculating probabilities 